@@ -1,6 +1,7 @@
 import os
 import logging
-from flask import Flask, send_from_directory
+import threading
+from flask import Flask, jsonify
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde .env
@@ -16,13 +17,6 @@ def create_app(test_config=None):
     # Crear y configurar la aplicación
     app = Flask(__name__, static_folder='static')
     
-    # Asegurarse de que el directorio de imágenes existe
-    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    whatsapp_images_dir = os.path.join(static_dir, 'whatsapp_images')
-    
-    for directory in [static_dir, whatsapp_images_dir]:
-        os.makedirs(directory, exist_ok=True)
-    
     # Cargar valores de .env para debugging
     logging.info(f"PHONE_NUMBER_ID: {os.getenv('PHONE_NUMBER_ID', 'No configurado')}")
     logging.info(f"VERSION: {os.getenv('VERSION', 'No configurado')}")
@@ -36,6 +30,8 @@ def create_app(test_config=None):
         VERIFY_TOKEN=os.environ.get('VERIFY_TOKEN', 'Harmony2025'),
         OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', ''),
         OPENAI_ASSISTANT_ID=os.environ.get('OPENAI_ASSISTANT_ID', ''),
+        # Detrás de nginx/Apache los medios se entregan con X-Sendfile en lugar de pasar por Python
+        USE_X_SENDFILE=os.environ.get('MEDIA_X_SENDFILE', 'false').lower() in ('1', 'true', 'yes'),
     )
 
     if test_config is None:
@@ -49,15 +45,42 @@ def create_app(test_config=None):
     logging.info(f"PHONE_NUMBER_ID en app.config: {app.config.get('PHONE_NUMBER_ID', 'No configurado')}")
     logging.info(f"VERSION en app.config: {app.config.get('VERSION', 'No configurado')}")
 
-    # Ruta para acceder a las imágenes de WhatsApp
-    @app.route('/static/whatsapp_images/<path:filename>')
-    def whatsapp_images(filename):
-        return send_from_directory(whatsapp_images_dir, filename)
-
     # Registrar blueprint para webhook
     from app.services import webhook
     app.register_blueprint(webhook.bp)
 
+    # Servidor de medios por hash de contenido (ETag, Range y caché inmutable)
+    from app.services import media_server
+    app.register_blueprint(media_server.bp)
+
+    # Responder los turnos que quedaron diferidos durante caídas del modelo
+    from app.utils.whatsapp_utils import start_deferred_replay_worker
+    start_deferred_replay_worker(app)
+
+    # Entregar los mensajes salientes del outbox (incluye los que quedaron pendientes)
+    from app.utils.whatsapp_utils import start_outbox_worker
+    start_outbox_worker(app)
+
+    # Retomar las extracciones de captura que quedaron pendientes
+    from app.services.openai_service import capture_extractor
+    if capture_extractor:
+        capture_extractor.start()
+
+    # Abrir en segundo plano las conexiones con la Graph API para que el primer mensaje
+    # no pague el handshake TLS (GRAPH_API_WARMUP_CONNECTIONS=0 lo desactiva)
+    from app.services.graph_api import get_graph_api_client
+    graph_api = get_graph_api_client()
+    warmup_connections = int(os.getenv("GRAPH_API_WARMUP_CONNECTIONS", "2"))
+    if warmup_connections > 0:
+        threading.Thread(
+            target=graph_api.warm_up, args=(warmup_connections,), name="graph-api-warmup", daemon=True
+        ).start()
+
+    # Latencia de las llamadas a la Graph API por endpoint
+    @app.route('/metrics/graph-api')
+    def graph_api_metrics():
+        return jsonify(graph_api.stats())
+
     # Ruta principal para verificar que la aplicación está funcionando
     @app.route('/')
     def index():
@@ -0,0 +1,287 @@
+import os
+import shutil
+import sqlite3
+import logging
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Formato al que se normalizan las notas de voz antes de transcribir (lo que esperan los modelos tipo Whisper)
+NORMALIZED_SAMPLE_RATE = 16000
+
+
+def normalize_audio(src_path, output_dir, timeout=60):
+    """
+    Convierte una nota de voz (OGG/Opus de WhatsApp) a WAV mono de 16kHz con ffmpeg.
+
+    Si ffmpeg no está instalado o la conversión falla se retorna el archivo original,
+    que los backends también aceptan.
+
+    Returns:
+        Ruta del audio a transcribir
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return src_path
+    stem = os.path.splitext(os.path.basename(src_path))[0]
+    output_path = os.path.join(output_dir, f"{stem}.wav")
+    if os.path.exists(output_path):
+        return output_path
+    tmp_path = output_path + ".tmp.wav"
+    try:
+        subprocess.run(
+            [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", src_path,
+             "-ac", "1", "-ar", str(NORMALIZED_SAMPLE_RATE), "-sample_fmt", "s16", tmp_path],
+            check=True, timeout=timeout, capture_output=True
+        )
+        os.replace(tmp_path, output_path)
+        return output_path
+    except Exception as e:
+        logger.warning(f"No se pudo normalizar {src_path} con ffmpeg, se usa el original: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return src_path
+
+
+class StubTranscriptionBackend:
+    """Backend local sin red para pruebas: retorna una transcripción fija con el tamaño del audio."""
+    name = "stub"
+
+    def transcribe(self, path):
+        return f"Transcripción de prueba ({os.path.getsize(path) / 1024:.1f}KB de audio)"
+
+
+class OpenAITranscriptionBackend:
+    """Backend de transcripción con la API de audio de OpenAI (whisper-1 por defecto)."""
+    name = "openai"
+
+    def __init__(self, call_layer, model="whisper-1", language="es"):
+        self.call_layer = call_layer
+        self.model = model
+        self.language = language
+
+    def transcribe(self, path):
+        with open(path, "rb") as f:
+            audio = (os.path.basename(path), f.read())
+        response, _ = self.call_layer.call(
+            self.call_layer.client.audio.transcriptions.create,
+            allow_hedge=False,
+            model=self.model,
+            file=audio,
+            language=self.language,
+        )
+        return response.text
+
+
+class LocalWhisperBackend:
+    """
+    Backend con un modelo Whisper local (faster-whisper, dependencia opcional).
+    El modelo se carga una sola vez, en el primer audio.
+    """
+    name = "local"
+
+    def __init__(self, model_size="small", language="es", compute_type="int8"):
+        try:
+            import faster_whisper  # noqa: F401
+        except ImportError:
+            raise ImportError("Biblioteca faster-whisper no instalada. Instálala para usar AUDIO_TRANSCRIPTION_BACKEND=local")
+        self.model_size = model_size
+        self.language = language
+        self.compute_type = compute_type
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def transcribe(self, path):
+        with self._model_lock:
+            if self._model is None:
+                from faster_whisper import WhisperModel
+                self._model = WhisperModel(self.model_size, compute_type=self.compute_type)
+        segments, _ = self._model.transcribe(path, language=self.language)
+        return " ".join(segment.text.strip() for segment in segments)
+
+
+class AudioTranscriber:
+    """
+    Pool de trabajadores que transcribe las notas de voz fuera del turno del webhook.
+
+    Cada audio se normaliza y se transcribe una sola vez (por sha256); el resultado
+    queda en la tabla audio_transcripts hasta que la conversación lo incorpora en su
+    siguiente turno.
+    """
+
+    def __init__(self, backend, db_path="whatsapp_conversations.db", max_workers=2, work_dir="audio_normalized",
+                 on_transcript=None, on_file=None):
+        """
+        Args:
+            backend: Backend de transcripción (transcribe(path) -> texto)
+            db_path: Base de datos SQLite con las transcripciones
+            max_workers: Transcripciones simultáneas
+            work_dir: Directorio de los audios normalizados
+            on_transcript: Callback opcional (wa_id, conversation_id, texto) al terminar
+            on_file: Callback opcional (ruta, sha256, kind) por cada audio normalizado en work_dir
+        """
+        self.backend = backend
+        self.db_path = db_path
+        self.work_dir = work_dir
+        self.on_transcript = on_transcript
+        self.on_file = on_file
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="audio-transcription")
+        self._pending = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de transcripciones si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS audio_transcripts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wa_id TEXT,
+                conversation_id TEXT,
+                media_id TEXT,
+                sha256 TEXT,
+                status TEXT DEFAULT 'pending',
+                transcript TEXT,
+                backend TEXT,
+                error TEXT,
+                merged BOOLEAN DEFAULT 0,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_audio_transcripts_wa_id ON audio_transcripts (wa_id, merged)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de transcripciones: {e}")
+
+    def _cached_transcript(self, sha256):
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT transcript FROM audio_transcripts WHERE sha256 = ? AND status = 'done' LIMIT 1", (sha256,))
+        row = c.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def submit(self, wa_id, conversation_id, handle):
+        """
+        Encola la transcripción de una nota de voz ya ingerida.
+
+        Args:
+            handle: Handle del medio (media_id, path, sha256, size, mime, url)
+
+        Returns:
+            Future con el texto transcrito
+        """
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO audio_transcripts (wa_id, conversation_id, media_id, sha256, backend, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (wa_id, conversation_id, handle.get("media_id"), handle["sha256"], self.backend.name, now, now)
+        )
+        row_id = c.lastrowid
+        conn.commit()
+        conn.close()
+
+        future = self._executor.submit(self._transcribe, row_id, wa_id, conversation_id, handle)
+        with self._lock:
+            self._pending.setdefault(conversation_id, set()).add(future)
+        future.add_done_callback(lambda done: self._discard_pending(conversation_id, done))
+        return future
+
+    def _discard_pending(self, conversation_id, future):
+        with self._lock:
+            self._pending.get(conversation_id, set()).discard(future)
+
+    def _transcribe(self, row_id, wa_id, conversation_id, handle):
+        transcript = self._cached_transcript(handle["sha256"])
+        error = None
+        if transcript is None:
+            try:
+                audio_path = normalize_audio(handle["path"], self.work_dir)
+                if self.on_file and audio_path != handle["path"]:
+                    self.on_file(audio_path, handle["sha256"], "audio_normalized")
+                transcript = (self.backend.transcribe(audio_path) or "").strip()
+                logger.info(f"Audio {handle.get('media_id')} transcrito con {self.backend.name} ({len(transcript)} caracteres)")
+            except Exception as e:
+                logger.error(f"Error transcribiendo el audio {handle.get('media_id')}: {e}")
+                error = str(e)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE audio_transcripts SET status = ?, transcript = ?, error = ?, updated_at = ? WHERE id = ?",
+            ("failed" if error else "done", transcript, error, datetime.now().isoformat(), row_id)
+        )
+        conn.commit()
+        conn.close()
+        if transcript and self.on_transcript:
+            self.on_transcript(wa_id, conversation_id, transcript)
+        return transcript
+
+    def wait(self, conversation_id, timeout=120):
+        """Espera las transcripciones en curso de una conversación"""
+        with self._lock:
+            pending = set(self._pending.get(conversation_id, set()))
+        if pending:
+            wait(pending, timeout=timeout)
+
+    def take_unmerged(self, wa_id):
+        """
+        Retorna las transcripciones terminadas que la conversación aún no incorporó y
+        las marca como incorporadas.
+
+        Returns:
+            Lista de dicts con media_id, sha256 y transcript
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level="IMMEDIATE")
+        try:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            c.execute(
+                "SELECT id, media_id, sha256, transcript FROM audio_transcripts "
+                "WHERE wa_id = ? AND status = 'done' AND merged = 0 ORDER BY id",
+                (wa_id,)
+            )
+            rows = [dict(row) for row in c.fetchall()]
+            c.executemany("UPDATE audio_transcripts SET merged = 1 WHERE id = ?", [(row["id"],) for row in rows])
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def transcripts_for(self, conversation_id):
+        """Retorna las transcripciones terminadas de una conversación (sin marcarlas)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(
+            "SELECT media_id, sha256, transcript FROM audio_transcripts "
+            "WHERE conversation_id = ? AND status = 'done' ORDER BY id",
+            (conversation_id,)
+        )
+        rows = [dict(row) for row in c.fetchall()]
+        conn.close()
+        return rows
+
+
+def create_transcription_backend_from_env(call_layer):
+    """
+    Crea el backend de transcripción según AUDIO_TRANSCRIPTION_BACKEND:
+    "openai" (por defecto), "local" (faster-whisper), "stub" o "none".
+    """
+    backend = os.getenv("AUDIO_TRANSCRIPTION_BACKEND", "openai").lower()
+    if backend == "none":
+        return None
+    if backend == "local":
+        return LocalWhisperBackend(model_size=os.getenv("AUDIO_TRANSCRIPTION_MODEL", "small"))
+    if backend == "stub" or call_layer is None:
+        return StubTranscriptionBackend()
+    return OpenAITranscriptionBackend(call_layer, model=os.getenv("AUDIO_TRANSCRIPTION_MODEL", "whisper-1"))
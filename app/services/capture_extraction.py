@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from app.utils.flow_state import (
+    AFFIRMATIVE_WORDS,
+    DONE_WORDS,
+    NEGATIVE_WORDS,
+    get_flow_step,
+    normalize_text,
+    update_flow_step,
+)
+
+logger = logging.getLogger(__name__)
+
+# Tiendas consideradas canal moderno (ver el guion del asistente)
+MODERN_CHANNEL_STORES = [
+    "d1", "ara", "exito", "carulla", "alkosto", "olimpica", "sao", "jumbo",
+    "metro", "makro", "farmatodo", "locatel",
+]
+
+# Campos de la captura normalizada
+CAPTURE_FIELDS = ["registered", "store_name", "channel", "city", "client", "category", "brand_feedback"]
+
+EXTRACTION_PROMPT = """Extrae los datos capturados en esta conversación de WhatsApp entre un asistente de Kapta y un usuario que registra una tienda.
+Responde SOLO con un objeto JSON con estas claves (null si el dato no aparece):
+- registered: true si el usuario ya estaba registrado en Kapta, false si no
+- store_name: nombre de la tienda
+- channel: "moderno" o "tradicional"
+- city: ciudad del usuario (solo si se registró)
+- client: cliente del usuario (solo si se registró)
+- category: categoría de productos fotografiada
+- brand_feedback: resumen de lo que el usuario dijo sobre su marca y la competencia"""
+
+
+def build_transcript(conversation_history):
+    """Convierte el historial de conversación en un texto plano para la extracción"""
+    lines = []
+    for message in conversation_history:
+        if message.get("role") in ("user", "assistant"):
+            lines.append(f"{message['role']}: {message.get('content', '')}")
+    return "\n".join(lines)
+
+
+def normalize_capture(raw, user_data):
+    """
+    Normaliza la extracción del modelo y la completa con los datos ya conocidos
+    del usuario (ubicación, fotos y audios recibidos).
+    """
+    record = {field: raw.get(field) for field in CAPTURE_FIELDS}
+    for field in ("store_name", "city", "client", "category", "brand_feedback"):
+        if isinstance(record[field], str):
+            record[field] = record[field].strip() or None
+
+    if isinstance(record["registered"], str):
+        record["registered"] = normalize_text(record["registered"]) in ("true", "si", "yes")
+    store_name = record["store_name"] or user_data.get("store_name")
+    record["store_name"] = store_name
+    if store_name:
+        store_words = set(normalize_text(store_name).split())
+        record["channel"] = "moderno" if store_words & set(MODERN_CHANNEL_STORES) else "tradicional"
+    elif record["channel"]:
+        record["channel"] = normalize_text(record["channel"]) or None
+
+    location = user_data.get("location") or {}
+    record["latitude"] = location.get("latitude")
+    record["longitude"] = location.get("longitude")
+    record["photo_count"] = len(user_data.get("images", []))
+    record["audio_count"] = len(user_data.get("audio_messages", []))
+    return record
+
+
+# Marcas con que el webhook registra en el historial los mensajes que no son texto
+MEDIA_MARKERS = {"[📸": "image", "[📷": "image", "[🎤": "audio", "[📍": "location", "[🗺️": "location"}
+
+
+def transcript_messages(transcript):
+    """Separa una transcripción de build_transcript en pares (rol, contenido)"""
+    parts = re.split(r'^(user|assistant): ', transcript, flags=re.MULTILINE)
+    return [(parts[i], parts[i + 1].strip()) for i in range(1, len(parts) - 1, 2)]
+
+
+class StubExtractionBackend:
+    """
+    Backend local sin red para pruebas: recorre los mensajes del usuario con la
+    misma máquina de estados del flujo y toma de ahí si ya estaba registrado, el
+    nombre de la tienda y lo que escribió sobre su marca durante el paso del audio.
+    """
+    name = "stub"
+
+    def extract_batch(self, transcripts):
+        return [self._extract(transcript) for transcript in transcripts]
+
+    def _extract(self, transcript):
+        raw = {}
+        state = {}
+        feedback = []
+        for role, content in transcript_messages(transcript):
+            if role != "user":
+                continue
+            message_type = next((kind for marker, kind in MEDIA_MARKERS.items() if content.startswith(marker)),
+                                "other" if content.startswith("[") else "text")
+            words = set(normalize_text(content).split()) if message_type == "text" else set()
+            step = get_flow_step(state)
+            if step == "onboarding" and "registered" not in raw:
+                if words & NEGATIVE_WORDS:
+                    raw["registered"] = False
+                elif words & AFFIRMATIVE_WORDS:
+                    raw["registered"] = True
+            elif step == "audio" and words - DONE_WORDS:
+                feedback.append(content)
+            update_flow_step(state, message_type, content if message_type == "text" else None)
+        raw["store_name"] = state.get("store_name")
+        raw["brand_feedback"] = " ".join(feedback) or None
+        return raw
+
+
+class OpenAIExtractionBackend:
+    """Backend de extracción con salida estructurada (JSON) de OpenAI."""
+    name = "openai"
+
+    def __init__(self, call_layer, model):
+        self.call_layer = call_layer
+        self.model = model
+
+    def extract_batch(self, transcripts):
+        results = []
+        for transcript in transcripts:
+            response, _ = self.call_layer.create_chat_completion(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": EXTRACTION_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+                response_format={"type": "json_object"},
+                temperature=0,
+            )
+            results.append(json.loads(response.choices[0].message.content or "{}"))
+        return results
+
+
+class CaptureExtractor:
+    """
+    Cola persistente de extracciones de captura al final de cada conversación.
+
+    Un hilo de fondo toma lotes de trabajos pendientes, los pasa al backend de
+    extracción y guarda un registro normalizado por conversación en capture_records.
+    """
+
+    def __init__(self, backend, load_conversation, on_record=None, db_path="whatsapp_conversations.db",
+                 batch_size=10, poll_interval=5.0, max_attempts=3):
+        """
+        Args:
+            backend: Backend de extracción (extract_batch(transcripts) -> lista de dicts)
+            load_conversation: Función wa_id -> (historial, user_data)
+            on_record: Callback opcional (wa_id, conversation_id, registro) al terminar
+            db_path: Base de datos SQLite donde viven la cola y los registros
+            batch_size: Trabajos procesados por lote
+            poll_interval: Segundos entre revisiones de la cola
+            max_attempts: Intentos antes de marcar un trabajo como fallido
+        """
+        self.backend = backend
+        self.load_conversation = load_conversation
+        self.on_record = on_record
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa las tablas de trabajos y registros de captura."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wa_id TEXT,
+                conversation_id TEXT UNIQUE,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            ''')
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS capture_records (
+                conversation_id TEXT PRIMARY KEY,
+                wa_id TEXT,
+                registered BOOLEAN,
+                store_name TEXT,
+                channel TEXT,
+                city TEXT,
+                client TEXT,
+                category TEXT,
+                brand_feedback TEXT,
+                latitude REAL,
+                longitude REAL,
+                photo_count INTEGER,
+                audio_count INTEGER,
+                backend TEXT,
+                extracted_at TEXT
+            )
+            ''')
+            c.execute("UPDATE extraction_jobs SET status = 'pending' WHERE status = 'running'")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la cola de extracción: {e}")
+
+    def enqueue(self, wa_id, conversation_id):
+        """Encola la extracción de una conversación terminada (una sola vez por conversación)."""
+        try:
+            now = datetime.now().isoformat()
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                "INSERT OR IGNORE INTO extraction_jobs (wa_id, conversation_id, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (wa_id, conversation_id, now, now)
+            )
+            conn.commit()
+            conn.close()
+            logger.info(f"Extracción de captura encolada para la conversación {conversation_id}")
+        except Exception as e:
+            logger.error(f"Error al encolar la extracción de captura: {e}")
+            return False
+        self.start()
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        """Inicia el hilo de fondo si no está corriendo."""
+        with self._worker_lock:
+            if self._worker and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name="capture-extraction", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                while self.process_batch():
+                    pass
+            except Exception as e:
+                logger.error(f"Error en el hilo de extracción de captura: {e}", exc_info=True)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _claim(self):
+        conn = sqlite3.connect(self.db_path, isolation_level="IMMEDIATE")
+        try:
+            c = conn.cursor()
+            c.execute(
+                "SELECT id, wa_id, conversation_id FROM extraction_jobs WHERE status = 'pending' ORDER BY id LIMIT ?",
+                (self.batch_size,)
+            )
+            jobs = c.fetchall()
+            c.executemany(
+                "UPDATE extraction_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(datetime.now().isoformat(), job[0]) for job in jobs]
+            )
+            conn.commit()
+            return jobs
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, error=None):
+        conn = sqlite3.connect(self.db_path)
+        if error is None:
+            conn.execute("UPDATE extraction_jobs SET status = 'done', error = NULL, updated_at = ? WHERE id = ?",
+                         (datetime.now().isoformat(), job_id))
+        else:
+            conn.execute(
+                "UPDATE extraction_jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, updated_at = ? WHERE id = ?",
+                (self.max_attempts, str(error), datetime.now().isoformat(), job_id)
+            )
+        conn.commit()
+        conn.close()
+
+    def _store_record(self, wa_id, conversation_id, record):
+        columns = ["conversation_id", "wa_id"] + list(record) + ["backend", "extracted_at"]
+        values = [conversation_id, wa_id] + list(record.values()) + [self.backend.name, datetime.now().isoformat()]
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            f"INSERT OR REPLACE INTO capture_records ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            values
+        )
+        conn.commit()
+        conn.close()
+
+    def process_batch(self):
+        """
+        Procesa un lote de trabajos pendientes.
+
+        Returns:
+            Número de trabajos procesados (0 si la cola estaba vacía)
+        """
+        jobs = self._claim()
+        if not jobs:
+            return 0
+
+        loaded = []
+        for job_id, wa_id, conversation_id in jobs:
+            history, user_data = self.load_conversation(wa_id)
+            loaded.append((job_id, wa_id, conversation_id, user_data, build_transcript(history)))
+
+        started = time.time()
+        try:
+            results = self.backend.extract_batch([item[4] for item in loaded])
+        except Exception as e:
+            logger.error(f"Error en la extracción de captura ({self.backend.name}): {e}")
+            for item in loaded:
+                self._finish(item[0], error=e)
+            return len(jobs)
+
+        for (job_id, wa_id, conversation_id, user_data, _), raw in zip(loaded, results):
+            try:
+                record = normalize_capture(raw or {}, user_data)
+                self._store_record(wa_id, conversation_id, record)
+                if self.on_record:
+                    self.on_record(wa_id, conversation_id, record)
+                self._finish(job_id)
+            except Exception as e:
+                logger.error(f"Error guardando la captura de {conversation_id}: {e}")
+                self._finish(job_id, error=e)
+
+        logger.info(f"Lote de {len(jobs)} extracción(es) procesado en {time.time() - started:.2f}s")
+        return len(jobs)
+
+    def get_record(self, conversation_id):
+        """Obtiene el registro de captura normalizado de una conversación (o None)."""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM capture_records WHERE conversation_id = ?", (conversation_id,))
+        row = c.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+
+def create_extraction_backend_from_env(call_layer):
+    """
+    Crea el backend de extracción según CAPTURE_EXTRACTION_BACKEND:
+    "openai" (por defecto), "stub" o "none" (sin extracción diferida).
+    """
+    backend = os.getenv("CAPTURE_EXTRACTION_BACKEND", "openai").lower()
+    if backend == "none":
+        return None
+    if backend == "stub" or call_layer is None:
+        return StubExtractionBackend()
+    return OpenAIExtractionBackend(call_layer, os.getenv("CAPTURE_EXTRACTION_MODEL", "gpt-4o-mini"))
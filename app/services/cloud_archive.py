@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class CloudArchiver:
+    """
+    Archivado incremental e idempotente de conversaciones en almacenamiento de objetos.
+
+    Cada medio se sube una sola vez, en cuanto llega, desde un pool acotado de hilos;
+    la tabla archived_objects recuerda lo ya subido para que los reintentos y los
+    mensajes posteriores no vuelvan a subirlo. El manifiesto (data.json) se escribe
+    una sola vez por conversación, cuando terminan las subidas pendientes.
+    """
+
+    def __init__(self, store, db_path="whatsapp_conversations.db", max_workers=4):
+        """
+        Args:
+            store: Almacenamiento de objetos (ver app/services/object_store.py)
+            db_path: Base de datos SQLite con el registro de objetos subidos
+            max_workers: Subidas simultáneas máximas
+        """
+        self.store = store
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cloud-archive")
+        # Los manifiestos esperan a las subidas de medios: van en su propio hilo para no bloquear el pool
+        self._manifest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cloud-archive-manifest")
+        self._inflight = {}
+        self._by_conversation = {}
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de objetos archivados si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS archived_objects (
+                object_path TEXT PRIMARY KEY,
+                wa_id TEXT,
+                conversation_id TEXT,
+                kind TEXT,
+                sha256 TEXT,
+                url TEXT,
+                size INTEGER,
+                uploaded_at TEXT
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_archived_objects_conversation "
+                      "ON archived_objects (conversation_id)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de objetos archivados: {e}")
+
+    def get_url(self, object_path):
+        """Retorna la URL de un objeto ya archivado o None"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT url FROM archived_objects WHERE object_path = ?", (object_path,))
+        row = c.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def object_path_for(self, sha256):
+        """Retorna la ruta del objeto archivado con ese sha256 (medios, no manifiestos) o None"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT object_path FROM archived_objects WHERE sha256 = ? AND kind != 'manifest' LIMIT 1",
+                  (sha256,))
+        row = c.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def conversation_urls(self, conversation_id):
+        """Retorna las URLs archivadas de una conversación: dict sha256 -> URL"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT sha256, url FROM archived_objects WHERE conversation_id = ? AND sha256 IS NOT NULL",
+                  (conversation_id,))
+        rows = c.fetchall()
+        conn.close()
+        return dict(rows)
+
+    def _record(self, wa_id, conversation_id, object_path, kind, sha256, url, size):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO archived_objects "
+            "(object_path, wa_id, conversation_id, kind, sha256, url, size, uploaded_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (object_path, wa_id, conversation_id, kind, sha256, url, size, datetime.now().isoformat())
+        )
+        conn.commit()
+        conn.close()
+
+    def _submit(self, conversation_id, object_path, task, executor=None):
+        """Encola una subida una sola vez por ruta de objeto (ya subida o en curso -> None)"""
+        with self._lock:
+            if object_path in self._inflight or self.get_url(object_path):
+                return None
+            future = (executor or self._executor).submit(task)
+            self._inflight[object_path] = future
+            self._by_conversation.setdefault(conversation_id, set()).add(future)
+
+        def cleanup(done):
+            with self._lock:
+                self._inflight.pop(object_path, None)
+                self._by_conversation.get(conversation_id, set()).discard(done)
+
+        future.add_done_callback(cleanup)
+        return future
+
+    def _upload(self, wa_id, conversation_id, object_path, kind, sha256, size, upload, source, content_type):
+        try:
+            if callable(source):
+                # Archivo que se prepara dentro del pool (p. ej. la versión normalizada de una foto)
+                source = source()
+                size = os.path.getsize(source)
+            url = upload(object_path, source, content_type)
+        except Exception as e:
+            logger.error(f"Error subiendo {object_path} a {self.store.name}: {e}")
+            raise
+        self._record(wa_id, conversation_id, object_path, kind, sha256, url, size)
+        logger.info(f"Objeto archivado: {object_path}")
+        return url
+
+    def archive_file(self, wa_id, conversation_id, object_path, local_path, content_type,
+                     kind="media", sha256=None, size=None):
+        """
+        Encola la subida de un archivo local; retorna el Future o None si ya estaba archivado.
+        local_path puede ser una función que retorna la ruta, evaluada en el pool.
+        """
+        return self._submit(conversation_id, object_path, lambda: self._upload(
+            wa_id, conversation_id, object_path, kind, sha256, size,
+            self.store.put_file, local_path, content_type
+        ))
+
+    def archive_bytes(self, wa_id, conversation_id, object_path, data, content_type,
+                      kind="media", sha256=None):
+        """Encola la subida de datos en memoria; retorna el Future o None si ya estaba archivado"""
+        return self._submit(conversation_id, object_path, lambda: self._upload(
+            wa_id, conversation_id, object_path, kind, sha256, len(data),
+            self.store.put_bytes, data, content_type
+        ))
+
+    def write_manifest(self, wa_id, conversation_id, object_path, build_manifest, timeout=300):
+        """
+        Escribe el manifiesto de la conversación una sola vez, en segundo plano y
+        después de que terminen sus subidas pendientes.
+
+        Args:
+            build_manifest: Función sin argumentos que retorna el contenido (str) del manifiesto
+            timeout: Espera máxima por las subidas pendientes
+
+        Returns:
+            Future con la URL del manifiesto, o None si ya estaba escrito o en curso
+        """
+        with self._lock:
+            pending = set(self._by_conversation.get(conversation_id, set()))
+
+        def task():
+            if pending:
+                wait(pending, timeout=timeout)
+            data = build_manifest()
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            return self._upload(wa_id, conversation_id, object_path, "manifest", None, len(data),
+                                self.store.put_bytes, data, "application/json")
+
+        return self._submit(conversation_id, object_path, task, executor=self._manifest_executor)
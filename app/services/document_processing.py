@@ -0,0 +1,306 @@
+import io
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Un documento de identidad se envía en dos fotos: frente y reverso
+MAX_PAGES_PER_DOCUMENT = 2
+
+
+def build_multipage_tiff(pages):
+    """
+    Une varias imágenes en un solo TIFF multipágina, para procesarlas en una sola
+    solicitud de Document AI.
+
+    Args:
+        pages: Lista de bytes de imágenes
+
+    Returns:
+        Bytes del TIFF
+    """
+    images = []
+    for content in pages:
+        img = Image.open(io.BytesIO(content))
+        images.append(ImageOps.exif_transpose(img).convert("RGB"))
+    output = io.BytesIO()
+    images[0].save(output, format="TIFF", save_all=True, append_images=images[1:], compression="jpeg", quality=90)
+    return output.getvalue()
+
+
+class StubDocumentProcessor:
+    """Procesador local sin red para pruebas: retorna un documento fijo con el número de páginas."""
+    name = "stub"
+
+    def process(self, content, mime_type):
+        pages = 1
+        if mime_type == "image/tiff":
+            with Image.open(io.BytesIO(content)) as img:
+                pages = getattr(img, "n_frames", 1)
+        return {
+            "success": True,
+            "text": f"DOCUMENTO DE PRUEBA ({pages} página(s))",
+            "entities": {},
+            "full_document": {"pages": [{"page_number": n + 1} for n in range(pages)], "entities": []}
+        }
+
+
+class DocAIDocumentProcessor:
+    """Procesador de Document AI; delega en una función (contenido, mime_type) -> resultado."""
+    name = "docai"
+
+    def __init__(self, process_fn):
+        self.process_fn = process_fn
+
+    def process(self, content, mime_type):
+        return self.process_fn(content, mime_type)
+
+
+class DocumentJobQueue:
+    """
+    Cola de extracción de documentos de identidad fuera del turno del webhook.
+
+    Las fotos que llegan seguidas (frente y reverso) se agrupan en un solo TIFF
+    multipágina y una sola solicitud. Los resultados se guardan en cache por el
+    sha256 de las páginas, de modo que reenviar las mismas fotos no vuelve a
+    procesarlas.
+    """
+
+    def __init__(self, processor, on_result, db_path="whatsapp_conversations.db", max_workers=2,
+                 group_window_seconds=20.0, prepare=None):
+        """
+        Args:
+            processor: Procesador de documentos (process(contenido, mime_type) -> dict de resultado)
+            on_result: Callback (wa_id, conversation_id, resultado, sha256s) al terminar
+            prepare: Función handle -> handle que prepara cada foto para el OCR (p. ej. la
+                normalización); corre en el hilo de trabajo, no en el turno del webhook
+            db_path: Base de datos SQLite con los trabajos y la cache de resultados
+            max_workers: Documentos procesados simultáneamente
+            group_window_seconds: Espera máxima por la segunda foto antes de procesar la primera sola
+        """
+        self.processor = processor
+        self.on_result = on_result
+        self.prepare = prepare
+        self.db_path = db_path
+        self.group_window_seconds = group_window_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="docai")
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa las tablas de trabajos y cache de documentos."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS document_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wa_id TEXT,
+                conversation_id TEXT,
+                cache_key TEXT,
+                pages INTEGER,
+                status TEXT DEFAULT 'pending',
+                cache_hit BOOLEAN DEFAULT 0,
+                error TEXT,
+                latency_ms REAL,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            ''')
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS docai_cache (
+                cache_key TEXT PRIMARY KEY,
+                sha256s TEXT,
+                result TEXT,
+                processor TEXT,
+                created_at TEXT
+            )
+            ''')
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS docai_pages (
+                sha256 TEXT PRIMARY KEY,
+                cache_key TEXT
+            )
+            ''')
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar las tablas de documentos: {e}")
+
+    @staticmethod
+    def cache_key(sha256s):
+        """Clave de cache de un grupo de páginas (independiente del orden de llegada)"""
+        return hashlib.sha256("+".join(sorted(sha256s)).encode("utf-8")).hexdigest()
+
+    def cached_result(self, sha256s):
+        """
+        Busca un resultado ya calculado para estas páginas: primero el grupo exacto y
+        luego, si todas las páginas ya se procesaron dentro de un mismo grupo, ese grupo.
+        """
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        try:
+            c.execute("SELECT result FROM docai_cache WHERE cache_key = ?", (self.cache_key(sha256s),))
+            row = c.fetchone()
+            if row:
+                return json.loads(row[0])
+            c.execute(f"SELECT DISTINCT cache_key FROM docai_pages WHERE sha256 IN ({','.join('?' * len(sha256s))})",
+                      list(sha256s))
+            keys = c.fetchall()
+            c.execute(f"SELECT COUNT(*) FROM docai_pages WHERE sha256 IN ({','.join('?' * len(sha256s))})",
+                      list(sha256s))
+            if len(keys) == 1 and c.fetchone()[0] == len(set(sha256s)):
+                c.execute("SELECT result FROM docai_cache WHERE cache_key = ?", (keys[0][0],))
+                row = c.fetchone()
+                return json.loads(row[0]) if row else None
+            return None
+        finally:
+            conn.close()
+
+    def _store_cache(self, sha256s, result):
+        key = self.cache_key(sha256s)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO docai_cache (cache_key, sha256s, result, processor, created_at) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(sorted(sha256s)), json.dumps(result, ensure_ascii=False), self.processor.name,
+             datetime.now().isoformat())
+        )
+        conn.executemany("INSERT OR REPLACE INTO docai_pages (sha256, cache_key) VALUES (?, ?)",
+                         [(sha256, key) for sha256 in sha256s])
+        conn.commit()
+        conn.close()
+
+    def extract(self, path, sha256, mime_type="application/pdf"):
+        """
+        Procesa un archivo completo (p. ej. un PDF recibido como documento) con la misma
+        cache por sha256. Es bloqueante: se llama desde un hilo de trabajo.
+
+        Returns:
+            Dict de resultado del procesador
+        """
+        result = self.cached_result([sha256])
+        if result is not None:
+            return result
+        with open(path, "rb") as f:
+            content = f.read()
+        logger.info(f"Procesando archivo {sha256[:12]} ({mime_type}, {len(content) / 1024:.1f}KB)")
+        result = self.processor.process(content, mime_type)
+        if result.get("success"):
+            self._store_cache([sha256], result)
+        return result
+
+    def submit(self, wa_id, conversation_id, handle):
+        """
+        Agrega una foto de documento al grupo abierto de la conversación. El grupo se
+        procesa al completar frente y reverso o al vencer la ventana de agrupación.
+
+        Args:
+            handle: Handle de la foto ingerida (path, sha256, mime); se lee y se prepara
+                en el hilo de trabajo
+
+        Returns:
+            True si la foto se encoló, False si ya estaba en el grupo abierto
+        """
+        sha256 = handle["sha256"]
+        with self._lock:
+            group = self._groups.get(conversation_id)
+            if group is None:
+                group = {"wa_id": wa_id, "pages": [], "timer": None}
+                self._groups[conversation_id] = group
+            if any(page["sha256"] == sha256 for page in group["pages"]):
+                return False
+            group["pages"].append({"sha256": sha256, "handle": handle})
+            if group["timer"]:
+                group["timer"].cancel()
+            if len(group["pages"]) >= MAX_PAGES_PER_DOCUMENT:
+                self._groups.pop(conversation_id)
+                self._executor.submit(self._process_group, conversation_id, group)
+            else:
+                group["timer"] = threading.Timer(self.group_window_seconds, self._flush, args=(conversation_id,))
+                group["timer"].daemon = True
+                group["timer"].start()
+        return True
+
+    def _page_content(self, page):
+        """Bytes y tipo MIME de una página, ya preparada para el OCR"""
+        handle = self.prepare(page["handle"]) if self.prepare else page["handle"]
+        with open(handle["path"], "rb") as f:
+            return f.read(), handle.get("mime") or "image/jpeg"
+
+    def _flush(self, conversation_id):
+        with self._lock:
+            group = self._groups.pop(conversation_id, None)
+        if group:
+            self._executor.submit(self._process_group, conversation_id, group)
+
+    def _process_group(self, conversation_id, group):
+        wa_id, pages = group["wa_id"], group["pages"]
+        sha256s = [page["sha256"] for page in pages]
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO document_jobs (wa_id, conversation_id, cache_key, pages, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'running', ?, ?)",
+            (wa_id, conversation_id, self.cache_key(sha256s), len(pages), now, now)
+        )
+        job_id = c.lastrowid
+        conn.commit()
+        conn.close()
+
+        started = time.time()
+        result = self.cached_result(sha256s)
+        cache_hit = result is not None
+        error = None
+        if cache_hit:
+            logger.info(f"Documento de {wa_id} servido desde la cache de Document AI")
+        else:
+            try:
+                contents = [self._page_content(page) for page in pages]
+                if len(contents) == 1:
+                    content, mime_type = contents[0]
+                else:
+                    content, mime_type = build_multipage_tiff([data for data, _ in contents]), "image/tiff"
+                logger.info(f"Procesando documento de {wa_id} ({len(pages)} página(s), {len(content) / 1024:.1f}KB)")
+                result = self.processor.process(content, mime_type)
+                if result.get("success"):
+                    self._store_cache(sha256s, result)
+                else:
+                    error = result.get("error")
+            except Exception as e:
+                logger.error(f"Error procesando documento de {wa_id}: {e}", exc_info=True)
+                result, error = {"success": False, "error": str(e)}, str(e)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE document_jobs SET status = ?, cache_hit = ?, error = ?, latency_ms = ?, updated_at = ? WHERE id = ?",
+            ("failed" if error else "done", cache_hit, error, round((time.time() - started) * 1000, 1),
+             datetime.now().isoformat(), job_id)
+        )
+        conn.commit()
+        conn.close()
+        try:
+            self.on_result(wa_id, conversation_id, result, sha256s)
+        except Exception as e:
+            logger.error(f"Error incorporando el documento de {wa_id}: {e}", exc_info=True)
+        return result
+
+
+def create_document_processor_from_env(process_fn):
+    """
+    Crea el procesador de documentos según DOCUMENT_PROCESSOR_BACKEND:
+    "docai" (por defecto) o "stub".
+    """
+    if os.getenv("DOCUMENT_PROCESSOR_BACKEND", "docai").lower() == "stub":
+        return StubDocumentProcessor()
+    return DocAIDocumentProcessor(process_fn)
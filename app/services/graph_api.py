@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_BASE_URL = "https://graph.facebook.com"
+DEFAULT_VERSION = "v17.0"
+
+
+class GraphAPIMetrics:
+    """Latencias y errores por endpoint de las llamadas a la Graph API (compartidas por los clientes)."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._latencies = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency_ms, error=False):
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(latency_ms)
+            counts = self._counts.setdefault(endpoint, {"calls": 0, "errors": 0})
+            counts["calls"] += 1
+            if error:
+                counts["errors"] += 1
+
+    def stats(self):
+        """
+        Returns:
+            Dict endpoint -> calls, errors, avg_ms, p95_ms y max_ms (de las últimas llamadas)
+        """
+        with self._lock:
+            result = {}
+            for endpoint, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                result[endpoint] = dict(
+                    self._counts[endpoint],
+                    avg_ms=round(sum(ordered) / len(ordered), 1),
+                    p95_ms=round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                    max_ms=round(ordered[-1], 1),
+                )
+            return result
+
+
+def _json_body(data):
+    """Acepta el payload como dict o como JSON ya serializado"""
+    return data if isinstance(data, (str, bytes)) else json.dumps(data)
+
+
+class GraphAPIClient:
+    """
+    Cliente síncrono de la Graph API de WhatsApp con un pool de conexiones keep-alive.
+
+    Todas las llamadas del bot, del dashboard y de los quickstarts pasan por una
+    misma sesión, de modo que cada mensaje reutiliza una conexión TLS abierta en
+    lugar de pagar un handshake nuevo con graph.facebook.com.
+    """
+
+    def __init__(self, access_token=None, phone_number_id=None, version=DEFAULT_VERSION, base_url=GRAPH_API_BASE_URL,
+                 pool_size=10, timeout=10.0, metrics=None):
+        """
+        Args:
+            access_token: Token de acceso por defecto (se puede reemplazar en cada llamada)
+            phone_number_id: ID del número de WhatsApp por defecto
+            version: Versión de la Graph API
+            base_url: URL base de la Graph API
+            pool_size: Conexiones keep-alive por host
+            timeout: Timeout en segundos de cada solicitud
+            metrics: GraphAPIMetrics compartidas (opcional)
+        """
+        self.access_token = access_token
+        self.phone_number_id = phone_number_id
+        self.version = version
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.metrics = metrics or GraphAPIMetrics()
+        self.session = requests.Session()
+        # Sin reintentos en el adaptador: los reintentos son decisión de quien llama
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _url(self, path, version=None):
+        return f"{self.base_url}/{version or self.version}/{path.lstrip('/')}"
+
+    def _headers(self, access_token=None, json_body=False):
+        token = access_token or self.access_token
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    def request(self, method, url, endpoint, **kwargs):
+        """
+        Ejecuta una solicitud con la sesión compartida y registra su latencia.
+
+        Args:
+            method: Método HTTP
+            url: URL completa
+            endpoint: Nombre del endpoint para las métricas ("messages", "media", ...)
+
+        Returns:
+            requests.Response (sin raise_for_status)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record(endpoint, (time.time() - started) * 1000, error=True)
+            raise
+        self.metrics.record(endpoint, (time.time() - started) * 1000, error=response.status_code >= 400)
+        return response
+
+    def send_message(self, data, phone_number_id=None, access_token=None, version=None):
+        """
+        Envía un mensaje (texto, imagen, plantilla, indicador de escritura...).
+
+        Args:
+            data: Payload del mensaje (dict o JSON serializado)
+
+        Returns:
+            requests.Response
+        """
+        url = self._url(f"{phone_number_id or self.phone_number_id}/messages", version)
+        return self.request("POST", url, "messages", data=_json_body(data),
+                            headers=self._headers(access_token, json_body=True))
+
+    def get_media(self, media_id, access_token=None, version=None):
+        """
+        Obtiene los metadatos de un medio (url temporal, mime_type, sha256, file_size).
+
+        Returns:
+            requests.Response
+        """
+        return self.request("GET", self._url(media_id, version), "media", headers=self._headers(access_token))
+
+    def get_phone_number(self, phone_number_id=None, access_token=None, version=None):
+        """Obtiene los datos del número de WhatsApp (sirve para probar la conexión)"""
+        url = self._url(phone_number_id or self.phone_number_id, version)
+        return self.request("GET", url, "phone_number", headers=self._headers(access_token))
+
+    def download(self, url, headers=None, **kwargs):
+        """GET de una URL de medios (lookaside) con la sesión compartida; acepta stream=True"""
+        return self.request("GET", url, "media_download", headers=headers, **kwargs)
+
+    def warm_up(self, connections=2):
+        """
+        Abre por adelantado conexiones TLS hacia la Graph API para que el primer
+        mensaje no pague el handshake. Los errores solo se registran.
+        """
+        def ping(_):
+            try:
+                self.session.head(self.base_url, timeout=self.timeout)
+                return True
+            except requests.RequestException as e:
+                logger.warning(f"No se pudo precalentar la conexión con la Graph API: {e}")
+                return False
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            opened = sum(executor.map(ping, range(connections)))
+        logger.info(f"Graph API: {opened} conexión(es) precalentada(s) en {(time.time() - started) * 1000:.0f}ms")
+        return opened
+
+    def stats(self):
+        """Métricas de latencia por endpoint"""
+        return self.metrics.stats()
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncGraphAPIClient:
+    """
+    Variante asíncrona del cliente (httpx, ya instalado con el SDK de OpenAI), con
+    pool keep-alive y HTTP/2 opcional (requiere el paquete h2).
+    """
+
+    def __init__(self, access_token=None, phone_number_id=None, version=DEFAULT_VERSION, base_url=GRAPH_API_BASE_URL,
+                 pool_size=10, timeout=10.0, http2=False, metrics=None):
+        import httpx
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Paquete h2 no instalado. El cliente de la Graph API usará HTTP/1.1.")
+                http2 = False
+        self.access_token = access_token
+        self.phone_number_id = phone_number_id
+        self.version = version
+        self.base_url = base_url.rstrip("/")
+        self.metrics = metrics or GraphAPIMetrics()
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout, connect=5.0),
+        )
+
+    def _url(self, path, version=None):
+        return f"{self.base_url}/{version or self.version}/{path.lstrip('/')}"
+
+    def _headers(self, access_token=None, json_body=False):
+        token = access_token or self.access_token
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    async def request(self, method, url, endpoint, **kwargs):
+        """Ejecuta una solicitud y registra su latencia; retorna httpx.Response"""
+        started = time.time()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except Exception:
+            self.metrics.record(endpoint, (time.time() - started) * 1000, error=True)
+            raise
+        self.metrics.record(endpoint, (time.time() - started) * 1000, error=response.status_code >= 400)
+        return response
+
+    async def send_message(self, data, phone_number_id=None, access_token=None, version=None):
+        url = self._url(f"{phone_number_id or self.phone_number_id}/messages", version)
+        return await self.request("POST", url, "messages", content=_json_body(data),
+                                  headers=self._headers(access_token, json_body=True))
+
+    async def get_media(self, media_id, access_token=None, version=None):
+        return await self.request("GET", self._url(media_id, version), "media", headers=self._headers(access_token))
+
+    async def warm_up(self):
+        """Abre por adelantado la conexión con la Graph API"""
+        try:
+            await self.client.head(self.base_url)
+        except Exception as e:
+            logger.warning(f"No se pudo precalentar la conexión con la Graph API: {e}")
+
+    def stats(self):
+        return self.metrics.stats()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def create_graph_api_client_from_env():
+    """Crea el cliente síncrono de la Graph API a partir de las variables de entorno"""
+    return GraphAPIClient(
+        access_token=os.getenv("ACCESS_TOKEN") or None,
+        phone_number_id=os.getenv("PHONE_NUMBER_ID") or None,
+        version=os.getenv("VERSION", DEFAULT_VERSION),
+        pool_size=int(os.getenv("GRAPH_API_POOL_SIZE", "10")),
+        timeout=float(os.getenv("GRAPH_API_TIMEOUT_SECONDS", "10")),
+    )
+
+
+def create_async_graph_api_client_from_env():
+    """Crea el cliente asíncrono de la Graph API (GRAPH_API_HTTP2=true activa HTTP/2)"""
+    return AsyncGraphAPIClient(
+        access_token=os.getenv("ACCESS_TOKEN") or None,
+        phone_number_id=os.getenv("PHONE_NUMBER_ID") or None,
+        version=os.getenv("VERSION", DEFAULT_VERSION),
+        pool_size=int(os.getenv("GRAPH_API_POOL_SIZE", "10")),
+        timeout=float(os.getenv("GRAPH_API_TIMEOUT_SECONDS", "10")),
+        http2=os.getenv("GRAPH_API_HTTP2", "false").lower() in ("1", "true", "yes"),
+    )
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_graph_api_client():
+    """
+    Cliente compartido del proceso (bot, ingesta de medios y dashboard usan el mismo pool).
+    Se crea la primera vez que se pide, a partir de las variables de entorno.
+    """
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = create_graph_api_client_from_env()
+    return _shared_client
@@ -0,0 +1,95 @@
+import os
+import re
+import logging
+from flask import Blueprint, abort, redirect, request, send_file, send_from_directory, url_for
+
+bp = Blueprint('media', __name__)
+logger = logging.getLogger(__name__)
+
+# Las URLs /media/<sha256> nunca cambian de contenido: los navegadores y la CDN las guardan un año
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Rutas antiguas por nombre de archivo (no direccionadas por contenido)
+LEGACY_MAX_AGE = 3600
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _media_dir():
+    return os.path.abspath(os.getenv("MEDIA_STORAGE_DIR", "whatsapp_images"))
+
+
+def send_media_file(path, mimetype=None, etag=None, immutable=True):
+    """
+    Envía un archivo de medios con soporte de caché y rangos.
+
+    send_file con conditional=True responde 304 a If-None-Match / If-Modified-Since
+    y 206 a las peticiones Range (necesarias para adelantar los audios). El cuerpo se
+    entrega con el file_wrapper del servidor WSGI (sendfile, sin copiar a memoria) o
+    con X-Sendfile si USE_X_SENDFILE está activo detrás de un proxy.
+
+    Args:
+        path: Ruta absoluta del archivo
+        mimetype: Tipo MIME (opcional; si no, se deduce de la extensión)
+        etag: ETag fuerte (el sha256 del contenido); si no, el que calcula Werkzeug
+        immutable: Si la URL es direccionada por contenido (Cache-Control immutable)
+    """
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=etag if etag else True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else LEGACY_MAX_AGE,
+    )
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+@bp.route('/media/<sha256>')
+def media_by_hash(sha256):
+    """
+    Sirve un medio por su sha256. ?variant=thumb|preview sirve el derivado reducido;
+    si todavía no existe (se genera en segundo plano) se redirige al original sin
+    caché, para no fijar la foto completa bajo la URL del derivado.
+    Los medios desalojados de la cache local se recuperan antes de enviarse; si lo
+    recuperado es otra versión del archivo, no se marca como inmutable.
+    """
+    if not SHA256_PATTERN.match(sha256):
+        abort(404)
+    from app.utils.whatsapp_utils import derivative_generator, media_ingestor
+
+    variant = request.args.get('variant')
+    if variant:
+        derivative = (derivative_generator.get(sha256).get(variant) if derivative_generator else None)
+        if derivative:
+            mimetype = f"image/{derivative['format'].lower()}"
+            return send_media_file(os.path.abspath(derivative["path"]), mimetype, etag=f"{sha256}-{variant}")
+        response = redirect(url_for("media.media_by_hash", sha256=sha256))
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    handle = media_ingestor.get_by_sha256(sha256)
+    if not handle:
+        abort(404)
+    if handle.get("variant") == "restored":
+        # Versión recuperada del archivo (no son los bytes del sha256): ETag de Werkzeug y
+        # caché corta, para que el original se sirva en cuanto vuelva a estar en disco
+        return send_media_file(os.path.abspath(handle["path"]), handle.get("mime"), immutable=False)
+    return send_media_file(os.path.abspath(handle["path"]), handle.get("mime"), etag=sha256)
+
+
+@bp.route('/media/files/<path:filename>')
+@bp.route('/static/whatsapp_images/<path:filename>')
+def media_files(filename):
+    """
+    Rutas anteriores por nombre de archivo. Los nombres <sha256>.<ext> se sirven como
+    /media/<sha256>; el resto (fotos guardadas antes de la ingesta por hash) desde la
+    raíz de medios, con caché corta.
+    """
+    sha256 = os.path.splitext(os.path.basename(filename))[0]
+    if SHA256_PATTERN.match(sha256):
+        return media_by_hash(sha256)
+    response = send_from_directory(_media_dir(), filename, conditional=True, max_age=LEGACY_MAX_AGE)
+    response.cache_control.public = True
+    return response
@@ -0,0 +1,215 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectStore:
+    """
+    Interfaz de almacenamiento de objetos usada por el archivado de conversaciones.
+
+    Los backends implementan put_bytes, put_file, exists, download_file, url_for y uri_for.
+    La concurrencia de las subidas la maneja quien los usa (ver CloudArchiver).
+    """
+    name = "base"
+
+    def put_bytes(self, key, data, content_type="application/octet-stream"):
+        """Guarda datos en memoria bajo key y retorna su URL"""
+        raise NotImplementedError
+
+    def put_file(self, key, local_path, content_type="application/octet-stream"):
+        """Guarda un archivo local bajo key (en streaming) y retorna su URL"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        """Indica si ya existe un objeto con esa key"""
+        raise NotImplementedError
+
+    def download_file(self, key, local_path):
+        """Descarga el objeto key a un archivo local"""
+        raise NotImplementedError
+
+    def url_for(self, key):
+        """URL con la que se accede al objeto (la misma que retornan los put)"""
+        raise NotImplementedError
+
+    def uri_for(self, key):
+        """URI canónica del objeto o prefijo (gs://..., file://...)"""
+        raise NotImplementedError
+
+
+class GCSObjectStore(ObjectStore):
+    """
+    Backend de Google Cloud Storage. El cliente se crea al primer uso, no al importar.
+
+    No se hacen llamadas de ACL por objeto (el bucket usa acceso uniforme), así que las
+    URLs https://storage.googleapis.com/... que retornan los put solo abren si el bucket
+    da lectura pública (allUsers con roles/storage.objectViewer). Con un bucket privado
+    usa public_urls=False para guardar URIs gs:// en su lugar.
+    """
+    name = "gcs"
+
+    def __init__(self, bucket_name, project=None, credentials_path=None, public_urls=True):
+        """
+        Args:
+            bucket_name: Nombre del bucket
+            project: Proyecto de GCP (opcional)
+            credentials_path: Archivo de cuenta de servicio (opcional; si no, credenciales por defecto)
+            public_urls: Si es True, url_for retorna la URL pública https; si no, la URI gs://
+        """
+        self.bucket_name = bucket_name
+        self.project = project
+        self.credentials_path = credentials_path
+        self.public_urls = public_urls
+        self._bucket = None
+        self._bucket_lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        with self._bucket_lock:
+            if self._bucket is None:
+                from google.cloud import storage
+                if self.credentials_path:
+                    from google.oauth2 import service_account
+                    credentials = service_account.Credentials.from_service_account_file(self.credentials_path)
+                    client = storage.Client(project=self.project, credentials=credentials)
+                else:
+                    client = storage.Client(project=self.project)
+                self._bucket = client.bucket(self.bucket_name)
+                logger.info(f"Cliente Cloud Storage inicializado correctamente para bucket {self.bucket_name}")
+                if self.public_urls:
+                    self._check_public_access(self._bucket)
+            return self._bucket
+
+    def _check_public_access(self, bucket):
+        """Advierte si el bucket no da lectura pública, porque las URLs https no abrirían"""
+        try:
+            policy = bucket.get_iam_policy(requested_policy_version=3)
+        except Exception as e:
+            logger.warning(f"No se pudo verificar el acceso público del bucket {self.bucket_name}: {e}")
+            return
+        public = any(
+            "allUsers" in binding.get("members", ())
+            and binding.get("role") in ("roles/storage.objectViewer", "roles/storage.legacyObjectReader")
+            for binding in policy.bindings
+        )
+        if not public:
+            logger.warning(f"El bucket {self.bucket_name} no es público: las URLs archivadas no se podrán "
+                           f"abrir. Dale lectura a allUsers o usa GCS_PUBLIC_URLS=false para guardar URIs gs://")
+
+    def put_bytes(self, key, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        # El acceso se controla a nivel de bucket: no se hacen llamadas de ACL por objeto
+        self.bucket.blob(key).upload_from_string(data, content_type=content_type)
+        logger.info(f"Archivo {key} subido exitosamente a GCS")
+        return self.url_for(key)
+
+    def put_file(self, key, local_path, content_type="application/octet-stream"):
+        self.bucket.blob(key).upload_from_filename(local_path, content_type=content_type)
+        logger.info(f"Archivo {key} subido exitosamente a GCS")
+        return self.url_for(key)
+
+    def exists(self, key):
+        return self.bucket.blob(key).exists()
+
+    def download_file(self, key, local_path):
+        self.bucket.blob(key).download_to_filename(local_path)
+
+    def url_for(self, key):
+        if not self.public_urls:
+            return self.uri_for(key)
+        return f"https://storage.googleapis.com/{self.bucket_name}/{quote(key)}"
+
+    def uri_for(self, key):
+        return f"gs://{self.bucket_name}/{key}"
+
+
+class LocalObjectStore(ObjectStore):
+    """
+    Backend en disco local, para desarrollo, pruebas y mediciones sin red o
+    despliegues on-prem. Las escrituras son atómicas (archivo temporal + rename).
+    """
+    name = "local"
+
+    def __init__(self, root_dir, public_base_url=None):
+        """
+        Args:
+            root_dir: Directorio raíz donde se guardan los objetos
+            public_base_url: URL base con la que se sirven los objetos (opcional; si no, file://)
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.public_base_url = public_base_url.rstrip("/") if public_base_url else None
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root_dir, key))
+        if not path.startswith(self.root_dir + os.sep):
+            raise ValueError(f"Key fuera del directorio del almacenamiento: {key}")
+        return path
+
+    def _write(self, key, writer):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info(f"Archivo {key} guardado en el almacenamiento local")
+        return self.url_for(key)
+
+    def put_bytes(self, key, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self._write(key, lambda f: f.write(data))
+
+    def put_file(self, key, local_path, content_type="application/octet-stream"):
+        def copy(f):
+            with open(local_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+        return self._write(key, copy)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def download_file(self, key, local_path):
+        shutil.copyfile(self._path(key), local_path)
+
+    def url_for(self, key):
+        if self.public_base_url:
+            return f"{self.public_base_url}/{quote(key)}"
+        return self.uri_for(key)
+
+    def uri_for(self, key):
+        return "file://" + quote(os.path.join(self.root_dir, key))
+
+
+def create_object_store_from_env():
+    """
+    Crea el almacenamiento de objetos según OBJECT_STORE_BACKEND: "gcs" (por defecto;
+    GCS_PUBLIC_URLS=false guarda URIs gs:// si el bucket no es público) o "local"
+    (OBJECT_STORE_LOCAL_DIR, OBJECT_STORE_PUBLIC_BASE_URL).
+    """
+    backend = os.getenv("OBJECT_STORE_BACKEND", "gcs").lower()
+    if backend == "local":
+        return LocalObjectStore(
+            root_dir=os.getenv("OBJECT_STORE_LOCAL_DIR", "object_store"),
+            public_base_url=os.getenv("OBJECT_STORE_PUBLIC_BASE_URL"),
+        )
+    if backend != "gcs":
+        raise ValueError(f"Backend de almacenamiento no soportado: {backend}")
+    return GCSObjectStore(
+        bucket_name=os.getenv("GCP_BUCKET_NAME", "kapta-bucket"),
+        project=os.getenv("GCP_PROJECT_ID") or None,
+        credentials_path=os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or None,
+        public_urls=os.getenv("GCS_PUBLIC_URLS", "true").lower() in ("1", "true", "yes"),
+    )
@@ -0,0 +1,241 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+import openai
+from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+# Códigos HTTP que justifican reintentar la llamada
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class OpenAICallTimeout(Exception):
+    """La llamada a OpenAI superó su plazo máximo."""
+
+
+def is_retryable_error(error):
+    """Determina si un error de OpenAI es transitorio (429, 5xx, timeouts o conexión)"""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, OpenAICallTimeout)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def summarize_attempts(attempts):
+    """
+    Cuenta los reintentos y las solicitudes de cobertura de una llamada.
+
+    Un reintento es cada intento numerado después del primero; las coberturas son
+    solicitudes duplicadas dentro de un mismo intento y no cuentan como reintentos.
+
+    Returns:
+        Tupla (reintentos, coberturas)
+    """
+    retries = max((a["attempt"] for a in attempts), default=1) - 1
+    hedges = sum(1 for a in attempts if a.get("hedge"))
+    return retries, hedges
+
+
+class OpenAICallLayer:
+    """
+    Capa de llamadas a OpenAI con plazo máximo por llamada, reintentos con backoff
+    exponencial y jitter ante 429/5xx, pool de conexiones acotado, límite de
+    concurrencia y solicitudes de cobertura (hedging) opcionales.
+
+    Con hedging activo, si la primera solicitud no ha respondido cuando se supera el
+    p95 de latencia observado, se lanza una segunda y se usa la que llegue primero.
+    """
+
+    def __init__(self, api_key, deadline_seconds=30.0, attempt_timeout_seconds=20.0, max_retries=3,
+                 backoff_base_seconds=0.5, backoff_max_seconds=8.0, max_connections=20,
+                 max_concurrency=10, hedge=False, hedge_min_samples=20, latency_window=200):
+        """
+        Inicializa la capa de llamadas.
+
+        Args:
+            api_key: API key de OpenAI
+            deadline_seconds: Plazo total de una llamada, incluyendo reintentos
+            attempt_timeout_seconds: Timeout de cada intento individual
+            max_retries: Número máximo de reintentos ante errores transitorios
+            backoff_base_seconds: Base del backoff exponencial
+            backoff_max_seconds: Espera máxima entre reintentos
+            max_connections: Tamaño del pool de conexiones HTTP
+            max_concurrency: Solicitudes simultáneas máximas hacia OpenAI
+            hedge: Activa las solicitudes de cobertura
+            hedge_min_samples: Muestras de latencia necesarias antes de empezar a cubrir
+            latency_window: Número de latencias recientes usadas para calcular el p95
+        """
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout_seconds = attempt_timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+
+        self._http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(attempt_timeout_seconds, connect=5.0),
+        )
+        # Los reintentos los gestiona esta capa, no el SDK
+        self.client = OpenAI(api_key=api_key, max_retries=0, http_client=self._http_client)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency * 2, thread_name_prefix="openai-call")
+        self._latencies = deque(maxlen=latency_window)
+        self._latencies_lock = threading.Lock()
+
+    def p95_latency(self):
+        """Retorna el p95 de latencia (segundos) de las llamadas exitosas recientes o None"""
+        with self._latencies_lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _backoff(self, retry, error):
+        """Calcula la espera antes del siguiente reintento (respeta Retry-After si viene)"""
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max_seconds)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * (2 ** retry)))
+
+    def _run(self, method, kwargs, timeout):
+        """Ejecuta una solicitud respetando el límite de concurrencia"""
+        if not self._semaphore.acquire(timeout=timeout):
+            raise OpenAICallTimeout("No hay capacidad disponible para llamar a OpenAI")
+        try:
+            started = time.time()
+            return method(timeout=timeout, **kwargs), time.time() - started
+        finally:
+            self._semaphore.release()
+
+    def _attempt(self, method, kwargs, attempt_number, remaining, attempts, allow_hedge=True):
+        """
+        Ejecuta un intento (con posible solicitud de cobertura) y registra sus tiempos.
+
+        Returns:
+            La respuesta de la primera solicitud exitosa
+        """
+        timeout = min(self.attempt_timeout_seconds, remaining)
+        started = time.time()
+        futures = {self._executor.submit(self._run, method, kwargs, timeout): False}
+
+        hedge_after = self.p95_latency() if self.hedge and allow_hedge else None
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                logger.info(f"Solicitud a OpenAI supera el p95 ({hedge_after:.2f}s), lanzando cobertura")
+                futures[self._executor.submit(self._run, method, kwargs, timeout - hedge_after)] = True
+
+        last_error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, timeout - (time.time() - started)),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                record = {"attempt": attempt_number, "hedge": futures[future]}
+                try:
+                    response, elapsed = future.result()
+                except Exception as e:
+                    last_error = e
+                    record.update(outcome="error", error=str(e),
+                                  latency_ms=round((time.time() - started) * 1000, 1))
+                    attempts.append(record)
+                    continue
+                record.update(outcome="ok", latency_ms=round(elapsed * 1000, 1))
+                attempts.append(record)
+                # Solo las llamadas completas alimentan el p95 (un stream mide solo su arranque)
+                if allow_hedge:
+                    with self._latencies_lock:
+                        self._latencies.append(elapsed)
+                for other in pending:
+                    attempts.append({"attempt": attempt_number, "hedge": futures[other],
+                                     "outcome": "abandoned",
+                                     "latency_ms": round((time.time() - started) * 1000, 1)})
+                return response
+
+        for future in pending:
+            attempts.append({"attempt": attempt_number, "hedge": futures[future], "outcome": "timeout",
+                             "latency_ms": round((time.time() - started) * 1000, 1)})
+        raise last_error or OpenAICallTimeout(f"La solicitud a OpenAI superó {timeout:.1f}s")
+
+    def call(self, method, allow_hedge=True, **kwargs):
+        """
+        Ejecuta un método del SDK de OpenAI con plazo, reintentos y cobertura.
+
+        Args:
+            method: Método del cliente a invocar (p. ej. client.chat.completions.create)
+            allow_hedge: Permite solicitudes de cobertura (se desactiva para streams)
+            **kwargs: Argumentos del método
+
+        Returns:
+            Tupla (respuesta, intentos) donde intentos es una lista de dicts con
+            attempt, hedge, outcome, latency_ms y error (si lo hubo)
+        """
+        attempts = []
+        started = time.time()
+        retry = 0
+        while True:
+            remaining = self.deadline_seconds - (time.time() - started)
+            if remaining <= 0:
+                raise OpenAICallTimeout(f"Se agotó el plazo de {self.deadline_seconds}s para llamar a OpenAI")
+            try:
+                return self._attempt(method, kwargs, retry + 1, remaining, attempts, allow_hedge), attempts
+            except Exception as e:
+                if not is_retryable_error(e) or retry >= self.max_retries:
+                    logger.error(f"Llamada a OpenAI fallida tras {retry + 1} intento(s): {e}")
+                    raise
+                delay = self._backoff(retry, e)
+                if time.time() - started + delay >= self.deadline_seconds:
+                    raise
+                logger.warning(f"Error transitorio de OpenAI ({e}), reintentando en {delay:.2f}s")
+                time.sleep(delay)
+                retry += 1
+
+    def create_chat_completion(self, **kwargs):
+        """Atajo para client.chat.completions.create a través de la capa de llamadas"""
+        return self.call(self.client.chat.completions.create, **kwargs)
+
+    def stream_chat_completion(self, **kwargs):
+        """
+        Abre una completion en streaming. Los reintentos y el plazo aplican hasta que
+        el stream queda establecido; cada lectura posterior está acotada por el timeout
+        del pool HTTP. No se usan solicitudes de cobertura.
+
+        Returns:
+            Tupla (stream de chunks, intentos); el último chunk trae el uso de tokens
+        """
+        return self.call(
+            self.client.chat.completions.create,
+            allow_hedge=False,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+
+
+def create_openai_call_layer_from_env(api_key):
+    """Crea la capa de llamadas a OpenAI a partir de las variables de entorno"""
+    return OpenAICallLayer(
+        api_key=api_key,
+        deadline_seconds=float(os.getenv("OPENAI_DEADLINE_SECONDS", "30")),
+        attempt_timeout_seconds=float(os.getenv("OPENAI_ATTEMPT_TIMEOUT_SECONDS", "20")),
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "3")),
+        max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "20")),
+        max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "10")),
+        hedge=os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes"),
+    )
@@ -1,20 +1,35 @@
 import shelve
 import logging
-import requests
 import json
 import os
 import time
-import sys
 import re
 import random
 import uuid
+import mimetypes
+import threading
 from datetime import datetime
 from google.cloud import documentai_v1 as documentai
-from google.cloud import storage
-from openai import OpenAI
 from flask import current_app
 from dotenv import load_dotenv
+from app.services.openai_client import create_openai_call_layer_from_env, is_retryable_error, summarize_attempts
 from app.utils.message_handler import MessageHandler
+from app.utils.flow_state import get_flow_step, update_flow_step
+from app.utils.response_cache import cache_state, create_response_cache_from_env
+from app.utils.model_router import FAST_TIER, LARGE_TIER, create_model_router_from_env
+from app.utils.circuit_breaker import OPEN, create_circuit_breaker_from_env
+from app.utils.deferred_turns import DeferredTurnQueue
+from app.utils.llm_metrics import LLMMetrics
+from app.utils.paragraph_streamer import ParagraphStreamer
+from app.utils.media_store import extension_for_mime
+from app.utils.image_dedup import create_image_dedup_index_from_env
+from app.utils.image_quality import create_photo_quality_gate_from_env
+from app.services.capture_extraction import CaptureExtractor, create_extraction_backend_from_env
+from app.services.cloud_archive import CloudArchiver
+from app.services.audio_transcription import AudioTranscriber, create_transcription_backend_from_env
+from app.services.document_processing import DocumentJobQueue, create_document_processor_from_env
+from app.services.object_store import create_object_store_from_env
+from app.services.prompts import PROMPT_SLICING_ENABLED, get_system_prompt, prompt_token_report
 
 # Cargar variables de entorno
 load_dotenv()
@@ -24,6 +39,27 @@ logging.basicConfig(level=logging.INFO)
 # Inicializar handler de mensajes
 message_handler = MessageHandler()
 
+# Cache de respuestas para turnos repetidos (None si está deshabilitado)
+response_cache = create_response_cache_from_env()
+
+# Router de modelos: turnos simples al modelo rápido, el resto al grande
+model_router = create_model_router_from_env()
+
+# Circuit breaker alrededor del modelo y cola de turnos diferidos durante caídas
+llm_breaker = create_circuit_breaker_from_env("openai", "OPENAI_CIRCUIT")
+deferred_turns = DeferredTurnQueue()
+
+# Métricas de consumo del modelo y presupuesto opcional de tokens por conversación (0 = sin límite)
+llm_metrics = LLMMetrics()
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("LLM_CONVERSATION_TOKEN_BUDGET", "0"))
+BUDGET_HISTORY_MESSAGES = int(os.getenv("LLM_BUDGET_HISTORY_MESSAGES", "10"))
+
+# Índice de fotos por conversación para detectar reenvíos exactos o casi idénticos
+image_dedup = create_image_dedup_index_from_env()
+
+# Revisión local de enfoque, exposición y resolución de cada foto (None si está deshabilitada)
+photo_quality_gate = create_photo_quality_gate_from_env()
+
 # ------------------------------------------------------------------------
 # CONFIGURACIÓN INICIAL
 # ------------------------------------------------------------------------
@@ -33,25 +69,20 @@ GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "")
 GCP_LOCATION = os.getenv("GCP_LOCATION", "us")  # Default: us
 DOCAI_PROCESSOR_ID = os.getenv("GCP_DOCAI_PROCESSOR_ID", "")
 
-creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "")
-
-client = storage.Client.from_service_account_json(creds_path)
 GCS_BUCKET_NAME = os.getenv("GCP_BUCKET_NAME", "kapta-bucket")
 
-print(creds_path)
-
 if not all([OPENAI_API_KEY, GCP_PROJECT_ID, DOCAI_PROCESSOR_ID, GCS_BUCKET_NAME]):
     logger.error("ERROR CRÍTICO: Faltan variables de entorno esenciales")
 
 # Inicializar clientes
 try:
-    # OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # OpenAI, a través de la capa con plazos, reintentos y pool de conexiones
+    openai_calls = create_openai_call_layer_from_env(OPENAI_API_KEY)
+    client = openai_calls.client
     # Don't call models.list() here - it's causing problems in your initialization
     logger.info(f"Cliente OpenAI inicializado correctamente")
     
     # Set up explicit credentials for Google Cloud
-    import os
     from google.oauth2 import service_account
     
     credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
@@ -65,44 +96,222 @@ try:
     docai_client = documentai.DocumentProcessorServiceClient(credentials=credentials)
     logger.info(f"Cliente Document AI inicializado correctamente")
     
-    # Google Cloud Storage with explicit project and credentials
-    storage_client = storage.Client(
-        project=GCP_PROJECT_ID,
-        credentials=credentials
-    )
-    bucket = storage_client.bucket(GCS_BUCKET_NAME)
-    logger.info(f"Cliente Cloud Storage inicializado correctamente para bucket {GCS_BUCKET_NAME}")
-    
 except Exception as e:
     logger.error(f"ERROR inicializando clientes: {e}", exc_info=True)
     # Set clients to None so you can check for this later
     docai_client = None
-    storage_client = None
-    bucket = None
+
+# Transcripción de notas de voz en un pool aparte (None = sin transcripción)
+_transcription_backend = create_transcription_backend_from_env(globals().get("openai_calls"))
+audio_transcriber = AudioTranscriber(
+    _transcription_backend,
+    max_workers=int(os.getenv("AUDIO_TRANSCRIPTION_WORKERS", "2")),
+    work_dir=os.getenv("AUDIO_NORMALIZED_DIR",
+                       os.path.join(os.getenv("MEDIA_STORAGE_DIR", "whatsapp_images"), "normalized_audio")),
+    on_transcript=lambda wa_id, conversation_id, text: message_handler.add_message(
+        phone_number=wa_id, message=f"[TRANSCRIPCIÓN] {text}", is_bot=False
+    ),
+    on_file=lambda path, sha256, kind: register_media_file(path, sha256, kind),
+) if _transcription_backend else None
+
+# Extracción diferida de la captura estructurada al terminar la conversación (None = extracción en vivo)
+_extraction_backend = create_extraction_backend_from_env(globals().get("openai_calls"))
+capture_extractor = CaptureExtractor(
+    _extraction_backend,
+    load_conversation=lambda wa_id: load_conversation_for_extraction(wa_id),
+    on_record=lambda wa_id, conversation_id, record: store_capture_record(wa_id, conversation_id, record),
+    batch_size=int(os.getenv("CAPTURE_EXTRACTION_BATCH_SIZE", "10")),
+) if _extraction_backend else None
+
+# Extracción de documentos de identidad en segundo plano, con cache por sha256 de las fotos
+document_jobs = DocumentJobQueue(
+    create_document_processor_from_env(lambda content, mime_type: process_document_with_docai(content, mime_type)),
+    on_result=lambda wa_id, conversation_id, result, sha256s: store_document_result(
+        wa_id, conversation_id, result, sha256s
+    ),
+    max_workers=int(os.getenv("DOCUMENT_PROCESSING_WORKERS", "2")),
+    group_window_seconds=float(os.getenv("DOCUMENT_GROUP_WINDOW_SECONDS", "20")),
+    prepare=lambda media: normalized_media(media, "ocr"),
+)
     
 # ------------------------------------------------------------------------
 # GESTIÓN DE CONVERSACIONES
 # ------------------------------------------------------------------------
+# Los shelves no admiten aperturas concurrentes (con dbm.dumb el índice se corrompe):
+# cada apertura pasa por _shelf_lock. Además, toda lectura-modificación-escritura de los
+# datos de un usuario (el turno del webhook y los callbacks de los hilos de fondo) se
+# hace con su lock, para que ninguna escritura pise a otra.
+_shelf_lock = threading.RLock()
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+
+def user_lock(wa_id):
+    """Lock (reentrante) de los datos e historial de un usuario"""
+    with _user_locks_guard:
+        if wa_id not in _user_locks:
+            _user_locks[wa_id] = threading.RLock()
+        return _user_locks[wa_id]
+
 def get_conversation_history(wa_id):
     """Obtiene el historial de conversación para un usuario de WhatsApp"""
-    with shelve.open("conversation_history") as history_shelf:
+    with _shelf_lock, shelve.open("conversation_history") as history_shelf:
         return history_shelf.get(wa_id, [])
 
 def store_conversation_history(wa_id, history):
     """Almacena el historial de conversación para un usuario de WhatsApp"""
-    with shelve.open("conversation_history", writeback=True) as history_shelf:
+    with _shelf_lock, shelve.open("conversation_history", writeback=True) as history_shelf:
         history_shelf[wa_id] = history
 
 def get_user_data(wa_id):
     """Obtiene los datos del usuario"""
-    with shelve.open("user_data") as data_shelf:
+    with _shelf_lock, shelve.open("user_data") as data_shelf:
         return data_shelf.get(wa_id, {})
 
 def store_user_data(wa_id, data):
     """Almacena los datos del usuario"""
-    with shelve.open("user_data", writeback=True) as data_shelf:
+    with _shelf_lock, shelve.open("user_data", writeback=True) as data_shelf:
         data_shelf[wa_id] = data
 
+def merge_audio_transcripts(wa_id, user_data, conversation_history):
+    """
+    Incorpora al historial y a user_data las transcripciones de notas de voz que
+    terminaron desde el último turno.
+    
+    Returns:
+        True si se incorporó alguna transcripción
+    """
+    if not audio_transcriber:
+        return False
+    transcripts = audio_transcriber.take_unmerged(wa_id)
+    for row in transcripts:
+        conversation_history.append({
+            "role": "user",
+            "content": f"[🎤 Transcripción del audio: {row['transcript']}]"
+        })
+        for audio in user_data.get("audio_messages", []):
+            if audio.get("sha256") == row["sha256"]:
+                audio["transcript"] = row["transcript"]
+                audio["processed"] = True
+    return bool(transcripts)
+
+def load_conversation_for_extraction(wa_id):
+    """
+    Carga el historial y los datos del usuario para la extracción de captura, con las
+    transcripciones de audio ya terminadas (espera las que sigan en curso).
+    """
+    conversation_history = get_conversation_history(wa_id)
+    user_data = get_user_data(wa_id)
+    if audio_transcriber and user_data.get("conversation_id"):
+        audio_transcriber.wait(user_data["conversation_id"])
+        merged = {audio.get("sha256") for audio in user_data.get("audio_messages", []) if audio.get("transcript")}
+        for row in audio_transcriber.transcripts_for(user_data["conversation_id"]):
+            if row["sha256"] not in merged:
+                conversation_history.append({
+                    "role": "user",
+                    "content": f"[🎤 Transcripción del audio: {row['transcript']}]"
+                })
+    return conversation_history, user_data
+
+def store_capture_record(wa_id, conversation_id, record):
+    """
+    Agrega a los datos del usuario el registro de captura extraído al final de la
+    conversación. Corre en el hilo de extracción, con el lock del usuario.
+    """
+    with user_lock(wa_id):
+        user_data = get_user_data(wa_id)
+        if user_data.get("conversation_id") != conversation_id:
+            return
+        # Se reemplaza solo una extracción anterior; las demás capturas se conservan
+        captures = [c for c in user_data.get("captures", []) if c.get("source") != "extraction"]
+        captures.append(dict(record, timestamp=time.time(), source="extraction"))
+        user_data["captures"] = captures
+        for key, value in record.items():
+            if value is not None and key not in user_data:
+                user_data[key] = value
+        store_user_data(wa_id, user_data)
+
+def store_document_result(wa_id, conversation_id, result, sha256s):
+    """
+    Incorpora a los datos del usuario la extracción de un documento terminada en segundo
+    plano. Corre en un hilo de docai, con el lock del usuario.
+    """
+    with user_lock(wa_id):
+        user_data = get_user_data(wa_id)
+        if user_data.get("conversation_id") != conversation_id:
+            return
+        if result.get("success"):
+            user_data.setdefault("documents", []).append({
+                "type": "identification",
+                "text": result["text"],
+                "entities": result["entities"],
+                "pages": len(sha256s),
+                "sha256s": sha256s,
+                "timestamp": time.time()
+            })
+            for image in user_data.get("images", []):
+                if image.get("sha256") in sha256s:
+                    image["docai_processed"] = True
+            user_data["onboarding_phase"] = "document_processed"
+            message_handler.add_message(phone_number=wa_id, message="[📸 Documento de identidad procesado]", is_bot=False)
+        else:
+            logger.warning(f"No se pudo procesar el documento de {wa_id}: {result.get('error')}")
+            message_handler.add_message(
+                phone_number=wa_id, message="[📸 Error al procesar documento. Por favor, inténtalo de nuevo]", is_bot=False
+            )
+        store_user_data(wa_id, user_data)
+
+def extract_document_text(path, sha256, mime_type):
+    """Extrae el texto de un documento recibido como archivo (PDF), con la cache de Document AI"""
+    return document_jobs.extract(path, sha256, mime_type)
+
+# Lista de user_data donde se registra cada tipo de archivo recibido
+MEDIA_FILE_KINDS = {"document": "files", "video": "videos"}
+
+def media_file_entry(user_data, kind, media_id):
+    """Retorna la entrada de user_data de un documento o video por su media_id, creándola si no existe"""
+    items = user_data.setdefault(MEDIA_FILE_KINDS[kind], [])
+    for item in items:
+        if item.get("media_id") == media_id:
+            return item
+    item = {"timestamp": time.time(), "media_id": media_id, "path": None, "sha256": None}
+    items.append(item)
+    return item
+
+def attach_media_file(wa_id, kind, handle):
+    """
+    Completa en user_data un documento o video cuya descarga terminó en segundo plano
+    y encola su archivado. Si el turno todavía no lo registró (o el bot está
+    desactivado y no hay turno) se crea la entrada.
+    
+    Returns:
+        ID de la conversación
+    """
+    # Corre en el hilo de la descarga: con el lock del usuario, como el turno del webhook
+    with user_lock(wa_id):
+        user_data = get_user_data(wa_id)
+        user_data.setdefault("conversation_id", str(uuid.uuid4()))
+        item = media_file_entry(user_data, kind, handle["media_id"])
+        item.update(path=handle["path"], sha256=handle["sha256"], size=handle["size"],
+                    mime=handle["mime"], url=handle["url"])
+        archive_media_item(wa_id, user_data, kind, item)
+        store_user_data(wa_id, user_data)
+        return user_data["conversation_id"]
+
+def store_media_analysis(wa_id, conversation_id, kind, handle, result):
+    """Agrega a los datos del usuario el análisis de un documento o video (páginas, texto, duración)"""
+    # Corre en el pool de análisis: con el lock del usuario, como el turno del webhook
+    with user_lock(wa_id):
+        user_data = get_user_data(wa_id)
+        if user_data.get("conversation_id") != conversation_id:
+            return
+        for item in user_data.get(MEDIA_FILE_KINDS[kind], []):
+            if item.get("sha256") == handle["sha256"]:
+                item.update(pages=result["pages"], duration=result["duration"], text=result["text"], analyzed=True)
+        store_user_data(wa_id, user_data)
+    if result["text"]:
+        message_handler.add_message(phone_number=wa_id, message=f"[TEXTO DEL DOCUMENTO] {result['text'][:1000]}",
+                                    is_bot=False)
+
 # ------------------------------------------------------------------------
 # PROCESAMIENTO DE DOCUMENTOS CON DOCUMENT AI
 # ------------------------------------------------------------------------
@@ -189,272 +398,312 @@ def process_document_with_docai(image_bytes, mime_type="image/jpeg"):
 # ------------------------------------------------------------------------
 # INTEGRACIÓN CON CLOUD STORAGE
 # ------------------------------------------------------------------------
-def upload_to_gcs(data, destination_blob_name, content_type="application/json"):
+# Archivado incremental: cada medio se sube una vez al llegar, el manifiesto al final
+object_store = create_object_store_from_env()
+cloud_archiver = CloudArchiver(object_store, max_workers=int(os.getenv("ARCHIVE_MAX_WORKERS", "4")))
+
+ARCHIVE_FOLDERS = {"image": "images", "audio": "audios", "document": "documents", "video": "videos"}
+DEFAULT_ARCHIVE_MIMES = {"image": "image/jpeg", "audio": "audio/ogg", "document": "application/pdf", "video": "video/mp4"}
+
+def restore_archived_media(sha256, dest_path):
     """
-    Sube datos a Google Cloud Storage
+    Recupera desde el almacenamiento de objetos un medio desalojado de la cache local.
+    Las imágenes vuelven en su versión normalizada de archivo (MediaIngestor las guarda
+    aparte del original).
     
-    Args:
-        data: Datos a subir (pueden ser bytes o string)
-        destination_blob_name: Nombre del archivo en GCS (incluye path)
-        content_type: Tipo MIME del contenido
-        
     Returns:
-        URL pública del archivo subido o None si falla
+        Tipo MIME del objeto descargado en dest_path, o None si el medio no estaba archivado
     """
-    try:
-        blob = bucket.blob(destination_blob_name)
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        blob.upload_from_string(data, content_type=content_type)
-        # Hacer el blob públicamente accesible (opcional)
-        blob.make_public()
-        logger.info(f"Archivo {destination_blob_name} subido exitosamente a GCS")
-        return blob.public_url
-    except Exception as e:
-        logger.error(f"Error subiendo a GCS: {e}")
+    object_path = cloud_archiver.object_path_for(sha256)
+    if not object_path:
+        return None
+    object_store.download_file(object_path, dest_path)
+    return mimetypes.guess_type(object_path)[0] or "application/octet-stream"
+
+def register_media_file(path, sha256, kind):
+    """Registra un archivo derivado en la cuota de la cache local de medios"""
+    from app.utils.whatsapp_utils import media_ingestor
+    media_ingestor.register_file(path, sha256, kind)
+
+def get_archive_base_path(wa_id, user_data):
+    """Ruta base de la conversación en el bucket (se fija la primera vez que se archiva algo)"""
+    if "archive_base_path" not in user_data:
+        date_str = datetime.now().strftime("%Y%m%d")
+        user_data["archive_base_path"] = f"{wa_id}/{user_data['conversation_id']}_{date_str}"
+    return user_data["archive_base_path"]
+
+def normalized_media(media, variant):
+    """
+    Retorna el handle de la versión normalizada de una imagen para un consumidor
+    ("ocr" para Document AI, "archive" para la nube), o el original si no está disponible.
+    """
+    # Import diferido: whatsapp_utils importa este módulo
+    from app.utils.whatsapp_utils import derivative_generator
+    if not (derivative_generator and media.get("sha256") and media.get("path")):
+        return media
+    return derivative_generator.normalized(media, variant)
+
+def archive_media_item(wa_id, user_data, kind, item):
+    """
+    Encola en segundo plano la subida de un medio recibido (imagen, audio, documento o video).
+    Los medios que ya tienen gcs_url o que ya fueron archivados no se vuelven a subir.
+    """
+    if item.get("gcs_url"):
+        return None
+    if not (item.get("sha256") and item.get("path") and os.path.exists(item["path"])):
+        # Entradas sin copia local (anteriores a la ingesta única): su URL de WhatsApp ya expiró
+        logger.warning(f"Medio sin copia local, no se puede archivar: {item.get('url')}")
         return None
+    base_path = get_archive_base_path(wa_id, user_data)
+    mime = item.get("mime") or DEFAULT_ARCHIVE_MIMES[kind]
+    local_path = item["path"]
+    if kind == "image":
+        # Se archiva la versión normalizada (JPEG sin metadatos y de resolución acotada),
+        # generada en el pool de subidas para no demorar el turno
+        mime = "image/jpeg"
+        local_path = lambda: normalized_media(dict(item, mime=item.get("mime") or mime), "archive")["path"]
+    object_path = f"{base_path}/{ARCHIVE_FOLDERS[kind]}/{item['sha256']}{extension_for_mime(mime)}"
+    return cloud_archiver.archive_file(wa_id, user_data["conversation_id"], object_path, local_path, mime,
+                                       kind=kind, sha256=item["sha256"], size=item.get("size"))
+
+def build_conversation_manifest(wa_id, conversation_id):
+    """
+    Construye el manifiesto (data.json) de la conversación con las URLs ya archivadas
+    y las deja también en user_data.
+    """
+    # Corre en el hilo del manifiesto: con el lock del usuario
+    with user_lock(wa_id):
+        user_data = get_user_data(wa_id)
+        conversation_history = get_conversation_history(wa_id)
+        archived = cloud_archiver.conversation_urls(conversation_id)
+    
+        for kind in ("images", "audio_messages"):
+            for item in user_data.get(kind, []):
+                if not item.get("gcs_url") and archived.get(item.get("sha256")):
+                    item["gcs_url"] = archived[item["sha256"]]
+        store_user_data(wa_id, user_data)
+    
+        # Referenciar cada audio archivado en su mensaje del historial (en orden de llegada)
+        audio_urls = [audio.get("gcs_url") for audio in user_data.get("audio_messages", [])]
+        audio_turns = [msg for msg in conversation_history
+                       if msg.get("role") == "user" and "[🎤 Audio recibido" in msg.get("content", "")]
+        for msg, audio_url in zip(audio_turns, audio_urls):
+            if audio_url:
+                msg["audio_url"] = audio_url
+        store_conversation_history(wa_id, conversation_history)
+    
+        return json.dumps({
+            "metadata": {
+                "wa_id": wa_id,
+                "conversation_id": conversation_id,
+                "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+                "date": datetime.now().isoformat()
+            },
+            "user_data": user_data,
+            "conversation_history": conversation_history
+        }, indent=2, ensure_ascii=False)
 
 def save_conversation_to_cloud(wa_id, conversation_id):
     """
-    Guarda toda la información de la conversación en Cloud Storage
+    Sincroniza la conversación con Cloud Storage en segundo plano: encola los medios
+    que aún no se hayan subido y el manifiesto, que se escribe una sola vez cuando
+    terminan esas subidas.
     
     Args:
         wa_id: ID de WhatsApp del usuario
         conversation_id: ID único de la conversación
         
     Returns:
-        Dict con las URLs de los archivos guardados
+        Dict con la ruta de la conversación en GCS y el número de subidas encoladas
     """
     try:
-        # Obtener datos del usuario y el historial de conversación
         user_data = get_user_data(wa_id)
-        conversation_history = get_conversation_history(wa_id)
-        
         if not user_data:
             logger.warning(f"No hay datos de usuario para {wa_id}")
             return None
-            
-        # Crear estructura de datos completa
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        date_str = datetime.now().strftime("%Y%m%d")
-        
-        save_data = {
-            "metadata": {
-                "wa_id": wa_id,
-                "conversation_id": conversation_id,
-                "timestamp": timestamp,
-                "date": datetime.now().isoformat()
-            },
-            "user_data": user_data,
-            "conversation_history": conversation_history
-        }
         
-        # Construir el path usando el número de teléfono y la combinación de conversation_id + fecha
-        base_path = f"{wa_id}/{conversation_id}_{date_str}"
-        
-        # 1. Guardar JSON principal con los datos estructurados
-        json_data = json.dumps(save_data, indent=2, ensure_ascii=False)
-        json_path = f"{base_path}/data.json"
-        json_url = upload_to_gcs(json_data, json_path)
-        
-        # 2. Guardar imágenes (si existen)
-        image_urls = []
-        if "images" in user_data:
-            for idx, image_info in enumerate(user_data["images"]):
-                image_bytes = download_image_bytes(image_info["url"])
-                if image_bytes:
-                    image_path = f"{base_path}/images/image_{idx}.jpg"
-                    image_url = upload_to_gcs(image_bytes, image_path, "image/jpeg")
-                    if image_url:
-                        image_urls.append(image_url)
-                        # Actualizar URL en el user_data para referencia futura
-                        user_data["images"][idx]["gcs_url"] = image_url
-        
-        # 3. Guardar audios (si existen)
-        audio_urls = []
-        if "audio_messages" in user_data:
-            for idx, audio_info in enumerate(user_data["audio_messages"]):
-                if "url" in audio_info:
-                    audio_bytes = download_image_bytes(audio_info["url"])
-                    if audio_bytes:
-                        # Asegurarse que el directorio de audios existe en Cloud Storage
-                        audio_path = f"{base_path}/audios/audio_{idx}.mp3"
-                        audio_url = upload_to_gcs(audio_bytes, audio_path, "audio/mpeg")
-                        if audio_url:
-                            audio_urls.append(audio_url)
-                            # Actualizar URL en el user_data para referencia futura
-                            user_data["audio_messages"][idx]["gcs_url"] = audio_url
-                            
-                            # Guardar la entrada en la base de datos para mostrar en el dashboard
-                            with shelve.open("conversation_history", writeback=True) as history_shelf:
-                                # Buscar el mensaje correspondiente y actualizarlo con la URL de audio
-                                if wa_id in history_shelf:
-                                    for msg in history_shelf[wa_id]:
-                                        if msg.get("role") == "user" and "[🎤 Audio recibido]" in msg.get("content", ""):
-                                            # Actualizar el mensaje con referencia a la URL de GCS
-                                            msg["audio_url"] = audio_url
-                                    # Guardar la historia actualizada
-                                    history_shelf[wa_id] = history_shelf[wa_id]
-        
-        # Actualizar user_data con las URLs de GCS
+        base_path = get_archive_base_path(wa_id, user_data)
         store_user_data(wa_id, user_data)
         
+        queued = 0
+        for kind, key in (("image", "images"), ("audio", "audio_messages")):
+            for item in user_data.get(key, []):
+                if archive_media_item(wa_id, user_data, kind, item):
+                    queued += 1
+        
+        manifest = cloud_archiver.write_manifest(
+            wa_id, conversation_id, f"{base_path}/data.json",
+            lambda: build_conversation_manifest(wa_id, conversation_id)
+        )
         return {
-            "json_url": json_url,
-            "image_urls": image_urls,
-            "audio_urls": audio_urls,
-            "gcs_path": f"gs://{GCS_BUCKET_NAME}/{base_path}"
+            "gcs_path": object_store.uri_for(base_path),
+            "queued_uploads": queued,
+            "manifest_queued": manifest is not None
         }
     except Exception as e:
         logger.error(f"Error guardando conversación en cloud: {e}")
         return None
 # ------------------------------------------------------------------------
-# FUNCIONALIDAD PARA DESCARGAR IMÁGENES
+# PROMPT DE SISTEMA (compuesto por paso del flujo, ver app/services/prompts.py)
 # ------------------------------------------------------------------------
-def download_image_bytes(image_url):
-    """Descarga una imagen desde una URL y retorna sus bytes"""
-    headers = {}
-    try:
-        token = current_app.config.get("ACCESS_TOKEN")
-        if token:
-            headers["Authorization"] = f"Bearer {token}"
-    except Exception:
-        pass
-
-    try:
-        logger.info(f"[download_image_bytes] Descargando: {image_url}")
-        resp = requests.get(image_url, headers=headers, timeout=10)
-        resp.raise_for_status()
-        return resp.content
-    except Exception as e:
-        logger.error(f"No se pudo descargar la imagen {image_url}: {e}")
-        return b""
+logger.info(
+    f"Recorte de prompt por paso {'activo' if PROMPT_SLICING_ENABLED else 'inactivo'}; tokens estimados: "
+    + ", ".join(f"{step}={report['step_tokens']}/{report['full_tokens']}" for step, report in prompt_token_report().items())
+)
 
 # ------------------------------------------------------------------------
-# PROMPT DE SISTEMA
+# LLAMAR A LA API DE OPENAI
 # ------------------------------------------------------------------------
-SYSTEM_PROMPT = """Eres un asistente que permite a los usuarios capturar datos en Tiendas de Barrio o Supermercados. 
-Agrega emojis para hacer más divertida la conversación de WhatsApp.
-
-1. Lo primero que haces es un Registro de Onboarding Preguntando al usuario si ya está registrado en Kapta o no. 
-
-1.1 Si el usuario responde que no, se le solicita la Cédula Frontal, Parte detrás, Ciudad, y Cliente en un mensaje. Agrega el estilo de un mensaje copado de WhatsApp, escribe los datos en un JSON local. 
-
-Se le indica al usuario que cuando finalice envíe Listo como para confirmar, validar que está listo por detrás, es decir que el usuario envió la información total solicitada. 
-
-Si se envió la información completa se avanza en el flujo, sino se le pide lo que falte al usuario. 
-
-1.2 Si el usuario dice que ya está registrado avanzamos a: 
-
-Para empezar, envíame el nombre de la tienda que vamos a capturar.
-
-📝 Ejemplos: Éxito La Felicidad o Supermercado Doña Luz
+OPENAI_ERROR_RESPONSE = "😕 Lo siento, ocurrió un error al procesar tu solicitud. Por favor, inténtalo de nuevo más tarde. 🙏"
+DEFERRED_ACK_RESPONSE = "⏳ ¡Recibido, {name}! Estamos con una demora técnica, guardamos tus mensajes y te respondemos apenas se resuelva. No necesitas reenviarlos 🙏"
 
-Dependiendo de si el Usuario dice algo parecido a: 
-Tiendas que son consideradas canal moderno:
-D1
-Ara
-Éxito
-Carulla
-Alkosto
-Olimpica
-Sao
-Jumbo
-Metro
-Makro
-Farmatodo
-Locatel
+# Pedido de repetir una foto que no pasó la revisión de calidad (sin llamar al modelo)
+PHOTO_RETAKE_RESPONSE = "📸 {name}, {problems}. ¿Puedes tomarla de nuevo? 🙏\n\n{tips}"
+PHOTO_ISSUE_MESSAGES = {
+    "low_resolution": ("la foto llegó con muy poca resolución",
+                       "✅ Envíala desde la cámara o la galería, no como captura de pantalla."),
+    "dark": ("la foto salió muy oscura",
+             "✅ Asegúrate de que haya buena iluminación."),
+    "overexposed": ("la foto salió con demasiada luz o reflejos",
+                    "✅ Evita el flash y, si hay neveras, ábrela antes de tomar la foto para evitar reflejos en el vidrio."),
+    "blurry": ("la foto salió borrosa",
+               "✅ Mantén el celular quieto y toca la pantalla para enfocar antes de tomarla."),
+}
 
-Ahí asignamos Canal Moderno y seguimos el siguiente flujo:
+class LLMUnavailableError(Exception):
+    """El modelo no está disponible (circuito abierto o error transitorio del proveedor)."""
 
-📍 Continuemos con la ubicación de la tienda.
 
-Para enviarnos tu ubicación:
- 1. Abre el chat.
- 2. Pulsa el ícono de adjuntar "📎".
- 3. Selecciona "Ubicación" y elige "Enviar mi ubicación actual".
-
-Luego de que el usuario WhatsApp envíe la ubicación le pedimos:
-
-📸 ¡Momento de capturar las fotos!
-
-🔍 Lo más importante es que podamos identificar la mayor cantidad de productos posibles de forma clara.
-
-📌 Para lograrlo, ten en cuenta:
-✅ Toma la foto de frente y a la altura de los ojos.
-✅ Asegúrate de que haya buena iluminación.
-✅ Si hay neveras, ábrela antes de tomar la foto para evitar reflejos en el vidrio.
-✅ Si hay publicidad o elementos que cubran los productos, trata de capturarlos de una forma en la que sean visibles.
-✅ Si hay muchos productos, divide la sección en varias fotos para que todo quede bien registrado.
-
-Cada detalle cuenta, empezaremos con tu categoría y agrega Listo luego de haber tomado las fotos. ¡Gracias por el esfuerzo! 🚀📷
-
-Finalmente luego de que el usuario capturó las fotos y mandó Listo como confirmación
-Enviamos el siguiente Mensaje: 
-
-🎤 Por último, envíame un audio contándome cómo ves el desempeño de tu marca y de la competencia en esta tienda dentro de la categoría.
-
-💡 Queremos conocer qué marcas están mejor posicionadas, cuáles tienen más visibilidad, si hay promociones atractivas o algo que pueda mejorar tu marca en esta tienda versus la competencia. ¡Tu opinión es clave para ayudar a mejorar! Envía Listo cuando hayas terminado. 
-
-Luego de que el usuario envíe Listo, finalmente lo despedimos y guardamos un JSON que tenga toda la información del chat capturada.
-
-# Output Format
-- Responder en español conversacional con muchos emojis adecuados
-- NUNCA incluir estructuras JSON o bloques de código en la respuesta visible
-- Mantener mensajes concisos pero amigables y atractivos
-- Usar emojis para resaltar información importante y hacer la conversación divertida
-
-# Notas importantes
-- Asegurar que cada mensaje del usuario sea reconocido con una respuesta amigable
-- Validar que la información esté completa antes de pasar al siguiente paso
-- Mantener interacciones amigables y atractivas durante todo el proceso
-- NUNCA mostrar detalles técnicos o datos JSON al usuario
-- Reemplazar {name} con el nombre del usuario y {agent_name} con "Kapta Assistant" cuando uses esas plantillas"""
+def stream_openai_response(model, messages, on_paragraph):
+    """
+    Genera la respuesta en streaming y entrega cada párrafo completo a on_paragraph
+    en cuanto termina, ya sin bloques JSON ni de código.
+    
+    Returns:
+        Tupla (texto visible, datos JSON, tokens de entrada, tokens de salida, intentos)
+    """
+    stream, attempts = openai_calls.stream_chat_completion(
+        model=model,
+        messages=messages,
+        temperature=0.7,
+    )
+    streamer = ParagraphStreamer(on_paragraph)
+    prompt_tokens = completion_tokens = 0
+    try:
+        for chunk in stream:
+            if chunk.choices:
+                streamer.feed(chunk.choices[0].delta.content)
+            if getattr(chunk, "usage", None):
+                prompt_tokens = chunk.usage.prompt_tokens or 0
+                completion_tokens = chunk.usage.completion_tokens or 0
+    except Exception as e:
+        # Si ya se enviaron párrafos al usuario no se puede diferir el turno: se cierra con lo recibido
+        if not streamer.paragraphs:
+            raise
+        logger.error(f"El stream de OpenAI se interrumpió tras {len(streamer.paragraphs)} párrafo(s): {e}")
+    finally:
+        stream.close()
+    return streamer.finish(), streamer.json_data, prompt_tokens, completion_tokens, attempts
 
-# ------------------------------------------------------------------------
-# LLAMAR A LA API DE OPENAI
-# ------------------------------------------------------------------------
-def call_openai(messages, user_name):
+def call_openai(messages, user_name, tier=LARGE_TIER, metrics_context=None, allow_escalation=True,
+                on_paragraph=None, prompt_step=None, previous_step=None):
     """
-    Llama a la API de OpenAI usando el modelo gpt-4-turbo-preview
+    Llama a la API de OpenAI con el modelo del nivel indicado. Si la respuesta del
+    modelo rápido no pasa la validación (JSON no parseable o respuesta vacía), se
+    escala al modelo grande.
+    
+    Con on_paragraph la respuesta se genera en streaming y cada párrafo se entrega
+    en cuanto se completa; en ese modo no se escala, porque el texto ya fue enviado.
     
     Args:
         messages: Lista de mensajes en formato de la API de OpenAI
         user_name: Nombre del usuario para personalizar respuestas
+        tier: Nivel de modelo a usar (fast o large), ver ModelRouter
+        metrics_context: Dict con wa_id, conversation_id y flow_step para registrar el consumo
+        allow_escalation: Si es False no se escala al modelo grande (presupuesto agotado)
+        on_paragraph: Callback opcional que recibe cada párrafo durante el streaming
+        prompt_step: Paso del flujo cuyas instrucciones se envían (None = prompt completo)
+        previous_step: Paso al que responde el mensaje, si el mensaje hizo avanzar el flujo
         
     Returns:
         Respuesta del asistente y datos JSON extraídos (si hay)
+        
+    Raises:
+        LLMUnavailableError: Si el circuito está abierto o el proveedor falla de forma transitoria
     """
+    if not llm_breaker.allow_request():
+        raise LLMUnavailableError("El circuito hacia OpenAI está abierto")
+    
     try:
         # Añadir información sobre el usuario al sistema prompt
-        personalized_prompt = SYSTEM_PROMPT.replace("{name}", user_name).replace("{agent_name}", "Kapta Assistant")
-        
-        response = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=[
-                {
-                    "role": "system",
-                    "content": personalized_prompt
-                }
-            ] + messages,
-            temperature=0.7,
-        )
-        
-        # Extraer respuesta
-        assistant_response = response.choices[0].message.content
+        personalized_prompt = get_system_prompt(prompt_step, previous_step).replace("{name}", user_name).replace("{agent_name}", "Kapta Assistant")
         
-        # Verificar si hay JSON en la respuesta y extraerlo silenciosamente
-        json_data = {}
-        json_match = re.search(r'```json\s*(.*?)\s*```', assistant_response, re.DOTALL)
-        if json_match:
-            try:
-                json_str = json_match.group(1)
-                json_data = json.loads(json_str)
-                # Eliminar el JSON de la respuesta que se mostrará al usuario
-                assistant_response = re.sub(r'```json\s*.*?\s*```', '', assistant_response, flags=re.DOTALL)
-                logger.info("JSON extraído de la respuesta y eliminado del texto visible")
-            except:
-                logger.warning("Se encontró formato de JSON pero no se pudo parsear")
+        model_tier = tier
+        call_started = time.time()
+        usage_totals = {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "retries": 0,
+                        "hedges": 0}
+        full_messages = [
+            {
+                "role": "system",
+                "content": personalized_prompt
+            }
+        ] + messages
+        while True:
+            started = time.time()
+            if on_paragraph:
+                assistant_response, json_data, prompt_tokens, completion_tokens, attempts = stream_openai_response(
+                    model_router.model_for(model_tier), full_messages, on_paragraph
+                )
+            else:
+                response, attempts = openai_calls.create_chat_completion(
+                    model=model_router.model_for(model_tier),
+                    messages=full_messages,
+                    temperature=0.7,
+                )
+                usage = getattr(response, "usage", None)
+                prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+                completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            usage_totals["cost_usd"] += model_router.record(
+                model_tier,
+                (time.time() - started) * 1000,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                escalated=model_tier != tier,
+            )
+            usage_totals["prompt_tokens"] += prompt_tokens
+            usage_totals["completion_tokens"] += completion_tokens
+            retries, hedges = summarize_attempts(attempts)
+            usage_totals["retries"] += retries
+            usage_totals["hedges"] += hedges
+            if retries or hedges:
+                logger.info(f"Llamada a OpenAI completada con {retries} reintento(s) y {hedges} "
+                            f"cobertura(s): {attempts}")
+            if on_paragraph:
+                # El texto ya llegó al usuario limpio y por párrafos
+                break
+            
+            # Extraer respuesta
+            assistant_response = response.choices[0].message.content or ""
+            
+            # Verificar si hay JSON en la respuesta y extraerlo silenciosamente
+            json_data = {}
+            json_valid = True
+            json_match = re.search(r'```json\s*(.*?)\s*```', assistant_response, re.DOTALL)
+            if json_match:
+                try:
+                    json_str = json_match.group(1)
+                    json_data = json.loads(json_str)
+                    # Eliminar el JSON de la respuesta que se mostrará al usuario
+                    assistant_response = re.sub(r'```json\s*.*?\s*```', '', assistant_response, flags=re.DOTALL)
+                    logger.info("JSON extraído de la respuesta y eliminado del texto visible")
+                except:
+                    json_valid = False
+                    logger.warning("Se encontró formato de JSON pero no se pudo parsear")
+            
+            if model_tier == LARGE_TIER or not allow_escalation or (json_valid and assistant_response.strip()):
+                break
+            logger.info(f"Respuesta del modelo {model_router.model_for(model_tier)} no válida, escalando al modelo grande")
+            model_tier = LARGE_TIER
         
         # Limpiar cualquier otro bloque de código que pudiera haberse colado
         assistant_response = re.sub(r'```.*?```', '', assistant_response, flags=re.DOTALL)
@@ -463,8 +712,8 @@ def call_openai(messages, user_name):
         assistant_response = re.sub(r'\[DEBUG:.*?\]', '', assistant_response)
         assistant_response = re.sub(r'\[INTERNAL:.*?\]', '', assistant_response)
         
-        # Añadir emojis si no hay suficientes
-        if assistant_response.count('😊🙂😀😄😁😃🤗👋👍✅🎉🏪🛒📸📱📍🗺️🎤🔊') < 2:
+        # Añadir emojis si no hay suficientes (no aplica si ya se envió en streaming)
+        if not on_paragraph and assistant_response.count('😊🙂😀😄😁😃🤗👋👍✅🎉🏪🛒📸📱📍🗺️🎤🔊') < 2:
             common_emojis = ['😊', '👋', '📸', '📍', '🎤', '✅', '🎉', '👍', '💯', '⭐']
             emoji_count = sum(1 for char in assistant_response if ord(char) > 127)
             if emoji_count < 2:
@@ -473,19 +722,151 @@ def call_openai(messages, user_name):
                 if not any(ord(char) > 127 for char in assistant_response[-10:]):
                     assistant_response = f"{assistant_response} {random.choice(common_emojis)}"
         
+        llm_breaker.record_success()
+        if metrics_context:
+            llm_metrics.record(
+                metrics_context.get("wa_id"),
+                metrics_context.get("conversation_id"),
+                metrics_context.get("flow_step"),
+                model=model_router.model_for(model_tier),
+                latency_ms=(time.time() - call_started) * 1000,
+                cache_lookup=metrics_context.get("cache_lookup", False),
+                **usage_totals
+            )
         return assistant_response, json_data
     except Exception as e:
         logger.error(f"Error llamando a OpenAI: {e}", exc_info=True)
-        return "😕 Lo siento, ocurrió un error al procesar tu solicitud. Por favor, inténtalo de nuevo más tarde. 🙏", {}
+        if is_retryable_error(e):
+            llm_breaker.record_failure()
+            raise LLMUnavailableError(str(e)) from e
+        # El proveedor respondió (p. ej. un 400): no es una caída
+        llm_breaker.record_success()
+        return OPENAI_ERROR_RESPONSE, {}
+
+# ------------------------------------------------------------------------
+# TURNOS DIFERIDOS DURANTE CAÍDAS DEL MODELO
+# ------------------------------------------------------------------------
+def merge_json_captures(user_data, json_data):
+    """Agrega los datos JSON capturados por el modelo a los datos del usuario"""
+    if "captures" not in user_data:
+        user_data["captures"] = []
+    json_data["timestamp"] = time.time()
+    user_data["captures"].append(json_data)
+    for key, value in json_data.items():
+        if key not in ["captures", "timestamp"]:
+            user_data[key] = value
+
+def coalesce_deferred_turns(wa_id, conversation_history):
+    """
+    Reclama los turnos diferidos del usuario y los agrega al historial como un
+    único mensaje, en el orden en que llegaron.
+    
+    Returns:
+        Lista de turnos reclamados (dicts con id, name, message_type y user_message)
+    """
+    turns = deferred_turns.claim(wa_id)
+    if turns:
+        conversation_history.append({
+            "role": "user",
+            "content": "\n".join(turn["user_message"] for turn in turns)
+        })
+        logger.info(f"{len(turns)} turno(s) diferido(s) de {wa_id} agrupados en el historial")
+    return turns
+
+def reject_photo(wa_id, name, user_data, conversation_history, media, quality, image_size):
+    """
+    Responde con una plantilla pidiendo repetir una foto que no pasó la revisión de
+    calidad. La foto queda en user_data["rejected_images"] con sus medidas y no se
+    cuenta, no se indexa ni se archiva.
+    """
+    issues = quality["issues"]
+    logger.info(f"Foto de {wa_id} descartada por calidad: {issues} {quality}")
+    user_data.setdefault("rejected_images", []).append({
+        "timestamp": time.time(),
+        "size_kb": round(image_size, 1),
+        "url": media.get("url"),
+        "media_id": media.get("media_id"),
+        "path": media.get("path"),
+        "sha256": media.get("sha256"),
+        "mime": media.get("mime"),
+        "quality": quality
+    })
+    store_user_data(wa_id, user_data)
+    
+    problems = " y ".join(PHOTO_ISSUE_MESSAGES[issue][0] for issue in issues)
+    tips = "\n".join(PHOTO_ISSUE_MESSAGES[issue][1] for issue in issues)
+    response = PHOTO_RETAKE_RESPONSE.format(name=name, problems=problems, tips=tips)
+    conversation_history.append({"role": "user", "content": f"[📸 Foto descartada por calidad: {', '.join(issues)}]"})
+    conversation_history.append({"role": "assistant", "content": response})
+    store_conversation_history(wa_id, conversation_history)
+    return {"text_response": response, "force_script": True}
+
+def defer_turn(wa_id, name, message_type, user_message):
+    """
+    Guarda el turno para reproducirlo cuando el modelo se recupere. Solo el primer
+    turno diferido del usuario recibe un acuse de recibo.
+    """
+    pending = deferred_turns.enqueue(wa_id, name, message_type, user_message)
+    if pending == 1:
+        return {"text_response": DEFERRED_ACK_RESPONSE.format(name=name), "force_script": True}
+    return {"text_response": "", "force_script": True}
+
+def replay_deferred_turns(wa_id):
+    """
+    Reproduce los turnos diferidos de un usuario en una sola llamada al modelo.
+    
+    Returns:
+        Dict con la respuesta a enviar, o None si no había turnos o el modelo sigue caído
+    """
+    # Con el lock del usuario: el webhook puede estar procesando otro turno
+    with user_lock(wa_id):
+        conversation_history = get_conversation_history(wa_id)
+        turns = coalesce_deferred_turns(wa_id, conversation_history)
+        if not turns:
+            return None
+        turn_ids = [turn["id"] for turn in turns]
+    
+        user_data = get_user_data(wa_id)
+        metrics_context = {
+            "wa_id": wa_id,
+            "conversation_id": user_data.get("conversation_id"),
+            "flow_step": get_flow_step(user_data),
+        }
+        try:
+            assistant_response, json_data = call_openai(
+                conversation_history, turns[-1]["name"] or "", metrics_context=metrics_context,
+                prompt_step=get_flow_step(user_data)
+            )
+        except LLMUnavailableError:
+            deferred_turns.release(turn_ids)
+            return None
+    
+        conversation_history.append({"role": "assistant", "content": assistant_response})
+        store_conversation_history(wa_id, conversation_history)
+        if json_data and not capture_extractor:
+            merge_json_captures(user_data, json_data)
+            store_user_data(wa_id, user_data)
+        deferred_turns.complete(turn_ids)
+        logger.info(f"Turnos diferidos de {wa_id} reproducidos")
+        return {"text_response": assistant_response, "force_script": True}
 
 # ------------------------------------------------------------------------
 # GENERAR RESPUESTA
 # ------------------------------------------------------------------------
-def generate_response(wa_id, name, message_type, message_content=None):
+def generate_response(wa_id, name, message_type, message_content=None, on_paragraph=None):
     """
     Procesa un mensaje de WhatsApp y genera una respuesta usando el modelo o1.
     Ahora incluye procesamiento de documentos y guardado en Cloud Storage.
+    
+    Si se pasa on_paragraph, la respuesta del modelo se entrega por párrafos en
+    streaming y el resultado trae "streamed": True (el texto ya fue enviado).
     """
+    # Un turno a la vez por usuario; los callbacks de los hilos de fondo esperan a que termine
+    with user_lock(wa_id):
+        return _generate_response(wa_id, name, message_type, message_content, on_paragraph)
+
+def _generate_response(wa_id, name, message_type, message_content=None, on_paragraph=None):
+    """Cuerpo de generate_response, con el lock del usuario tomado"""
     try:
         if not OPENAI_API_KEY:
             error_msg = "😕 Error de configuración: No se puede conectar con el asistente."
@@ -509,7 +890,9 @@ def generate_response(wa_id, name, message_type, message_content=None):
             })
         
         user_message = ""
-        docai_results = None
+        # Paso del flujo en el que llega el mensaje (antes de avanzar)
+        flow_step = get_flow_step(user_data)
+        cacheable = True
         
         # Procesamiento según el tipo de mensaje
         if message_type == "text":
@@ -520,39 +903,62 @@ def generate_response(wa_id, name, message_type, message_content=None):
                 store_user_data(wa_id, user_data)
                 
         elif message_type == "image":
-            image_bytes = download_image_bytes(message_content)
-            if image_bytes:
-                image_size = len(image_bytes) / 1024  # KB
-                # Procesar con Document AI si es parte del onboarding de documento
-                if user_data.get("onboarding_phase") == "document_upload":
-                    docai_results = process_document_with_docai(image_bytes)
-                    if docai_results["success"]:
-                        user_message = "[📸 Documento de identidad procesado]"
-                        if "documents" not in user_data:
-                            user_data["documents"] = []
-                        user_data["documents"].append({
-                            "type": "identification",
-                            "text": docai_results["text"],
-                            "entities": docai_results["entities"],
-                            "timestamp": time.time()
-                        })
-                        user_data["onboarding_phase"] = "document_processed"
-                    else:
-                        user_message = "[📸 Error al procesar documento. Por favor, inténtalo de nuevo]"
+            # El ingestor de medios entrega un handle con la copia local (sin nueva descarga)
+            media = message_content if isinstance(message_content, dict) else {"url": message_content}
+            # La foto ya está en disco (descarga en streaming): el tamaño sale del handle, sin leerla
+            if media.get("path") and os.path.exists(media["path"]):
+                image_size = (media.get("size") or os.path.getsize(media["path"])) / 1024  # KB
+                # Fotos borrosas, oscuras o muy pequeñas: se piden de nuevo de inmediato, sin el modelo
+                quality = photo_quality_gate.evaluate(media["path"]) if photo_quality_gate and media.get("path") else None
+                if quality and not quality["ok"]:
+                    return reject_photo(wa_id, name, user_data, conversation_history, media, quality, image_size)
+                # Documento de identidad: las fotos del paso de registro (cédula frontal y trasera)
+                # se encolan y se responde de inmediato; la extracción llega a user_data["documents"]
+                # cuando termina (frente y reverso en una sola solicitud)
+                is_document = flow_step == "registration"
+                if is_document:
+                    # La normalización para OCR se hace en el hilo de docai, no en el turno
+                    document_jobs.submit(wa_id, user_data["conversation_id"], media)
+                    user_message = "[📸 Documento de identidad recibido, se está procesando]"
+                    cacheable = False
                 else:
                     user_message = f"[📸 Imagen recibida ({image_size:.1f}KB)]"
                 
-                if "images" not in user_data:
-                    user_data["images"] = []
-                user_data["images"].append({
-                    "timestamp": time.time(),
-                    "size_kb": round(image_size, 1),
-                    "url": message_content,
-                    "docai_processed": bool(docai_results and docai_results["success"])
-                })
-                store_user_data(wa_id, user_data)
+                # Fotos reenviadas: las copias exactas (y las casi idénticas en modo "skip")
+                # no se vuelven a contar ni a subir a la nube
+                duplicate = {"kind": None}
+                if image_dedup and media.get("sha256") and not is_document:
+                    duplicate = image_dedup.check(user_data["conversation_id"], media)
+                skip_image = duplicate["kind"] == "exact" or (duplicate["kind"] == "near" and image_dedup.mode == "skip")
+                if skip_image:
+                    logger.info(f"Imagen repetida ({duplicate['kind']}) de {wa_id}, igual a {duplicate['duplicate_of']}")
+                    user_message = "[📸 Imagen repetida: es igual a una foto ya recibida y no se contó]"
+                    cacheable = False
+                else:
+                    if "images" not in user_data:
+                        user_data["images"] = []
+                    image_info = {
+                        "timestamp": time.time(),
+                        "size_kb": round(image_size, 1),
+                        "url": media.get("url"),
+                        "media_id": media.get("media_id"),
+                        "path": media.get("path"),
+                        "sha256": media.get("sha256"),
+                        "mime": media.get("mime"),
+                        "docai_processed": False,
+                        "quality": quality
+                    }
+                    if duplicate["kind"] == "near":
+                        image_info["near_duplicate_of"] = duplicate["duplicate_of"]
+                        image_info["duplicate_distance"] = duplicate["distance"]
+                        user_message = f"[📸 Imagen recibida ({image_size:.1f}KB), muy parecida a una foto anterior]"
+                        cacheable = False
+                    user_data["images"].append(image_info)
+                    archive_media_item(wa_id, user_data, "image", image_info)
+                    store_user_data(wa_id, user_data)
             else:
                 user_message = "[📷 Error al recibir imagen]"
+                cacheable = False
                 logger.warning("No se pudo descargar la imagen")
                 
         # En la sección de procesamiento de mensajes de audio en generate_response
@@ -561,18 +967,28 @@ def generate_response(wa_id, name, message_type, message_content=None):
             if "audio_messages" not in user_data:
                 user_data["audio_messages"] = []
             
+            media = message_content if isinstance(message_content, dict) else {"url": message_content}
             audio_info = {
                 "timestamp": time.time(),
-                "url": message_content,
+                "url": media.get("url"),
+                "media_id": media.get("media_id"),
+                "path": media.get("path"),
+                "sha256": media.get("sha256"),
+                "mime": media.get("mime"),
                 "processed": False
             }
             user_data["audio_messages"].append(audio_info)
+            if audio_info["path"]:
+                archive_media_item(wa_id, user_data, "audio", audio_info)
+                # La transcripción corre en segundo plano y se incorpora en un turno posterior
+                if audio_transcriber:
+                    audio_transcriber.submit(wa_id, user_data["conversation_id"], media)
             store_user_data(wa_id, user_data)
             
             # Si ya se guardó el audio en GCS en conversaciones anteriores, usar esa URL
             audio_gcs_url = None
             for audio in user_data.get("audio_messages", []):
-                if audio.get("url") == message_content and "gcs_url" in audio:
+                if audio.get("url") == media.get("url") and "gcs_url" in audio:
                     audio_gcs_url = audio.get("gcs_url")
                     break
             
@@ -580,7 +996,7 @@ def generate_response(wa_id, name, message_type, message_content=None):
             if audio_gcs_url:
                 user_message = f"[🎤 Audio recibido - {audio_gcs_url}]"
             
-            logger.info(f"Audio recibido y referencia almacenada: {message_content}")
+            logger.info(f"Audio recibido y referencia almacenada: {media.get('path') or media.get('url')}")
             
         elif message_type == "location":
             try:
@@ -603,42 +1019,140 @@ Dirección: {loc.get('address', 'No disponible')}
             except Exception as e:
                 logger.error(f"Error procesando ubicación: {e}")
                 user_message = "[🗺️ Ubicación recibida (error al procesar detalles)]"
+                cacheable = False
                 
+        elif message_type in MEDIA_FILE_KINDS:
+            # La descarga y el análisis (páginas, texto, primer cuadro) siguen en segundo plano
+            media = message_content if isinstance(message_content, dict) else {}
+            # Si la descarga ya terminó, attach_media_file creó la entrada: se completa sin duplicarla
+            item = media_file_entry(user_data, message_type, media.get("media_id"))
+            item.update(filename=media.get("filename"), caption=media.get("caption"))
+            item.setdefault("mime", media.get("mime"))
+            store_user_data(wa_id, user_data)
+            if message_type == "document":
+                user_message = f"[📄 Documento recibido: {media.get('filename') or 'sin nombre'}]"
+            else:
+                user_message = "[🎥 Video recibido]"
+            if media.get("caption"):
+                user_message += f"\nTexto: {media['caption']}"
+            cacheable = False
+            
+        elif message_type == "sticker":
+            user_message = "[Sticker recibido]"
+            
         else:
             user_message = f"[Tipo de mensaje recibido: {message_type}]"
             logger.info(f"Mensaje de tipo no estándar recibido: {message_type}")
         
+        update_flow_step(user_data, message_type, message_content if message_type == "text" else None)
+        store_user_data(wa_id, user_data)
+        
+        # Si el usuario tiene turnos diferidos por una caída, se responden junto con este
+        deferred_ids = []
+        if llm_breaker.state != OPEN and deferred_turns.has_pending(wa_id):
+            deferred_ids = [turn["id"] for turn in coalesce_deferred_turns(wa_id, conversation_history)]
+            cacheable = False
+        
+        # Transcripciones de notas de voz que terminaron desde el último turno
+        if merge_audio_transcripts(wa_id, user_data, conversation_history):
+            store_user_data(wa_id, user_data)
+            cacheable = False
+        
         conversation_history.append({"role": "user", "content": user_message})
         
-        assistant_response, json_data = call_openai(conversation_history, name)
+        # Buscar una respuesta cacheada para este paso y mensaje antes de llamar al modelo
+        cache_key = None
+        if response_cache and cacheable:
+            # La respuesta depende del estado del usuario ("2 de 3 fotos", "listo" antes o después
+            # del audio...): solo comparten respuesta los usuarios en el mismo estado
+            cache_key = response_cache.make_key(
+                flow_step, message_type, message_content if message_type == "text" else None,
+                state=cache_state(user_data)
+            )
+        cached_response = response_cache.get(cache_key, name) if cache_key else None
+        
+        metrics_context = {
+            "wa_id": wa_id,
+            "conversation_id": user_data["conversation_id"],
+            "flow_step": flow_step,
+            "cache_lookup": cache_key is not None,
+        }
+        streamed = False
+        if cached_response:
+            assistant_response, json_data = cached_response, {}
+            llm_metrics.record(cache_hit=True, latency_saved_ms=response_cache.saved_latency_ms(cache_key),
+                               **metrics_context)
+            logger.info(f"Respuesta servida desde cache para paso '{flow_step}': {response_cache.stats()}")
+        else:
+            tier = model_router.select_tier(
+                message_type, flow_step, message_content if message_type == "text" else None
+            )
+            # Con el presupuesto de tokens agotado: modelo rápido, sin escalar y con historial recortado
+            over_budget = (
+                CONVERSATION_TOKEN_BUDGET > 0
+                and llm_metrics.conversation_tokens(user_data["conversation_id"]) >= CONVERSATION_TOKEN_BUDGET
+            )
+            messages = conversation_history
+            if over_budget:
+                logger.info(f"Presupuesto de tokens agotado para {wa_id}, usando modo económico")
+                tier = FAST_TIER
+                messages = conversation_history[-BUDGET_HISTORY_MESSAGES:]
+            started = time.time()
+            try:
+                assistant_response, json_data = call_openai(
+                    messages, name, tier=tier,
+                    metrics_context=metrics_context,
+                    allow_escalation=not over_budget,
+                    on_paragraph=on_paragraph,
+                    # Instrucciones del paso al que responde el mensaje y del paso al que avanzó
+                    prompt_step=get_flow_step(user_data),
+                    previous_step=flow_step
+                )
+            except LLMUnavailableError as e:
+                logger.warning(f"Modelo no disponible para {wa_id}, turno diferido: {e}")
+                deferred_turns.release(deferred_ids)
+                return defer_turn(wa_id, name, message_type, user_message)
+            deferred_turns.complete(deferred_ids)
+            streamed = on_paragraph is not None and assistant_response != OPENAI_ERROR_RESPONSE
+            latency_ms = (time.time() - started) * 1000
+            logger.info(f"Métricas por nivel de modelo: {model_router.stats()}")
+            # No cachear errores ni respuestas que traen datos capturados del usuario
+            if cache_key and not json_data and assistant_response != OPENAI_ERROR_RESPONSE:
+                response_cache.put(cache_key, assistant_response, name, latency_ms)
         conversation_history.append({"role": "assistant", "content": assistant_response})
         store_conversation_history(wa_id, conversation_history)
         
-        if json_data:
-            if "captures" not in user_data:
-                user_data["captures"] = []
-            json_data["timestamp"] = time.time()
-            user_data["captures"].append(json_data)
-            for key, value in json_data.items():
-                if key not in ["captures", "timestamp"]:
-                    user_data[key] = value
+        # Con extracción diferida la captura sale de la transcripción final, no del turno en vivo
+        if json_data and not capture_extractor:
+            merge_json_captures(user_data, json_data)
             store_user_data(wa_id, user_data)
         
-        # Guardar en Cloud Storage si la conversación está completa
-        if user_data.get("conversation_complete"):
-            conversation_id = user_data["conversation_id"]
-            save_results = save_conversation_to_cloud(wa_id, conversation_id)
-            if save_results:
-                logger.info(f"Conversación guardada en GCS: {save_results['gcs_path']}")
-                # Opcional: aquí se puede limpiar la información local si fuera necesario
+        # Al llegar al final del flujo (no basta con un "listo" suelto, que también cierra el
+        # registro) se extrae la captura de la transcripción completa y se archiva la conversación
+        if get_flow_step(user_data) == "complete":
+            if capture_extractor and not user_data.get("capture_extraction_enqueued"):
+                capture_extractor.enqueue(wa_id, user_data["conversation_id"])
+                user_data["capture_extraction_enqueued"] = True
+                store_user_data(wa_id, user_data)
+            # El archivado corre en segundo plano y el manifiesto se escribe una sola vez
+            # (los medios ya se subieron a medida que llegaron)
+            if not user_data.get("cloud_archive_enqueued"):
+                conversation_id = user_data["conversation_id"]
+                save_results = save_conversation_to_cloud(wa_id, conversation_id)
+                if save_results:
+                    user_data = get_user_data(wa_id)
+                    user_data["cloud_archive_enqueued"] = True
+                    store_user_data(wa_id, user_data)
+                    logger.info(f"Archivado de la conversación encolado en GCS: {save_results['gcs_path']}")
         
-        if len(assistant_response) > 0 and sum(1 for c in assistant_response if ord(c) > 127) < 2:
+        if not streamed and len(assistant_response) > 0 and sum(1 for c in assistant_response if ord(c) > 127) < 2:
             emojis = ["😊", "👍", "👋", "🎉", "✅"]
             assistant_response = f"{random.choice(emojis)} {assistant_response}"
         
         return {
             "text_response": assistant_response,
-            "force_script": True
+            "force_script": True,
+            "streamed": streamed
         }
         
     except Exception as e:
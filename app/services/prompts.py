@@ -0,0 +1,170 @@
+import os
+import logging
+from functools import lru_cache
+
+from app.utils.flow_state import FLOW_STEPS
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------
+# FRAGMENTOS DEL PROMPT DE SISTEMA
+# ------------------------------------------------------------------------
+PROMPT_PREAMBLE = """Eres un asistente que permite a los usuarios capturar datos en Tiendas de Barrio o Supermercados.
+Agrega emojis para hacer más divertida la conversación de WhatsApp.
+"""
+
+STEP_PROMPTS = {
+    "onboarding": """1. Lo primero que haces es un Registro de Onboarding Preguntando al usuario si ya está registrado en Kapta o no.
+""",
+    "registration": """1.1 Si el usuario responde que no, se le solicita la Cédula Frontal, Parte detrás, Ciudad, y Cliente en un mensaje. Agrega el estilo de un mensaje copado de WhatsApp.
+
+Se le indica al usuario que cuando finalice envíe Listo como para confirmar, validar que está listo por detrás, es decir que el usuario envió la información total solicitada.
+
+Si se envió la información completa se avanza en el flujo, sino se le pide lo que falte al usuario.
+""",
+    "store_name": """1.2 Si el usuario dice que ya está registrado avanzamos a:
+
+Para empezar, envíame el nombre de la tienda que vamos a capturar.
+
+📝 Ejemplos: Éxito La Felicidad o Supermercado Doña Luz
+""",
+    "location": """Dependiendo de si el Usuario dice algo parecido a:
+Tiendas que son consideradas canal moderno:
+D1
+Ara
+Éxito
+Carulla
+Alkosto
+Olimpica
+Sao
+Jumbo
+Metro
+Makro
+Farmatodo
+Locatel
+
+Ahí asignamos Canal Moderno y seguimos el siguiente flujo:
+
+📍 Continuemos con la ubicación de la tienda.
+
+Para enviarnos tu ubicación:
+ 1. Abre el chat.
+ 2. Pulsa el ícono de adjuntar "📎".
+ 3. Selecciona "Ubicación" y elige "Enviar mi ubicación actual".
+""",
+    "photos": """Luego de que el usuario WhatsApp envíe la ubicación le pedimos:
+
+📸 ¡Momento de capturar las fotos!
+
+🔍 Lo más importante es que podamos identificar la mayor cantidad de productos posibles de forma clara.
+
+📌 Para lograrlo, ten en cuenta:
+✅ Toma la foto de frente y a la altura de los ojos.
+✅ Asegúrate de que haya buena iluminación.
+✅ Si hay neveras, ábrela antes de tomar la foto para evitar reflejos en el vidrio.
+✅ Si hay publicidad o elementos que cubran los productos, trata de capturarlos de una forma en la que sean visibles.
+✅ Si hay muchos productos, divide la sección en varias fotos para que todo quede bien registrado.
+
+Cada detalle cuenta, empezaremos con tu categoría y agrega Listo luego de haber tomado las fotos. ¡Gracias por el esfuerzo! 🚀📷
+""",
+    "audio": """Finalmente luego de que el usuario capturó las fotos y mandó Listo como confirmación
+Enviamos el siguiente Mensaje:
+
+🎤 Por último, envíame un audio contándome cómo ves el desempeño de tu marca y de la competencia en esta tienda dentro de la categoría.
+
+💡 Queremos conocer qué marcas están mejor posicionadas, cuáles tienen más visibilidad, si hay promociones atractivas o algo que pueda mejorar tu marca en esta tienda versus la competencia. ¡Tu opinión es clave para ayudar a mejorar! Envía Listo cuando hayas terminado.
+""",
+    "complete": """Luego de que el usuario envíe Listo, finalmente lo despedimos.
+""",
+}
+
+PROMPT_RULES = """
+# Output Format
+- Responder en español conversacional con muchos emojis adecuados
+- NUNCA incluir estructuras JSON o bloques de código en la respuesta visible
+- Mantener mensajes concisos pero amigables y atractivos
+- Usar emojis para resaltar información importante y hacer la conversación divertida
+
+# Notas importantes
+- Asegurar que cada mensaje del usuario sea reconocido con una respuesta amigable
+- Validar que la información esté completa antes de pasar al siguiente paso
+- Mantener interacciones amigables y atractivas durante todo el proceso
+- NUNCA mostrar detalles técnicos o datos JSON al usuario
+- Reemplazar {name} con el nombre del usuario y {agent_name} con "Kapta Assistant" cuando uses esas plantillas"""
+
+# Sin extracción diferida (CAPTURE_EXTRACTION_BACKEND=none) la captura sale de los bloques
+# ```json que escribe el modelo en cada turno, así que el guion se los sigue pidiendo
+LIVE_CAPTURE_ENABLED = os.getenv("CAPTURE_EXTRACTION_BACKEND", "openai").lower() == "none"
+
+LIVE_CAPTURE_PROMPTS = {
+    "registration": "Escribe los datos del registro en un JSON local.\n",
+    "complete": "Al despedirlo guardamos un JSON que tenga toda la información del chat capturada.\n",
+}
+
+LIVE_CAPTURE_RULE = """
+- Los datos capturados se escriben en un bloque ```json al final del mensaje; el sistema lo retira antes de enviarlo"""
+
+if LIVE_CAPTURE_ENABLED:
+    for _step, _instructions in LIVE_CAPTURE_PROMPTS.items():
+        STEP_PROMPTS[_step] += _instructions
+    PROMPT_RULES += LIVE_CAPTURE_RULE
+
+STEP_CONTEXT = """
+El usuario está en el paso "{step}" del flujo (pasos: {steps}). Sigue estas instrucciones para este paso:
+
+"""
+
+TRANSITION_CONTEXT = """
+El mensaje del usuario responde al paso "{previous_step}" y con él el flujo pasa al paso "{step}" (pasos: {steps}).
+Valida el mensaje con las instrucciones del paso "{previous_step}" y continúa con las del paso "{step}":
+
+"""
+
+# Prompt completo con el guion de todos los pasos (modo sin recorte)
+SYSTEM_PROMPT = PROMPT_PREAMBLE + "\n" + "\n".join(STEP_PROMPTS[step] for step in FLOW_STEPS) + PROMPT_RULES
+
+
+def _compile_step_prompt(step):
+    context = STEP_CONTEXT.format(step=step, steps=" → ".join(FLOW_STEPS))
+    return PROMPT_PREAMBLE + context + STEP_PROMPTS[step] + PROMPT_RULES
+
+
+# Prompts por paso, compilados una sola vez al importar el módulo
+STEP_SYSTEM_PROMPTS = {step: _compile_step_prompt(step) for step in FLOW_STEPS}
+
+PROMPT_SLICING_ENABLED = os.getenv("PROMPT_SLICING_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=None)
+def _compile_transition_prompt(previous_step, step):
+    context = TRANSITION_CONTEXT.format(previous_step=previous_step, step=step, steps=" → ".join(FLOW_STEPS))
+    return PROMPT_PREAMBLE + context + STEP_PROMPTS[previous_step] + "\n" + STEP_PROMPTS[step] + PROMPT_RULES
+
+
+def get_system_prompt(flow_step=None, previous_step=None):
+    """
+    Retorna el prompt de sistema para el paso del flujo (o el completo si no hay recorte).
+
+    Si el mensaje del usuario hizo avanzar el flujo (previous_step distinto de flow_step),
+    el prompt incluye las instrucciones de los dos pasos: las del paso al que responde el
+    mensaje (p. ej. la validación del registro ante un "listo") y las del paso siguiente.
+    """
+    if not PROMPT_SLICING_ENABLED or flow_step not in STEP_SYSTEM_PROMPTS:
+        return SYSTEM_PROMPT
+    if previous_step in STEP_PROMPTS and previous_step != flow_step:
+        return _compile_transition_prompt(previous_step, flow_step)
+    return STEP_SYSTEM_PROMPTS[flow_step]
+
+
+def estimate_tokens(text):
+    """Estimación aproximada de tokens (~4 caracteres por token en español)"""
+    return (len(text) + 3) // 4
+
+
+def prompt_token_report():
+    """Compara los tokens estimados del prompt completo contra el prompt de cada paso"""
+    full = estimate_tokens(SYSTEM_PROMPT)
+    return {
+        step: {"full_tokens": full, "step_tokens": estimate_tokens(prompt), "saved_tokens": full - estimate_tokens(prompt)}
+        for step, prompt in STEP_SYSTEM_PROMPTS.items()
+    }
@@ -0,0 +1,81 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker para llamadas a servicios externos.
+
+    Tras `failure_threshold` fallos consecutivos el circuito se abre y se rechazan
+    las llamadas durante `recovery_timeout` segundos. Luego pasa a semiabierto y
+    deja pasar una llamada de prueba: si tiene éxito se cierra, si falla se abre de nuevo.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Estado actual del circuito (closed, open o half_open)"""
+        with self._lock:
+            if self._state == OPEN and time.time() - self._opened_at >= self.recovery_timeout:
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+            return self._state
+
+    def allow_request(self):
+        """Indica si se puede hacer una llamada; en semiabierto solo deja pasar una prueba"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        with self._lock:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        """Registra una llamada exitosa y cierra el circuito"""
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"Circuito '{self.name}' cerrado tras una llamada exitosa")
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """Registra un fallo y abre el circuito si se supera el umbral"""
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning(f"Circuito '{self.name}' abierto tras {self._failures} fallo(s)")
+                self._state = OPEN
+                self._opened_at = time.time()
+
+
+def create_circuit_breaker_from_env(name, prefix):
+    """Crea un circuit breaker leyendo <PREFIX>_FAILURE_THRESHOLD y <PREFIX>_RECOVERY_SECONDS"""
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv(f"{prefix}_FAILURE_THRESHOLD", "5")),
+        recovery_timeout=float(os.getenv(f"{prefix}_RECOVERY_SECONDS", "30")),
+    )
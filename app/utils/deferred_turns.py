@@ -0,0 +1,160 @@
+import sqlite3
+from datetime import datetime
+import logging
+
+from app.utils.circuit_breaker import OPEN
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredTurnQueue:
+    """
+    Cola persistente de turnos de usuario que no se pudieron responder porque el
+    modelo no estaba disponible. Los turnos se reproducen en orden cuando el
+    servicio se recupera.
+    """
+    def __init__(self, db_path="whatsapp_conversations.db"):
+        self.db_path = db_path
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de turnos diferidos si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS deferred_turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wa_id TEXT,
+                name TEXT,
+                message_type TEXT,
+                user_message TEXT,
+                created_at TEXT,
+                status TEXT DEFAULT 'pending'
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_deferred_turns_status ON deferred_turns (status, wa_id)")
+            # Turnos que quedaron reclamados si el proceso se detuvo a mitad de una reproducción
+            c.execute("UPDATE deferred_turns SET status = 'pending' WHERE status = 'replaying'")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la cola de turnos diferidos: {e}")
+
+    def enqueue(self, wa_id, name, message_type, user_message):
+        """
+        Encola un turno del usuario.
+
+        Returns:
+            Número de turnos pendientes del usuario, incluyendo el nuevo
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO deferred_turns (wa_id, name, message_type, user_message, created_at) VALUES (?, ?, ?, ?, ?)",
+                (wa_id, name, message_type, user_message, datetime.now().isoformat())
+            )
+            c.execute("SELECT COUNT(*) FROM deferred_turns WHERE wa_id = ? AND status != 'done'", (wa_id,))
+            pending = c.fetchone()[0]
+            conn.commit()
+            logger.info(f"Turno diferido encolado para {wa_id} ({pending} pendiente(s))")
+            return pending
+        finally:
+            conn.close()
+
+    def has_pending(self, wa_id):
+        """Indica si el usuario tiene turnos pendientes"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM deferred_turns WHERE wa_id = ? AND status = 'pending' LIMIT 1", (wa_id,))
+            return c.fetchone() is not None
+        finally:
+            conn.close()
+
+    def pending_wa_ids(self):
+        """Lista los usuarios con turnos pendientes, en el orden en que llegaron"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                "SELECT wa_id FROM deferred_turns WHERE status = 'pending' GROUP BY wa_id ORDER BY MIN(id)"
+            )
+            return [row[0] for row in c.fetchall()]
+        finally:
+            conn.close()
+
+    def claim(self, wa_id):
+        """
+        Reclama los turnos pendientes de un usuario para reproducirlos.
+
+        Returns:
+            Lista de dicts (id, name, message_type, user_message) en orden de llegada
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level="IMMEDIATE")
+        conn.row_factory = sqlite3.Row
+        try:
+            c = conn.cursor()
+            c.execute(
+                "SELECT id, name, message_type, user_message FROM deferred_turns "
+                "WHERE wa_id = ? AND status = 'pending' ORDER BY id",
+                (wa_id,)
+            )
+            turns = [dict(row) for row in c.fetchall()]
+            c.executemany(
+                "UPDATE deferred_turns SET status = 'replaying' WHERE id = ?",
+                [(turn["id"],) for turn in turns]
+            )
+            conn.commit()
+            return turns
+        finally:
+            conn.close()
+
+    def replay_pending(self, replay_fn, deliver_fn, breaker=None):
+        """
+        Reproduce, en orden de llegada, los turnos pendientes de cada usuario.
+
+        Si un usuario no obtiene respuesta (otro hilo ya reclamó sus turnos o su
+        llamada falló y los devolvió a la cola) se pasa al siguiente; solo se detiene
+        cuando el circuito del modelo está abierto.
+
+        Args:
+            replay_fn: Función (wa_id) -> respuesta o None
+            deliver_fn: Función (wa_id, respuesta) que envía la respuesta al usuario
+            breaker: CircuitBreaker del modelo (opcional)
+
+        Returns:
+            Número de usuarios respondidos
+        """
+        replayed = 0
+        for wa_id in self.pending_wa_ids():
+            if breaker is not None and breaker.state == OPEN:
+                break
+            response = replay_fn(wa_id)
+            if response is None:
+                continue
+            deliver_fn(wa_id, response)
+            replayed += 1
+        return replayed
+
+    def complete(self, turn_ids):
+        """Marca turnos como reproducidos"""
+        self._set_status(turn_ids, "done")
+
+    def release(self, turn_ids):
+        """Devuelve turnos reclamados a la cola (la reproducción falló)"""
+        self._set_status(turn_ids, "pending")
+
+    def _set_status(self, turn_ids, status):
+        if not turn_ids:
+            return
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.executemany(
+                "UPDATE deferred_turns SET status = ? WHERE id = ?",
+                [(status, turn_id) for turn_id in turn_ids]
+            )
+            conn.commit()
+        finally:
+            conn.close()
@@ -0,0 +1,84 @@
+import re
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pasos del flujo de captura, en el orden en que los recorre el usuario
+FLOW_STEPS = [
+    "onboarding",     # Preguntar si ya está registrado en Kapta
+    "registration",   # Cédula frontal/trasera, ciudad y cliente
+    "store_name",     # Nombre de la tienda
+    "location",       # Ubicación de la tienda
+    "photos",         # Fotos de la categoría
+    "audio",          # Audio sobre desempeño de la marca
+    "complete",       # Conversación finalizada
+]
+
+AFFIRMATIVE_WORDS = {"si", "sí", "ya", "claro", "registrado", "correcto", "afirmativo"}
+NEGATIVE_WORDS = {"no", "nop", "todavia", "todavía", "aun", "aún", "nunca"}
+DONE_WORDS = {"listo", "terminado"}
+
+
+def normalize_text(text):
+    """
+    Normaliza un mensaje de usuario para compararlo: minúsculas, sin tildes,
+    sin signos de puntuación y con espacios colapsados.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _words(text):
+    return set(normalize_text(text).split())
+
+
+def get_flow_step(user_data):
+    """Obtiene el paso actual del flujo para el usuario"""
+    return user_data.get("flow_step", FLOW_STEPS[0])
+
+
+def update_flow_step(user_data, message_type, message_text=None):
+    """
+    Avanza el paso del flujo según el mensaje recibido.
+
+    Args:
+        user_data: Datos del usuario (se modifican en sitio)
+        message_type: Tipo de mensaje (text, image, audio, location, etc)
+        message_text: Texto del mensaje si es de tipo text
+
+    Returns:
+        El nuevo paso del flujo
+    """
+    step = get_flow_step(user_data)
+    words = _words(message_text) if message_type == "text" else set()
+    done = bool(words & DONE_WORDS)
+
+    if message_type == "location":
+        step = "photos"
+    elif message_type == "audio":
+        step = "audio"
+    elif message_type == "text":
+        if step == "onboarding":
+            if words & NEGATIVE_WORDS:
+                step = "registration"
+            elif words & AFFIRMATIVE_WORDS:
+                step = "store_name"
+        elif step == "registration" and done:
+            step = "store_name"
+        elif step == "store_name" and words and not done:
+            user_data["store_name"] = message_text.strip()
+            step = "location"
+        elif step == "photos" and done:
+            step = "audio"
+        elif step == "audio" and done:
+            step = "complete"
+
+    if step != user_data.get("flow_step"):
+        logger.info(f"Paso del flujo: {user_data.get('flow_step', FLOW_STEPS[0])} -> {step}")
+        user_data["flow_step"] = step
+    return step
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import logging
+from datetime import datetime
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+# Resolución de la que se toman las frecuencias bajas de la DCT en el pHash
+PHASH_RESOLUTION = HASH_SIZE * 4
+
+
+def _dct_matrix(n):
+    """Matriz de la DCT-II ortonormal de tamaño n x n"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0, :] = np.sqrt(1.0 / n)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_RESOLUTION)
+
+
+def _bits_to_hex(bits):
+    return f"{int(''.join('1' if bit else '0' for bit in bits.flatten()), 2):016x}"
+
+
+def dhash(img):
+    """Hash de diferencias: compara cada píxel con su vecino derecho en una imagen de 9x8"""
+    gray = np.asarray(img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_hex(gray[:, 1:] > gray[:, :-1])
+
+
+def phash(img):
+    """Hash perceptual: signo de las frecuencias bajas de la DCT respecto a su mediana"""
+    gray = np.asarray(img.convert("L").resize((PHASH_RESOLUTION, PHASH_RESOLUTION), Image.LANCZOS),
+                      dtype=np.float64)
+    low = (_DCT @ gray @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return _bits_to_hex(low > np.median(low))
+
+
+def hamming_distance(hash_a, hash_b):
+    """Número de bits distintos entre dos hashes hexadecimales"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def compute_image_hashes(path):
+    """
+    Calcula el dHash y el pHash de una imagen.
+
+    Returns:
+        Tupla (dhash, phash) en hexadecimal
+    """
+    with Image.open(path) as img:
+        # Los hashes solo necesitan una versión diminuta: se decodifica a escala reducida
+        img.draft("L", (PHASH_RESOLUTION * 4, PHASH_RESOLUTION * 4))
+        img = ImageOps.exif_transpose(img)
+        return dhash(img), phash(img)
+
+
+class ImageDedupIndex:
+    """
+    Índice de imágenes por conversación para detectar fotos repetidas.
+
+    Las copias exactas se reconocen por sha256; las casi idénticas (la misma foto
+    reenviada, recomprimida o levemente recortada) por la distancia de Hamming entre
+    sus dHash y pHash.
+    """
+
+    def __init__(self, db_path="whatsapp_conversations.db", threshold=10, mode="flag"):
+        """
+        Args:
+            db_path: Base de datos SQLite con el índice de hashes
+            threshold: Distancia máxima (bits de 64) para considerar dos fotos casi idénticas
+            mode: "flag" marca las casi idénticas y las conserva, "skip" las descarta
+        """
+        self.db_path = db_path
+        self.threshold = threshold
+        self.mode = mode
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de hashes de imágenes si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT,
+                media_id TEXT,
+                sha256 TEXT,
+                dhash TEXT,
+                phash TEXT,
+                created_at TEXT
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_image_hashes_conversation ON image_hashes (conversation_id)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar el índice de imágenes: {e}")
+
+    def check(self, conversation_id, handle):
+        """
+        Compara una imagen con las ya recibidas en la conversación y la agrega al índice
+        si no es una copia exacta.
+
+        Args:
+            conversation_id: ID de la conversación
+            handle: Handle del medio (media_id, path, sha256, ...)
+
+        Returns:
+            Dict con kind ("exact", "near" o None), duplicate_of (media_id de la foto
+            anterior) y distance
+        """
+        result = {"kind": None, "duplicate_of": None, "distance": None}
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT media_id, sha256, dhash, phash FROM image_hashes WHERE conversation_id = ?",
+                      (conversation_id,))
+            previous = c.fetchall()
+
+            for media_id, sha256, _, _ in previous:
+                if sha256 == handle["sha256"]:
+                    result.update(kind="exact", duplicate_of=media_id, distance=0)
+                    return result
+
+            try:
+                image_dhash, image_phash = compute_image_hashes(handle["path"])
+            except Exception as e:
+                logger.warning(f"No se pudieron calcular los hashes de {handle['path']}: {e}")
+                image_dhash = image_phash = None
+
+            if image_dhash:
+                for media_id, _, other_dhash, other_phash in previous:
+                    if not other_dhash:
+                        continue
+                    distance = max(hamming_distance(image_dhash, other_dhash),
+                                   hamming_distance(image_phash, other_phash))
+                    if distance <= self.threshold and (result["distance"] is None or distance < result["distance"]):
+                        result.update(kind="near", duplicate_of=media_id, distance=distance)
+
+            c.execute(
+                "INSERT INTO image_hashes (conversation_id, media_id, sha256, dhash, phash, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, handle.get("media_id"), handle["sha256"], image_dhash, image_phash,
+                 datetime.now().isoformat())
+            )
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+
+def create_image_dedup_index_from_env():
+    """Crea el índice de duplicados a partir de las variables de entorno (None si está deshabilitado)"""
+    if os.getenv("IMAGE_DEDUP_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return ImageDedupIndex(
+        threshold=int(os.getenv("IMAGE_DEDUP_THRESHOLD", "10")),
+        mode=os.getenv("IMAGE_DEDUP_MODE", "flag").lower(),
+    )
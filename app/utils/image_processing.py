@@ -0,0 +1,292 @@
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Lado máximo (px) de cada derivado que se genera al recibir una imagen
+DEFAULT_DERIVATIVE_SIZES = {"thumb": 256, "preview": 1024}
+
+FORMAT_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+
+# Versiones normalizadas (orientadas, sin metadatos, recomprimidas) para cada consumidor:
+# "ocr" para Document AI y "archive" para el archivado en la nube
+DEFAULT_NORMALIZATION_PROFILES = {
+    "ocr": {"max_side": 2048, "quality": 90},
+    "archive": {"max_side": 1600, "quality": 80},
+}
+
+
+def generate_derivatives(src_path, output_dir, stem, sizes, image_format="WEBP", quality=80):
+    """
+    Genera versiones reducidas de una imagen (miniatura, vista previa, ...).
+
+    Se ejecuta en un proceso del pool, por lo que solo recibe y retorna tipos simples.
+
+    Args:
+        src_path: Ruta de la imagen original
+        output_dir: Directorio de salida de los derivados
+        stem: Prefijo del nombre de archivo (el sha256 de la imagen)
+        sizes: Dict variante -> lado máximo en píxeles
+        image_format: "WEBP" o "JPEG"
+        quality: Calidad de compresión (1-100)
+
+    Returns:
+        Dict variante -> dict con path, width, height, size y format
+    """
+    extension = FORMAT_EXTENSIONS[image_format]
+    results = {}
+    with Image.open(src_path) as img:
+        # En JPEG se decodifica directamente a una escala reducida (mucho más rápido)
+        largest = max(sizes.values())
+        img.draft("RGB", (largest, largest))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+
+        for variant, max_side in sorted(sizes.items(), key=lambda item: -item[1]):
+            derivative = img.copy()
+            derivative.thumbnail((max_side, max_side), Image.LANCZOS)
+            path = os.path.join(output_dir, f"{stem}_{variant}{extension}")
+            tmp_path = path + ".tmp"
+            if image_format == "WEBP":
+                derivative.save(tmp_path, format=image_format, quality=quality, method=4)
+            else:
+                derivative.save(tmp_path, format=image_format, quality=quality, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            results[variant] = {
+                "path": path,
+                "width": derivative.width,
+                "height": derivative.height,
+                "size": os.path.getsize(path),
+                "format": image_format,
+            }
+    return results
+
+
+def normalize_image(src_path, output_dir, stem, variant, max_side, quality):
+    """
+    Normaliza una foto para un consumidor: aplica la orientación EXIF, limita la
+    resolución, descarta los metadatos (EXIF, GPS, perfil ICC) y la recomprime en JPEG.
+
+    Se ejecuta en un proceso del pool, por lo que solo recibe y retorna tipos simples.
+
+    Args:
+        src_path: Ruta de la imagen original
+        output_dir: Directorio de salida
+        stem: Prefijo del nombre de archivo (el sha256 de la imagen)
+        variant: Nombre de la variante ("ocr", "archive", ...)
+        max_side: Lado máximo en píxeles
+        quality: Calidad JPEG (1-100)
+
+    Returns:
+        Dict variante -> dict con path, width, height, size y format (mismo formato que generate_derivatives)
+    """
+    path = os.path.join(output_dir, f"{stem}_{variant}.jpg")
+    with Image.open(src_path) as img:
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        tmp_path = path + ".tmp"
+        # Sin exif= ni icc_profile= PIL no copia los metadatos del original
+        img.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, path)
+        return {variant: {
+            "path": path,
+            "width": img.width,
+            "height": img.height,
+            "size": os.path.getsize(path),
+            "format": "JPEG",
+        }}
+
+
+class DerivativeGenerator:
+    """
+    Genera en un pool de procesos las miniaturas y vistas previas de cada imagen
+    ingerida, para que el dashboard no cargue las fotos a resolución completa.
+    """
+
+    def __init__(self, output_dir, db_path="whatsapp_conversations.db", sizes=None, image_format="WEBP",
+                 quality=80, max_workers=2, normalization_profiles=None, on_file=None):
+        """
+        Args:
+            output_dir: Directorio donde se guardan los derivados
+            db_path: Base de datos SQLite con el índice de derivados
+            sizes: Dict variante -> lado máximo en píxeles
+            image_format: "WEBP" o "JPEG"
+            quality: Calidad de compresión (1-100)
+            max_workers: Procesos del pool
+            normalization_profiles: Dict variante -> {"max_side", "quality"} de las versiones normalizadas
+            on_file: Callback opcional (ruta, sha256, kind) por cada derivado generado
+        """
+        self.output_dir = output_dir
+        self.db_path = db_path
+        self.sizes = dict(sizes or DEFAULT_DERIVATIVE_SIZES)
+        self.image_format = image_format.upper()
+        if self.image_format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Formato de derivados no soportado: {image_format}")
+        self.quality = quality
+        self.max_workers = max_workers
+        self.normalization_profiles = dict(normalization_profiles or DEFAULT_NORMALIZATION_PROFILES)
+        self.on_file = on_file
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de derivados si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS media_derivatives (
+                sha256 TEXT,
+                variant TEXT,
+                path TEXT,
+                width INTEGER,
+                height INTEGER,
+                size INTEGER,
+                format TEXT,
+                created_at TEXT,
+                PRIMARY KEY (sha256, variant)
+            )
+            ''')
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de derivados: {e}")
+
+    def _pool(self):
+        # El pool se crea al primer uso para no lanzar procesos al importar el módulo
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def submit(self, handle):
+        """
+        Encola la generación de derivados de una imagen ingerida.
+
+        Args:
+            handle: Handle del medio (media_id, path, sha256, size, mime, url)
+
+        Returns:
+            Future con el dict de derivados, o None si el medio no es una imagen
+            o sus miniaturas ya existen
+        """
+        if not (handle.get("mime") or "").startswith("image/"):
+            return None
+        # Solo cuentan las miniaturas y vistas previas: las variantes ocr/archive comparten la tabla
+        if set(self.sizes) <= set(self.get(handle["sha256"])):
+            return None
+        future = self._pool().submit(
+            generate_derivatives, handle["path"], self.output_dir, handle["sha256"],
+            self.sizes, self.image_format, self.quality
+        )
+        future.add_done_callback(lambda done: self._store(handle["sha256"], done))
+        return future
+
+    def _store(self, sha256, future):
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error(f"Error generando derivados de {sha256}: {e}")
+            return
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "INSERT OR REPLACE INTO media_derivatives (sha256, variant, path, width, height, size, format, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(sha256, variant, info["path"], info["width"], info["height"], info["size"], info["format"],
+              datetime.now().isoformat()) for variant, info in results.items()]
+        )
+        conn.commit()
+        conn.close()
+        if self.on_file:
+            for info in results.values():
+                self.on_file(info["path"], sha256, "derivative")
+        logger.info(f"Derivados de {sha256[:12]} generados: "
+                    + ", ".join(f"{v}={i['width']}x{i['height']} ({i['size'] / 1024:.1f}KB)" for v, i in results.items()))
+
+    def normalized(self, handle, variant, timeout=30):
+        """
+        Retorna la versión normalizada de una imagen para un consumidor, generándola en
+        el pool de procesos si aún no existe.
+
+        Args:
+            handle: Handle del medio (media_id, path, sha256, size, mime, url)
+            variant: Perfil de normalización ("ocr" o "archive")
+            timeout: Espera máxima por la normalización
+
+        Returns:
+            Handle de la variante (path, sha256 del original, size, mime), o el handle
+            original si no es una imagen o la normalización falla
+        """
+        if not (handle.get("mime") or "").startswith("image/") or variant not in self.normalization_profiles:
+            return handle
+        info = self.get(handle["sha256"]).get(variant)
+        if not info:
+            profile = self.normalization_profiles[variant]
+            future = self._pool().submit(
+                normalize_image, handle["path"], self.output_dir, handle["sha256"], variant,
+                profile["max_side"], profile["quality"]
+            )
+            try:
+                future.result(timeout=timeout)
+            except Exception as e:
+                logger.error(f"Error normalizando {handle['sha256']} ({variant}), se usa el original: {e}")
+                return handle
+            self._store(handle["sha256"], future)
+            info = self.get(handle["sha256"]).get(variant)
+            if not info:
+                return handle
+        return dict(handle, path=info["path"], size=info["size"], mime="image/jpeg", variant=variant)
+
+    def get(self, sha256):
+        """Retorna los derivados existentes de una imagen: dict variante -> dict de datos"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT variant, path, width, height, size, format FROM media_derivatives WHERE sha256 = ?",
+                  (sha256,))
+        rows = c.fetchall()
+        conn.close()
+        return {row["variant"]: dict(row) for row in rows if os.path.exists(row["path"])}
+
+    def find_path(self, sha256, variant):
+        """Retorna la ruta del derivado pedido o None si aún no existe"""
+        return (self.get(sha256).get(variant) or {}).get("path")
+
+
+def create_derivative_generator_from_env(media_dir, on_file=None):
+    """
+    Crea el generador de derivados a partir de las variables de entorno
+    (None si IMAGE_DERIVATIVES_ENABLED está desactivado).
+
+    Args:
+        media_dir: Raíz de la cache local de medios
+        on_file: Callback (ruta, sha256, kind) para contar los derivados en la cuota
+    """
+    if os.getenv("IMAGE_DERIVATIVES_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return DerivativeGenerator(
+        output_dir=os.getenv("IMAGE_DERIVATIVES_DIR", os.path.join(media_dir, "derivatives")),
+        sizes={
+            "thumb": int(os.getenv("IMAGE_THUMB_SIZE", str(DEFAULT_DERIVATIVE_SIZES["thumb"]))),
+            "preview": int(os.getenv("IMAGE_PREVIEW_SIZE", str(DEFAULT_DERIVATIVE_SIZES["preview"]))),
+        },
+        image_format=os.getenv("IMAGE_DERIVATIVE_FORMAT", "WEBP"),
+        quality=int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80")),
+        max_workers=int(os.getenv("IMAGE_PROCESSING_WORKERS", "2")),
+        normalization_profiles={
+            variant: {
+                "max_side": int(os.getenv(f"IMAGE_{variant.upper()}_MAX_SIDE", str(profile["max_side"]))),
+                "quality": int(os.getenv(f"IMAGE_{variant.upper()}_QUALITY", str(profile["quality"]))),
+            }
+            for variant, profile in DEFAULT_NORMALIZATION_PROFILES.items()
+        },
+        on_file=on_file,
+    )
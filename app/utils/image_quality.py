@@ -0,0 +1,112 @@
+import os
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Lado (px) al que se reduce la foto para medirla: suficiente para el enfoque y mucho más rápido
+ANALYSIS_SIDE = 1024
+
+# Problemas detectables, en el orden en que se le explican al usuario
+QUALITY_ISSUES = ["low_resolution", "dark", "overexposed", "blurry"]
+
+
+def measure_image_quality(path, analysis_side=ANALYSIS_SIDE):
+    """
+    Mide el enfoque y la exposición de una foto.
+
+    - blur_score: varianza del laplaciano (valores bajos = foto borrosa)
+    - brightness: brillo medio (0-255)
+    - dark_ratio / bright_ratio: fracción de píxeles casi negros / casi blancos
+
+    Returns:
+        Dict con width, height (de la foto original, ya orientada), blur_score,
+        brightness, dark_ratio y bright_ratio
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        orientation = img.getexif().get(0x0112, 1)
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+        # En JPEG se decodifica directamente a escala reducida y en escala de grises
+        img.draft("L", (analysis_side, analysis_side))
+        gray = ImageOps.exif_transpose(img).convert("L")
+        gray.thumbnail((analysis_side, analysis_side), Image.BILINEAR)
+        pixels = np.asarray(gray, dtype=np.float32)
+
+    laplacian = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+                 - 4 * pixels[1:-1, 1:-1])
+    histogram = np.bincount(pixels.astype(np.uint8).ravel(), minlength=256) / pixels.size
+    return {
+        "width": width,
+        "height": height,
+        "blur_score": round(float(laplacian.var()), 1),
+        "brightness": round(float(pixels.mean()), 1),
+        "dark_ratio": round(float(histogram[:32].sum()), 3),
+        "bright_ratio": round(float(histogram[224:].sum()), 3),
+    }
+
+
+class PhotoQualityGate:
+    """
+    Revisión local de cada foto recibida (sin llamar al modelo): resolución mínima,
+    enfoque y exposición. Las fotos que no pasan se le piden de nuevo al usuario.
+    """
+
+    def __init__(self, min_side=480, min_blur_score=60.0, min_brightness=45.0, max_brightness=220.0,
+                 max_clipped_ratio=0.5):
+        """
+        Args:
+            min_side: Lado menor mínimo en píxeles
+            min_blur_score: Varianza del laplaciano mínima (a ANALYSIS_SIDE px)
+            min_brightness: Brillo medio mínimo (0-255)
+            max_brightness: Brillo medio máximo (0-255)
+            max_clipped_ratio: Fracción máxima de píxeles casi negros o casi blancos
+        """
+        self.min_side = min_side
+        self.min_blur_score = min_blur_score
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped_ratio = max_clipped_ratio
+
+    def evaluate(self, path):
+        """
+        Evalúa una foto.
+
+        Returns:
+            Dict con las medidas de measure_image_quality, issues (lista de problemas
+            de QUALITY_ISSUES) y ok. Si la foto no se puede leer se retorna ok=True y
+            sin medidas, para no bloquear al usuario.
+        """
+        try:
+            scores = measure_image_quality(path)
+        except Exception as e:
+            logger.warning(f"No se pudo evaluar la calidad de {path}: {e}")
+            return {"issues": [], "ok": True}
+
+        issues = []
+        if min(scores["width"], scores["height"]) < self.min_side:
+            issues.append("low_resolution")
+        if scores["brightness"] < self.min_brightness or scores["dark_ratio"] > self.max_clipped_ratio:
+            issues.append("dark")
+        elif scores["brightness"] > self.max_brightness or scores["bright_ratio"] > self.max_clipped_ratio:
+            issues.append("overexposed")
+        # Con mala exposición el contraste cae y el laplaciano no distingue el desenfoque
+        elif scores["blur_score"] < self.min_blur_score:
+            issues.append("blurry")
+        return dict(scores, issues=issues, ok=not issues)
+
+
+def create_photo_quality_gate_from_env():
+    """Crea la revisión de calidad de fotos a partir de las variables de entorno (None si está deshabilitada)"""
+    if os.getenv("PHOTO_QUALITY_GATE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    return PhotoQualityGate(
+        min_side=int(os.getenv("PHOTO_MIN_SIDE", "480")),
+        min_blur_score=float(os.getenv("PHOTO_MIN_BLUR_SCORE", "60")),
+        min_brightness=float(os.getenv("PHOTO_MIN_BRIGHTNESS", "45")),
+        max_brightness=float(os.getenv("PHOTO_MAX_BRIGHTNESS", "220")),
+        max_clipped_ratio=float(os.getenv("PHOTO_MAX_CLIPPED_RATIO", "0.5")),
+    )
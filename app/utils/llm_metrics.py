@@ -0,0 +1,155 @@
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LLMMetrics:
+    """
+    Registro del consumo del modelo por llamada (tokens, latencia, modelo, cache,
+    reintentos y solicitudes de cobertura), con agregados por paso del flujo, por día y por conversación.
+    """
+    def __init__(self, db_path="whatsapp_conversations.db"):
+        self.db_path = db_path
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de métricas si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS llm_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts INTEGER,
+                day TEXT,
+                wa_id TEXT,
+                conversation_id TEXT,
+                flow_step TEXT,
+                model TEXT,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                latency_ms INTEGER DEFAULT 0,
+                cost_usd REAL DEFAULT 0,
+                cache_hit INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0
+            )
+            ''')
+            # Consultas al cache de respuestas (turnos cacheables) y latencia ahorrada en cada acierto
+            c.execute("PRAGMA table_info(llm_calls)")
+            columns = [info[1] for info in c.fetchall()]
+            if 'cache_lookup' not in columns:
+                c.execute("ALTER TABLE llm_calls ADD COLUMN cache_lookup INTEGER DEFAULT 0")
+            if 'latency_saved_ms' not in columns:
+                c.execute("ALTER TABLE llm_calls ADD COLUMN latency_saved_ms INTEGER DEFAULT 0")
+            # Solicitudes de cobertura (hedging), separadas de los reintentos por error
+            if 'hedges' not in columns:
+                c.execute("ALTER TABLE llm_calls ADD COLUMN hedges INTEGER DEFAULT 0")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_conversation ON llm_calls (conversation_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_day ON llm_calls (day)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de métricas del modelo: {e}")
+
+    def record(self, wa_id, conversation_id, flow_step, model=None, prompt_tokens=0, completion_tokens=0,
+               latency_ms=0, cost_usd=0.0, cache_hit=False, retries=0, cache_lookup=False, latency_saved_ms=0, hedges=0):
+        """
+        Registra una llamada al modelo (o un acierto del cache de respuestas).
+
+        cache_lookup indica que el turno se buscó en el cache (acierto o fallo) y
+        latency_saved_ms la latencia de la llamada que evitó un acierto. retries son
+        los reintentos por error y hedges las solicitudes de cobertura duplicadas.
+        """
+        try:
+            now = time.time()
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                "INSERT INTO llm_calls (ts, day, wa_id, conversation_id, flow_step, model, prompt_tokens, "
+                "completion_tokens, latency_ms, cost_usd, cache_hit, retries, cache_lookup, latency_saved_ms, hedges) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(now), time.strftime("%Y-%m-%d", time.localtime(now)), wa_id, conversation_id, flow_step,
+                 model, prompt_tokens, completion_tokens, int(latency_ms), cost_usd, int(cache_hit), retries,
+                 int(cache_lookup or cache_hit), int(latency_saved_ms), hedges)
+            )
+            conn.commit()
+            conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"Error al registrar métricas del modelo: {e}")
+            return False
+
+    def conversation_tokens(self, conversation_id):
+        """Obtiene el total de tokens consumidos por una conversación."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM llm_calls WHERE conversation_id = ?",
+                (conversation_id,)
+            )
+            total = c.fetchone()[0]
+            conn.close()
+            return total
+        except Exception as e:
+            logger.error(f"Error al obtener tokens de la conversación: {e}")
+            return 0
+
+    def _rollup(self, group_by, limit=None, order_by=None):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        query = (
+            f"SELECT {group_by}, COUNT(*) AS calls, SUM(cache_hit) AS cache_hits, "
+            "SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens, "
+            "ROUND(AVG(CASE WHEN cache_hit = 0 THEN latency_ms END), 1) AS avg_latency_ms, "
+            "SUM(retries) AS retries, SUM(hedges) AS hedges, ROUND(SUM(cost_usd), 6) AS cost_usd "
+            f"FROM llm_calls GROUP BY {group_by} ORDER BY {order_by or group_by}"
+        )
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        c.execute(query)
+        result = [dict(row) for row in c.fetchall()]
+        conn.close()
+        return result
+
+    def rollup_by_step(self):
+        """Agregado de consumo por paso del flujo."""
+        return self._rollup("flow_step")
+
+    def rollup_by_day(self):
+        """Agregado de consumo por día."""
+        return self._rollup("day", order_by="day DESC")
+
+    def cache_stats(self):
+        """
+        Efectividad del cache de respuestas: consultas, aciertos, tasa de aciertos y
+        latencia ahorrada, en total y por paso del flujo.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(
+            "SELECT flow_step, SUM(cache_lookup) AS lookups, SUM(cache_hit) AS hits, "
+            "SUM(latency_saved_ms) AS latency_saved_ms FROM llm_calls WHERE cache_lookup = 1 "
+            "GROUP BY flow_step ORDER BY flow_step"
+        )
+        by_step = [dict(row) for row in c.fetchall()]
+        conn.close()
+        for row in by_step:
+            row["hit_rate"] = round(row["hits"] / row["lookups"], 3) if row["lookups"] else 0.0
+        lookups = sum(row["lookups"] for row in by_step)
+        hits = sum(row["hits"] for row in by_step)
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "latency_saved_ms": sum(row["latency_saved_ms"] or 0 for row in by_step),
+            "by_step": by_step,
+        }
+
+    def top_conversations(self, limit=20):
+        """Conversaciones con mayor consumo de tokens."""
+        return self._rollup("wa_id, conversation_id", limit=limit,
+                            order_by="SUM(prompt_tokens + completion_tokens) DESC")
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import shutil
+import sqlite3
+import logging
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.media_store import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Objetos de página en un PDF ("/Type /Page", no "/Type /Pages")
+PDF_PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+# Tamaño máximo de un PDF que se envía completo al procesador de documentos
+DEFAULT_MAX_TEXT_BYTES = 10 * 1024 * 1024
+
+
+def pdf_page_count(path):
+    """
+    Cuenta las páginas de un PDF sin cargarlo entero en memoria.
+
+    Usa pypdf si está instalado (dependencia opcional); si no, recorre el archivo por
+    bloques buscando los objetos de página.
+
+    Returns:
+        Número de páginas o None si no se pudo determinar
+    """
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(path).pages)
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning(f"pypdf no pudo leer {path}, se cuentan las páginas por bloques: {e}")
+
+    count = 0
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            data = tail + chunk
+            # Se cuentan las marcas que empiezan antes de los últimos 32 bytes (caben completas);
+            # el final se conserva por si una marca queda partida entre dos lecturas
+            cut = max(len(data) - 32, 0)
+            count += sum(1 for match in PDF_PAGE_PATTERN.finditer(data) if match.start() < cut)
+            tail = data[cut:]
+    count += len(PDF_PAGE_PATTERN.findall(tail))
+    return count or None
+
+
+def video_first_frame(src_path, output_path, timeout=60):
+    """
+    Extrae el primer cuadro de un video a JPEG con ffmpeg.
+
+    Returns:
+        True si se generó el cuadro (False si ffmpeg no está instalado o falla)
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return False
+    tmp_path = output_path + ".tmp.jpg"
+    try:
+        subprocess.run(
+            [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", src_path, "-frames:v", "1", "-q:v", "3", tmp_path],
+            check=True, timeout=timeout, capture_output=True
+        )
+        os.replace(tmp_path, output_path)
+        return True
+    except Exception as e:
+        logger.warning(f"No se pudo extraer el primer cuadro de {src_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def video_duration(src_path, timeout=30):
+    """Duración de un video en segundos según ffprobe (None si no está disponible)"""
+    ffprobe = shutil.which("ffprobe")
+    if not ffprobe:
+        return None
+    try:
+        result = subprocess.run(
+            [ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "json", src_path],
+            check=True, timeout=timeout, capture_output=True
+        )
+        return round(float(json.loads(result.stdout)["format"]["duration"]), 1)
+    except Exception as e:
+        logger.warning(f"No se pudo obtener la duración de {src_path}: {e}")
+        return None
+
+
+class MediaAnalyzer:
+    """
+    Análisis en segundo plano de documentos y videos ya descargados: número de
+    páginas y texto de los PDF, primer cuadro y duración de los videos. Trabaja
+    siempre desde el archivo en disco, fuera del hilo del webhook.
+    """
+
+    def __init__(self, work_dir, db_path="whatsapp_conversations.db", max_workers=2, derivatives=None,
+                 extract_text=None, max_text_bytes=DEFAULT_MAX_TEXT_BYTES, on_result=None, on_file=None):
+        """
+        Args:
+            work_dir: Directorio de los cuadros extraídos de los videos
+            db_path: Base de datos SQLite con los resultados
+            max_workers: Análisis simultáneos
+            derivatives: Generador de derivados (miniaturas del primer cuadro), opcional
+            extract_text: Función (ruta, sha256, mime) -> resultado del procesador de documentos, opcional
+            max_text_bytes: Tamaño máximo de un PDF que se envía a extract_text
+            on_result: Callback (wa_id, conversation_id, kind, handle, resultado) al terminar
+            on_file: Callback opcional (ruta, sha256, kind) por cada cuadro guardado en work_dir
+        """
+        self.work_dir = work_dir
+        self.db_path = db_path
+        self.derivatives = derivatives
+        self.extract_text = extract_text
+        self.max_text_bytes = max_text_bytes
+        self.on_result = on_result
+        self.on_file = on_file
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media-analysis")
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de análisis de medios si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS media_analysis (
+                sha256 TEXT PRIMARY KEY,
+                kind TEXT,
+                mime TEXT,
+                pages INTEGER,
+                duration REAL,
+                frame_path TEXT,
+                text_chars INTEGER,
+                error TEXT,
+                created_at TEXT
+            )
+            ''')
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de análisis de medios: {e}")
+
+    def get(self, sha256):
+        """Retorna el análisis guardado de un medio o None"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM media_analysis WHERE sha256 = ?", (sha256,))
+        row = c.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def submit(self, wa_id, conversation_id, kind, handle):
+        """
+        Encola el análisis de un documento o video ya ingerido.
+
+        Args:
+            kind: "document" o "video"
+            handle: Handle del medio (media_id, path, sha256, size, mime, url)
+
+        Returns:
+            Future con el dict de resultado
+        """
+        return self._executor.submit(self._analyze, wa_id, conversation_id, kind, handle)
+
+    def _analyze(self, wa_id, conversation_id, kind, handle):
+        mime = (handle.get("mime") or "").split(";")[0]
+        result = {"pages": None, "duration": None, "frame_path": None, "text": None, "error": None}
+        try:
+            if kind == "document" and mime == "application/pdf":
+                result["pages"] = pdf_page_count(handle["path"])
+                if self.extract_text and (handle.get("size") or 0) <= self.max_text_bytes:
+                    extraction = self.extract_text(handle["path"], handle["sha256"], mime)
+                    if extraction.get("success"):
+                        result["text"] = extraction.get("text")
+                    else:
+                        result["error"] = extraction.get("error")
+            elif kind == "video":
+                result["duration"] = video_duration(handle["path"])
+                frame_path = os.path.join(self.work_dir, f"{handle['sha256']}_frame.jpg")
+                if video_first_frame(handle["path"], frame_path):
+                    result["frame_path"] = frame_path
+                    if self.on_file:
+                        self.on_file(frame_path, handle["sha256"], "frame")
+                    # Miniatura y vista previa del cuadro, con la clave del video (/media/<sha256>?variant=thumb)
+                    if self.derivatives:
+                        self.derivatives.submit({"path": frame_path, "sha256": handle["sha256"], "mime": "image/jpeg"})
+        except Exception as e:
+            logger.error(f"Error analizando {kind} {handle.get('media_id')}: {e}", exc_info=True)
+            result["error"] = str(e)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO media_analysis "
+            "(sha256, kind, mime, pages, duration, frame_path, text_chars, error, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (handle["sha256"], kind, mime, result["pages"], result["duration"], result["frame_path"],
+             len(result["text"]) if result["text"] else None, result["error"], datetime.now().isoformat())
+        )
+        conn.commit()
+        conn.close()
+        logger.info(f"{kind.capitalize()} {handle.get('media_id')} analizado: páginas={result['pages']}, "
+                    f"duración={result['duration']}, cuadro={bool(result['frame_path'])}")
+        if self.on_result:
+            self.on_result(wa_id, conversation_id, kind, handle, result)
+        return result
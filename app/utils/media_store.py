@@ -0,0 +1,552 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import mimetypes
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+from app.services.graph_api import get_graph_api_client
+
+logger = logging.getLogger(__name__)
+
+# Extensiones preferidas para los tipos MIME habituales de WhatsApp
+MIME_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "audio/ogg": ".ogg",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+    "audio/aac": ".aac",
+    "application/pdf": ".pdf",
+    "video/mp4": ".mp4",
+    "video/3gpp": ".3gp",
+}
+
+# Tamaño de cada bloque leído durante la descarga en streaming
+CHUNK_SIZE = 64 * 1024
+# Tamaño máximo por defecto de un medio (WhatsApp admite audios de hasta 16MB)
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class MediaTooLargeError(Exception):
+    """El medio supera el tamaño máximo permitido."""
+
+
+def extension_for_mime(mime):
+    """Retorna la extensión de archivo para un tipo MIME (".bin" si no se conoce)"""
+    mime = (mime or "").split(";")[0].strip().lower()
+    return MIME_EXTENSIONS.get(mime) or mimetypes.guess_extension(mime) or ".bin"
+
+
+def read_media_bytes(handle):
+    """
+    Lee los bytes de un medio ya ingerido a partir de su handle.
+
+    Returns:
+        Bytes del archivo o b"" si el handle no tiene copia local
+    """
+    path = (handle or {}).get("path")
+    if not path or not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def file_sha256(path):
+    """Calcula el sha256 de un archivo leyéndolo por bloques"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def stream_to_file(url, part_path, headers=None, max_bytes=DEFAULT_MAX_BYTES, timeout=15, resume=True):
+    """
+    Descarga una URL en streaming hacia part_path, por bloques y sin cargar el
+    archivo completo en memoria, calculando el sha256 a medida que llega.
+
+    Si part_path ya existe (una descarga anterior interrumpida) se pide el resto con
+    un header Range; si el servidor no lo soporta, se descarga desde el inicio.
+    Al terminar, el archivo queda completo en part_path y el llamador lo renombra.
+
+    Args:
+        url: URL a descargar
+        part_path: Ruta del archivo parcial
+        headers: Headers adicionales (p. ej. Authorization)
+        max_bytes: Tamaño máximo permitido; si se supera se borra el parcial
+        timeout: Timeout de conexión y de lectura de cada bloque
+        resume: Retoma la descarga parcial si existe
+    
+    Returns:
+        Dict con sha256, size y mime
+    
+    Raises:
+        MediaTooLargeError: Si el medio supera max_bytes
+    """
+    headers = dict(headers or {})
+    offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    hasher = hashlib.sha256()
+    # Sesión compartida con la Graph API: las descargas reutilizan conexiones keep-alive
+    with get_graph_api_client().download(url, headers=headers, stream=True, timeout=timeout) as response:
+        if offset and response.status_code == 206:
+            mode = "ab"
+            with open(part_path, "rb") as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    hasher.update(block)
+            logger.info(f"Retomando descarga de {part_path} desde el byte {offset}")
+        else:
+            response.raise_for_status()
+            mode, offset = "wb", 0
+
+        mime = response.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip()
+        expected = response.headers.get("Content-Length")
+        if expected and expected.isdigit() and offset + int(expected) > max_bytes:
+            _discard(part_path)
+            raise MediaTooLargeError(f"El medio anuncia {offset + int(expected)} bytes (máximo {max_bytes})")
+
+        size = offset
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    f.close()
+                    _discard(part_path)
+                    raise MediaTooLargeError(f"El medio supera el máximo de {max_bytes} bytes")
+                f.write(chunk)
+                hasher.update(chunk)
+
+    return {"sha256": hasher.hexdigest(), "size": size, "mime": mime}
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class MediaUrlCache:
+    """
+    Cache en memoria de la resolución media_id -> URL de descarga de la Graph API.
+
+    Las URLs de WhatsApp son temporales: cada entrada vence con el parámetro "ext"
+    de la URL (menos un margen) o, si no viene, tras ttl_seconds. Se desaloja por
+    LRU al superar max_entries.
+    """
+
+    def __init__(self, ttl_seconds=240, max_entries=1000, expiry_margin_seconds=30):
+        """
+        Args:
+            ttl_seconds: Vigencia de una entrada cuando la URL no indica su expiración
+            max_entries: Número máximo de entradas antes de desalojar por LRU
+            expiry_margin_seconds: Margen antes de la expiración real de la URL
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expires_at(self, url):
+        now = time.time()
+        try:
+            ext = parse_qs(urlparse(url).query).get("ext", [None])[0]
+            if ext and ext.isdigit():
+                return min(int(ext) - self.expiry_margin_seconds, now + self.ttl_seconds)
+        except ValueError:
+            pass
+        return now + self.ttl_seconds
+
+    def get(self, media_id):
+        """Retorna los datos resueltos del medio (url, mime_type, ...) o None si no hay o vencieron"""
+        with self._lock:
+            entry = self._entries.get(media_id)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[media_id]
+                return None
+            self._entries.move_to_end(media_id)
+            return data
+
+    def put(self, media_id, data):
+        """Guarda la respuesta de la Graph API para un medio"""
+        if not data or not data.get("url"):
+            return
+        with self._lock:
+            self._entries[media_id] = (data, self._expires_at(data["url"]))
+            self._entries.move_to_end(media_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, media_id):
+        """Elimina la entrada de un medio (p. ej. si la descarga con su URL falló)"""
+        with self._lock:
+            self._entries.pop(media_id, None)
+
+
+class MediaIngestor:
+    """
+    Etapa única de ingesta de medios de WhatsApp.
+
+    Cada media_id se descarga una sola vez: los bytes se guardan en disco con su
+    hash como nombre y se entrega un handle compartido (media_id, path, sha256,
+    size, mime, url) al proxy del dashboard, al turno del modelo y al archivado en
+    la nube, que ya no vuelven a llamar a la URL temporal de WhatsApp.
+
+    El directorio funciona como cache local con cuota: los medios ya archivados y
+    usados hace más tiempo se desalojan (según el índice, sin recorrer el directorio)
+    y se recuperan del almacenamiento de objetos cuando se vuelven a pedir. Los
+    archivos derivados (miniaturas, variantes normalizadas, cuadros de video, audios
+    normalizados) se registran con register_file en la tabla media_files, cuentan en
+    la misma cuota y se desalojan antes que los originales porque se pueden regenerar.
+    """
+
+    def __init__(self, media_dir="whatsapp_images", db_path="whatsapp_conversations.db", timeout=15,
+                 max_bytes=DEFAULT_MAX_BYTES, max_attempts=3, quota_bytes=0, restore=None):
+        """
+        Args:
+            media_dir: Directorio local donde se guardan los medios (raíz única de la cache local)
+            db_path: Base de datos SQLite con el índice de medios
+            timeout: Timeout en segundos de la descarga
+            max_bytes: Tamaño máximo aceptado por medio
+            max_attempts: Intentos de descarga (los siguientes retoman el parcial)
+            quota_bytes: Espacio máximo de los medios en disco (0 = sin límite)
+            restore: Función (sha256, ruta_destino) -> tipo MIME del objeto recuperado (o None)
+                que recupera un medio desalojado desde el almacenamiento de objetos
+        """
+        self.media_dir = media_dir
+        self.db_path = db_path
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.quota_bytes = quota_bytes
+        self.restore = restore
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._quota_lock = threading.Lock()
+        os.makedirs(self.media_dir, exist_ok=True)
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla de medios ingeridos si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS media (
+                media_id TEXT PRIMARY KEY,
+                sha256 TEXT,
+                path TEXT,
+                size INTEGER,
+                mime TEXT,
+                url TEXT,
+                created_at TEXT
+            )
+            ''')
+            # Columnas de la cache local: último acceso (LRU) y si el archivo fue desalojado
+            c.execute("PRAGMA table_info(media)")
+            columns = [info[1] for info in c.fetchall()]
+            if 'last_access' not in columns:
+                c.execute("ALTER TABLE media ADD COLUMN last_access REAL")
+            if 'evicted' not in columns:
+                c.execute("ALTER TABLE media ADD COLUMN evicted BOOLEAN DEFAULT 0")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_media_sha256 ON media (sha256)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_media_lru ON media (evicted, last_access)")
+            # Archivos derivados bajo la cache local (kind: derivative, frame, audio_normalized, restored)
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS media_files (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT,
+                kind TEXT,
+                size INTEGER,
+                created_at TEXT,
+                last_access REAL
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_media_files_sha256 ON media_files (sha256, kind)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar la tabla de medios: {e}")
+
+    def _lock_for(self, media_id):
+        with self._locks_lock:
+            return self._locks.setdefault(media_id, threading.Lock())
+
+    def _find(self, column, value):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(f"SELECT media_id, path, sha256, size, mime, url, evicted FROM media WHERE {column} = ? LIMIT 1",
+                  (value,))
+        row = c.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def _touch(self, sha256):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE media SET last_access = ? WHERE sha256 = ?", (time.time(), sha256))
+        conn.commit()
+        conn.close()
+
+    def register_file(self, path, sha256, kind):
+        """
+        Registra un archivo derivado de un medio para que cuente en la cuota de la cache.
+
+        Args:
+            path: Ruta del archivo derivado
+            sha256: sha256 del medio original
+            kind: Tipo de derivado ("derivative", "frame", "audio_normalized", "restored")
+        """
+        if not path or not os.path.exists(path):
+            return
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO media_files (path, sha256, kind, size, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, sha256, kind, os.path.getsize(path), datetime.now().isoformat(), time.time())
+        )
+        conn.commit()
+        conn.close()
+        self.enforce_quota()
+
+    def _restored_variant(self, row):
+        """Handle de la variante recuperada de un medio desalojado, si está en disco (o None)"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT path, size FROM media_files WHERE sha256 = ? AND kind = 'restored' LIMIT 1",
+                  (row["sha256"],))
+        found = c.fetchone()
+        if found and os.path.exists(found[0]):
+            conn.execute("UPDATE media_files SET last_access = ? WHERE path = ?", (time.time(), found[0]))
+            conn.commit()
+        conn.close()
+        if not found or not os.path.exists(found[0]):
+            return None
+        mime = mimetypes.guess_type(found[0])[0] or "application/octet-stream"
+        return dict(row, path=found[0], size=found[1], mime=mime, variant="restored")
+
+    def _ensure_local(self, row):
+        """Retorna el handle con el archivo en disco, recuperándolo si fue desalojado (None si no se puede)"""
+        evicted = row.pop("evicted", 0)
+        if not os.path.exists(row["path"]):
+            if not (evicted and self.restore):
+                return None
+            with self._lock_for(row["sha256"]):
+                if not os.path.exists(row["path"]):
+                    return self._restored_variant(row) or self._restore(row)
+        self._touch(row["sha256"])
+        return row
+
+    def _restore(self, row):
+        """
+        Recupera un medio desalojado desde el almacenamiento de objetos.
+
+        Si el objeto archivado tiene los mismos bytes que el original vuelve a su ruta
+        <sha256>.<ext>. Si es otra versión (p. ej. el JPEG normalizado que se archiva de
+        cada foto) se guarda en su propia ruta y fila de media_files, y la fila del
+        medio sigue desalojada: el sha256, el tamaño y el MIME del original no cambian.
+
+        Returns:
+            Handle del medio (con variant="restored" si es otra versión) o None
+        """
+        part_path = row["path"] + ".part"
+        try:
+            mime = self.restore(row["sha256"], part_path)
+            if not mime:
+                return None
+            if file_sha256(part_path) == row["sha256"]:
+                os.replace(part_path, row["path"])
+            else:
+                variant_path = os.path.join(self.media_dir, f"{row['sha256']}_restored{extension_for_mime(mime)}")
+                os.replace(part_path, variant_path)
+        except Exception as e:
+            logger.error(f"No se pudo recuperar el medio desalojado {row['sha256'][:12]}: {e}")
+            _discard(part_path)
+            return None
+
+        if os.path.exists(row["path"]):
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("UPDATE media SET evicted = 0, last_access = ? WHERE sha256 = ?",
+                         (time.time(), row["sha256"]))
+            conn.commit()
+            conn.close()
+            logger.info(f"Medio {row['sha256'][:12]} recuperado del almacenamiento de objetos")
+            self.enforce_quota()
+            return row
+        logger.info(f"Medio {row['sha256'][:12]} recuperado como versión archivada ({mime}) en {variant_path}")
+        self.register_file(variant_path, row["sha256"], "restored")
+        return dict(row, path=variant_path, size=os.path.getsize(variant_path), mime=mime, variant="restored")
+
+    def get(self, media_id):
+        """
+        Retorna el handle de un medio ya ingerido (o None si no existe). Si el archivo
+        fue desalojado de la cache local se recupera de forma transparente.
+        """
+        row = self._find("media_id", media_id)
+        return self._ensure_local(row) if row else None
+
+    def get_by_sha256(self, sha256):
+        """Igual que get, buscando el medio por su sha256 (p. ej. al servir /media/files)"""
+        row = self._find("sha256", sha256)
+        return self._ensure_local(row) if row else None
+
+    def enforce_quota(self):
+        """
+        Desaloja de la cache local los archivos usados hace más tiempo hasta volver al 90%
+        de la cuota. Primero los derivados de media_files, que se regeneran o se vuelven a
+        recuperar; después los originales que ya están en el almacenamiento de objetos
+        (tabla archived_objects), por lo que siempre se pueden recuperar.
+
+        Returns:
+            Bytes liberados
+        """
+        if not self.quota_bytes:
+            return 0
+        with self._quota_lock:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                c = conn.cursor()
+                # Un mismo archivo puede corresponder a varios media_id: se cuenta una vez por sha256
+                c.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                          "(SELECT MAX(size) AS size FROM media WHERE evicted = 0 GROUP BY sha256)")
+                used = c.fetchone()[0]
+                c.execute("SELECT COALESCE(SUM(size), 0) FROM media_files")
+                used += c.fetchone()[0]
+                if used <= self.quota_bytes:
+                    return 0
+                target = int(self.quota_bytes * 0.9)
+                freed = 0
+                c.execute("SELECT path, size FROM media_files ORDER BY COALESCE(last_access, 0)")
+                for path, size in c.fetchall():
+                    if used - freed <= target:
+                        break
+                    _discard(path)
+                    c.execute("DELETE FROM media_files WHERE path = ?", (path,))
+                    freed += size or 0
+                try:
+                    c.execute(
+                        "SELECT sha256, path, MAX(size), MAX(COALESCE(last_access, 0)) AS last_access FROM media "
+                        "WHERE evicted = 0 AND sha256 IN (SELECT sha256 FROM archived_objects) "
+                        "GROUP BY sha256 ORDER BY last_access"
+                    )
+                    candidates = c.fetchall()
+                except sqlite3.OperationalError:
+                    # Sin archivado configurado no hay nada que se pueda recuperar después
+                    candidates = []
+                for sha256, path, size, _ in candidates:
+                    if used - freed <= target:
+                        break
+                    _discard(path)
+                    c.execute("UPDATE media SET evicted = 1 WHERE sha256 = ?", (sha256,))
+                    freed += size or 0
+                conn.commit()
+            finally:
+                conn.close()
+            if freed:
+                logger.info(f"Cache de medios: {freed / 1024 / 1024:.1f}MB desalojados "
+                            f"({(used - freed) / 1024 / 1024:.1f}MB de {self.quota_bytes / 1024 / 1024:.1f}MB)")
+            elif used - freed > self.quota_bytes:
+                logger.warning(f"Cache de medios sobre la cuota ({used / 1024 / 1024:.1f}MB) "
+                               "y sin medios archivados para desalojar")
+            return freed
+
+    def ingest(self, media_id, url, access_token=None, max_bytes=None):
+        """
+        Descarga un medio una sola vez y retorna su handle.
+
+        Si el media_id ya fue ingerido (p. ej. un reintento del webhook) se retorna el
+        handle existente sin volver a descargar.
+
+        Args:
+            media_id: ID del medio en WhatsApp
+            url: URL temporal de descarga entregada por la Graph API
+            access_token: Token de acceso para la API de WhatsApp
+            max_bytes: Tamaño máximo para este medio (por defecto el del ingestor)
+
+        Returns:
+            Dict con media_id, path, sha256, size, mime y url, o None si falla la descarga
+        """
+        with self._lock_for(media_id):
+            handle = self.get(media_id)
+            if handle:
+                logger.info(f"Medio {media_id} ya ingerido, se reutiliza {handle['path']}")
+                return handle
+
+            headers = {"Authorization": f"Bearer {access_token}"} if access_token else {}
+            part_path = os.path.join(self.media_dir, re.sub(r"[^\w.-]", "_", str(media_id)) + ".part")
+            info = None
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    logger.info(f"Descargando medio {media_id} (intento {attempt})")
+                    info = stream_to_file(url, part_path, headers=headers, max_bytes=max_bytes or self.max_bytes,
+                                          timeout=self.timeout)
+                    break
+                except MediaTooLargeError as e:
+                    logger.error(f"Medio {media_id} descartado: {e}")
+                    return None
+                except Exception as e:
+                    logger.warning(f"Descarga del medio {media_id} interrumpida: {e}")
+            if info is None:
+                logger.error(f"No se pudo descargar el medio {media_id} tras {self.max_attempts} intento(s)")
+                return None
+
+            sha256, size, mime = info["sha256"], info["size"], info["mime"]
+            path = os.path.join(self.media_dir, sha256 + extension_for_mime(mime))
+            # Contenido direccionado por hash: el renombrado es atómico y un duplicado no se reescribe
+            if os.path.exists(path):
+                _discard(part_path)
+            else:
+                os.replace(part_path, path)
+
+            handle = {
+                "media_id": media_id,
+                "path": path,
+                "sha256": sha256,
+                "size": size,
+                "mime": mime,
+                "url": url,
+            }
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO media (media_id, sha256, path, size, mime, url, created_at, last_access, evicted) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (media_id, sha256, path, size, mime, url, datetime.now().isoformat(), time.time())
+            )
+            # El archivo vuelve a estar en disco también para otros media_id con el mismo contenido
+            conn.execute("UPDATE media SET evicted = 0 WHERE sha256 = ?", (sha256,))
+            conn.commit()
+            conn.close()
+            logger.info(f"Medio {media_id} guardado en {path} ({size / 1024:.1f}KB, {mime})")
+        self.enforce_quota()
+        return handle
+
+
+def create_media_ingestor_from_env(restore=None):
+    """
+    Crea el ingestor de medios a partir de las variables de entorno.
+
+    Args:
+        restore: Función (sha256, ruta_destino) -> bool para recuperar medios desalojados
+    """
+    return MediaIngestor(
+        media_dir=os.getenv("MEDIA_STORAGE_DIR", "whatsapp_images"),
+        timeout=float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT_SECONDS", "15")),
+        max_bytes=int(os.getenv("MEDIA_MAX_BYTES", str(DEFAULT_MAX_BYTES))),
+        quota_bytes=int(float(os.getenv("MEDIA_CACHE_QUOTA_MB", "0")) * 1024 * 1024),
+        restore=restore,
+    )
@@ -0,0 +1,135 @@
+import os
+import json
+import logging
+import threading
+
+from app.utils.flow_state import normalize_text
+
+logger = logging.getLogger(__name__)
+
+FAST_TIER = "fast"
+LARGE_TIER = "large"
+
+# Precios en USD por millón de tokens (entrada, salida). Se pueden sobrescribir con OPENAI_MODEL_PRICES
+DEFAULT_MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "output": 10.00},
+    "gpt-4-turbo-preview": {"input": 10.00, "output": 30.00},
+}
+
+# Pasos del flujo donde hay que validar información completa y conviene el modelo grande
+DEFAULT_LARGE_STEPS = {"registration", "complete"}
+
+# Tipos de mensaje que solo requieren un acuse de recibo y el siguiente paso del guion
+DEFAULT_FAST_TYPES = {"image", "location", "audio"}
+
+
+class ModelRouter:
+    """
+    Selecciona el nivel de modelo (rápido o grande) para cada turno según el tipo
+    de mensaje, el paso del flujo y la longitud del mensaje. Lleva las métricas de
+    latencia y costo por nivel para poder ajustar los umbrales.
+    """
+
+    def __init__(self, fast_model, large_model, max_fast_chars=60, large_steps=None,
+                 fast_types=None, prices=None):
+        """
+        Inicializa el router.
+
+        Args:
+            fast_model: Modelo de baja latencia para turnos simples
+            large_model: Modelo grande para turnos complejos y escalamientos
+            max_fast_chars: Longitud máxima del mensaje normalizado para usar el modelo rápido
+            large_steps: Pasos del flujo que siempre usan el modelo grande
+            fast_types: Tipos de mensaje que usan el modelo rápido
+            prices: Dict modelo -> {"input": usd, "output": usd} por millón de tokens
+        """
+        self.models = {FAST_TIER: fast_model, LARGE_TIER: large_model}
+        self.max_fast_chars = max_fast_chars
+        self.large_steps = set(large_steps if large_steps is not None else DEFAULT_LARGE_STEPS)
+        self.fast_types = set(fast_types if fast_types is not None else DEFAULT_FAST_TYPES)
+        self.prices = dict(DEFAULT_MODEL_PRICES, **(prices or {}))
+        self._lock = threading.Lock()
+        self._stats = {
+            tier: {"calls": 0, "escalations": 0, "latency_ms": 0.0, "prompt_tokens": 0,
+                   "completion_tokens": 0, "cost_usd": 0.0}
+            for tier in self.models
+        }
+
+    def select_tier(self, message_type, flow_step, user_message=None):
+        """Retorna el nivel de modelo para el turno"""
+        if flow_step in self.large_steps:
+            return LARGE_TIER
+        if message_type in self.fast_types:
+            return FAST_TIER
+        if message_type == "text" and len(normalize_text(user_message)) <= self.max_fast_chars:
+            return FAST_TIER
+        return LARGE_TIER
+
+    def model_for(self, tier):
+        """Retorna el nombre del modelo para un nivel"""
+        return self.models.get(tier, self.models[LARGE_TIER])
+
+    def estimate_cost(self, model, prompt_tokens, completion_tokens):
+        """Calcula el costo en USD de una llamada según la tabla de precios"""
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        return (prompt_tokens * price["input"] + completion_tokens * price["output"]) / 1_000_000
+
+    def record(self, tier, latency_ms, prompt_tokens=0, completion_tokens=0, escalated=False):
+        """
+        Registra una llamada al modelo del nivel indicado.
+
+        Returns:
+            Costo estimado de la llamada en USD
+        """
+        cost = self.estimate_cost(self.model_for(tier), prompt_tokens, completion_tokens)
+        with self._lock:
+            stats = self._stats.setdefault(tier, {"calls": 0, "escalations": 0, "latency_ms": 0.0,
+                                                  "prompt_tokens": 0, "completion_tokens": 0,
+                                                  "cost_usd": 0.0})
+            stats["calls"] += 1
+            stats["escalations"] += int(escalated)
+            stats["latency_ms"] += latency_ms
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cost_usd"] += cost
+        return cost
+
+    def stats(self):
+        """Retorna latencia promedio, tokens y costo acumulado por nivel"""
+        with self._lock:
+            result = {}
+            for tier, stats in self._stats.items():
+                calls = stats["calls"]
+                result[tier] = {
+                    "model": self.model_for(tier),
+                    "calls": calls,
+                    "escalations": stats["escalations"],
+                    "avg_latency_ms": round(stats["latency_ms"] / calls, 1) if calls else 0.0,
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "completion_tokens": stats["completion_tokens"],
+                    "cost_usd": round(stats["cost_usd"], 6),
+                }
+        return result
+
+
+def create_model_router_from_env():
+    """Crea el router de modelos a partir de las variables de entorno"""
+    prices = {}
+    raw_prices = os.getenv("OPENAI_MODEL_PRICES", "")
+    if raw_prices:
+        try:
+            prices = json.loads(raw_prices)
+        except ValueError:
+            logger.warning("OPENAI_MODEL_PRICES no es un JSON válido, se usan los precios por defecto")
+
+    large_steps = os.getenv("MODEL_ROUTER_LARGE_STEPS")
+    return ModelRouter(
+        fast_model=os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini"),
+        large_model=os.getenv("OPENAI_LARGE_MODEL", "gpt-4-turbo-preview"),
+        max_fast_chars=int(os.getenv("MODEL_ROUTER_MAX_FAST_CHARS", "60")),
+        large_steps=[s.strip() for s in large_steps.split(",") if s.strip()] if large_steps else None,
+        prices=prices,
+    )
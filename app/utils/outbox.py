@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENDING = "sending"
+DELIVERED = "delivered"
+DEAD = "dead"
+
+# Respuestas de la Graph API que se reintentan (límite de throughput y errores del servidor)
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Limitador de tasa por número de WhatsApp: rate mensajes por segundo con
+    ráfagas de hasta capacity. pause() vacía el cubo tras un 429 de Meta.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Espera hasta obtener un token"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Detiene los envíos del número durante seconds segundos"""
+        with self._lock:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def retry_after_seconds(response):
+    """Segundos indicados en el header Retry-After (en segundos o como fecha), o None"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class MessageOutbox:
+    """
+    Cola persistente de los mensajes salientes de WhatsApp.
+
+    Cada mensaje se guarda antes de enviarse y un despachador lo entrega respetando
+    el orden por destinatario (el siguiente mensaje de un usuario espera a que el
+    anterior se entregue o se descarte), con un token bucket por PHONE_NUMBER_ID.
+    Los 429 y 5xx se reintentan con backoff exponencial; los mensajes que agotan
+    los intentos o que Meta rechaza (4xx) pasan a la cola de fallidos ("dead").
+    """
+
+    def __init__(self, send_fn=None, db_path="whatsapp_conversations.db", rate_per_second=20.0, burst=20,
+                 max_attempts=6, base_delay=2.0, max_delay=300.0, poll_interval=1.0, max_workers=4,
+                 on_dead_letter=None):
+        """
+        Args:
+            send_fn: Función (payload, phone_number_id) -> requests.Response que hace el envío real
+                (None si el proceso solo encola, como el dashboard)
+            db_path: Base de datos SQLite del outbox
+            rate_per_second: Mensajes por segundo por número (tier de throughput de Meta)
+            burst: Ráfaga máxima por número
+            max_attempts: Intentos antes de pasar el mensaje a fallidos
+            base_delay: Espera del primer reintento, en segundos (se duplica en cada intento)
+            max_delay: Espera máxima entre reintentos
+            poll_interval: Cada cuánto se revisa la tabla (mensajes encolados por otros procesos)
+            max_workers: Envíos simultáneos (siempre a destinatarios distintos)
+            on_dead_letter: Callback (mensaje) cuando un mensaje pasa a fallidos
+        """
+        self.send_fn = send_fn
+        self.db_path = db_path
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.max_workers = max_workers
+        self.on_dead_letter = on_dead_letter
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._executor = None
+        self._started = False
+        self.init_db()
+
+    def init_db(self):
+        """Inicializa la tabla del outbox si no existe."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            c = conn.cursor()
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS outbox_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wa_id TEXT,
+                phone_number_id TEXT,
+                kind TEXT,
+                payload TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_status INTEGER,
+                last_error TEXT,
+                whatsapp_message_id TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox_messages (status, wa_id, id)")
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error al inicializar el outbox de mensajes: {e}")
+
+    def enqueue(self, payload, wa_id, phone_number_id, kind="text"):
+        """
+        Guarda un mensaje para su envío.
+
+        Args:
+            payload: Payload de la Graph API (dict o JSON serializado)
+            wa_id: Destinatario (define el orden de entrega)
+            phone_number_id: Número de WhatsApp que envía
+            kind: Tipo de mensaje ("text", "image", "typing"...)
+
+        Returns:
+            ID del mensaje en el outbox
+        """
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO outbox_messages (wa_id, phone_number_id, kind, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (wa_id, phone_number_id, kind, payload if isinstance(payload, str) else json.dumps(payload), now, now)
+            )
+            conn.commit()
+            outbox_id = c.lastrowid
+        finally:
+            conn.close()
+        self._wake.set()
+        return outbox_id
+
+    def _bucket(self, phone_number_id):
+        with self._buckets_lock:
+            if phone_number_id not in self._buckets:
+                self._buckets[phone_number_id] = TokenBucket(self.rate_per_second, self.burst)
+            return self._buckets[phone_number_id]
+
+    def _claim_due(self, limit):
+        """
+        Reclama el primer mensaje pendiente de cada destinatario que ya toca enviar.
+        Un destinatario con un mensaje en envío o en espera de reintento no avanza.
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level="IMMEDIATE")
+        conn.row_factory = sqlite3.Row
+        try:
+            c = conn.cursor()
+            c.execute(
+                "SELECT o.* FROM outbox_messages o JOIN ("
+                "  SELECT wa_id, MIN(id) AS head_id FROM outbox_messages "
+                "  WHERE status IN ('pending', 'sending') GROUP BY wa_id"
+                ") h ON o.id = h.head_id "
+                "WHERE o.status = 'pending' AND o.next_attempt_at <= ? ORDER BY o.id LIMIT ?",
+                (time.time(), limit)
+            )
+            messages = [dict(row) for row in c.fetchall()]
+            c.executemany(
+                "UPDATE outbox_messages SET status = 'sending', updated_at = ? WHERE id = ?",
+                [(datetime.now().isoformat(), message["id"]) for message in messages]
+            )
+            conn.commit()
+            return messages
+        finally:
+            conn.close()
+
+    def _update(self, outbox_id, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute(f"UPDATE outbox_messages SET {columns} WHERE id = ?", (*fields.values(), outbox_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _backoff(self, attempts, retry_after=None):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        delay = delay * random.uniform(0.8, 1.2)
+        return max(delay, retry_after or 0.0)
+
+    def _deliver(self, message):
+        """Envía un mensaje reclamado y registra el resultado"""
+        attempts = message["attempts"] + 1
+        response, error = None, None
+        self._bucket(message["phone_number_id"]).acquire()
+        try:
+            response = self.send_fn(message["payload"], message["phone_number_id"])
+        except Exception as e:
+            error = str(e)
+
+        if response is not None and response.status_code < 300:
+            try:
+                whatsapp_message_id = (response.json().get("messages") or [{}])[0].get("id")
+            except ValueError:
+                whatsapp_message_id = None
+            self._update(message["id"], status=DELIVERED, attempts=attempts, last_status=response.status_code,
+                         last_error=None, whatsapp_message_id=whatsapp_message_id)
+            self._wake.set()
+            return
+
+        status_code = response.status_code if response is not None else None
+        if response is not None:
+            error = response.text[:500]
+        retry_after = retry_after_seconds(response)
+        if status_code == 429:
+            # Se superó el tier de throughput del número: se frenan todos sus envíos
+            self._bucket(message["phone_number_id"]).pause(retry_after or self.base_delay)
+
+        # Los indicadores de escritura no sirven si llegan tarde: no se reintentan
+        retryable = message["kind"] != "typing" and (status_code is None or status_code in RETRYABLE_STATUS)
+        if retryable and attempts < self.max_attempts:
+            delay = self._backoff(attempts, retry_after)
+            logger.warning(f"Envío {message['id']} a {message['wa_id']} falló ({status_code or error}); "
+                           f"reintento {attempts + 1}/{self.max_attempts} en {delay:.1f}s")
+            self._update(message["id"], status=PENDING, attempts=attempts, last_status=status_code,
+                         last_error=error, next_attempt_at=time.time() + delay)
+            return
+
+        logger.error(f"Mensaje {message['id']} a {message['wa_id']} pasa a fallidos tras {attempts} intento(s): "
+                     f"{status_code or ''} {error}")
+        self._update(message["id"], status=DEAD, attempts=attempts, last_status=status_code, last_error=error)
+        # El siguiente mensaje del destinatario ya puede salir
+        self._wake.set()
+        if self.on_dead_letter:
+            try:
+                self.on_dead_letter(dict(message, attempts=attempts, last_status=status_code, last_error=error))
+            except Exception as e:
+                logger.error(f"Error en el callback de mensajes fallidos: {e}")
+
+    def start(self, app_context=None):
+        """
+        Inicia el despachador en un hilo. Los mensajes que quedaron en envío cuando
+        se detuvo el proceso vuelven a la cola.
+
+        Args:
+            app_context: Callable que retorna el contexto en el que corre send_fn (p. ej. app.app_context)
+        """
+        if self._started or not self.send_fn:
+            return
+        self._started = True
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE outbox_messages SET status = 'pending' WHERE status = 'sending'")
+        conn.commit()
+        conn.close()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="outbox-send")
+
+        def run(message):
+            try:
+                with (app_context() if app_context else nullcontext()):
+                    self._deliver(message)
+            except Exception as e:
+                logger.error(f"Error enviando el mensaje {message['id']} del outbox: {e}", exc_info=True)
+                self._update(message["id"], status=PENDING, next_attempt_at=time.time() + self.base_delay)
+
+        def dispatcher():
+            in_flight = set()
+            lock = threading.Lock()
+
+            def done(outbox_id):
+                with lock:
+                    in_flight.discard(outbox_id)
+                self._wake.set()
+
+            while True:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                try:
+                    with lock:
+                        free = self.max_workers - len(in_flight)
+                    if free <= 0:
+                        continue
+                    for message in self._claim_due(free):
+                        with lock:
+                            in_flight.add(message["id"])
+                        future = self._executor.submit(run, message)
+                        future.add_done_callback(lambda _, outbox_id=message["id"]: done(outbox_id))
+                except Exception as e:
+                    logger.error(f"Error en el despachador del outbox: {e}", exc_info=True)
+
+        threading.Thread(target=dispatcher, name="outbox-dispatcher", daemon=True).start()
+        logger.info(f"Outbox de mensajes activo ({self.rate_per_second} msg/s por número, ráfaga {self.burst})")
+
+    def retry(self, outbox_id):
+        """Devuelve un mensaje fallido a la cola"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE outbox_messages SET status = 'pending', attempts = 0, next_attempt_at = 0, updated_at = ? "
+                "WHERE id = ? AND status = 'dead'",
+                (datetime.now().isoformat(), outbox_id)
+            )
+            conn.commit()
+            requeued = c.rowcount > 0
+        finally:
+            conn.close()
+        self._wake.set()
+        return requeued
+
+    def counts(self):
+        """Número de mensajes por estado"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT status, COUNT(*) FROM outbox_messages GROUP BY status")
+            counts = {PENDING: 0, SENDING: 0, DELIVERED: 0, DEAD: 0}
+            counts.update(dict(c.fetchall()))
+            return counts
+        finally:
+            conn.close()
+
+    def oldest_pending_seconds(self):
+        """Antigüedad en segundos del mensaje pendiente (o en envío) más antiguo, o None si no hay"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT MIN(created_at) FROM outbox_messages WHERE status IN (?, ?)", (PENDING, SENDING))
+            oldest = c.fetchone()[0]
+        finally:
+            conn.close()
+        if not oldest:
+            return None
+        return max((datetime.now() - datetime.fromisoformat(oldest)).total_seconds(), 0.0)
+
+    def list_messages(self, statuses, limit=100):
+        """Mensajes en los estados indicados, los más recientes primero"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            c = conn.cursor()
+            c.execute(
+                f"SELECT id, wa_id, kind, status, attempts, last_status, last_error, whatsapp_message_id, "
+                f"created_at, updated_at FROM outbox_messages WHERE status IN ({', '.join('?' for _ in statuses)}) "
+                f"ORDER BY id DESC LIMIT ?",
+                (*statuses, limit)
+            )
+            return [dict(row) for row in c.fetchall()]
+        finally:
+            conn.close()
+
+
+def create_message_outbox_from_env(send_fn=None, on_dead_letter=None, db_path="whatsapp_conversations.db"):
+    """Crea el outbox de mensajes a partir de las variables de entorno"""
+    return MessageOutbox(
+        send_fn=send_fn,
+        db_path=db_path,
+        rate_per_second=float(os.getenv("OUTBOX_RATE_PER_SECOND", "20")),
+        burst=int(os.getenv("OUTBOX_BURST", "20")),
+        max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6")),
+        base_delay=float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "2")),
+        max_delay=float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "300")),
+        poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "1")),
+        max_workers=int(os.getenv("OUTBOX_WORKERS", "4")),
+        on_dead_letter=on_dead_letter,
+    )
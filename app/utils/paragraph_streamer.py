@@ -0,0 +1,98 @@
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FENCE = "```"
+PARAGRAPH_BREAK = "\n\n"
+
+
+def clean_visible_text(text):
+    """Elimina marcas técnicas ([DEBUG: ...], [INTERNAL: ...]) del texto visible"""
+    text = re.sub(r'\[DEBUG:.*?\]', '', text)
+    text = re.sub(r'\[INTERNAL:.*?\]', '', text)
+    # Espacios dobles que quedan donde se retiró un bloque o una marca
+    text = re.sub(r'[ \t]{2,}', ' ', text)
+    return text.strip()
+
+
+class ParagraphStreamer:
+    """
+    Agrupa los fragmentos de una respuesta en streaming en párrafos completos y los
+    entrega a un callback en cuanto terminan. Los bloques de código (incluidos los
+    ```json) se retiran del texto visible a medida que llegan; el primer bloque
+    JSON válido queda disponible en `json_data`.
+    """
+
+    def __init__(self, on_paragraph):
+        """
+        Args:
+            on_paragraph: Función que recibe cada párrafo limpio a enviar
+        """
+        self.on_paragraph = on_paragraph
+        self.json_data = {}
+        self.paragraphs = []
+        self._buffer = ""
+        self._paragraph = ""
+        self._in_fence = False
+
+    def feed(self, delta):
+        """Agrega un fragmento de texto y entrega los párrafos que se completen"""
+        if delta:
+            self._buffer += delta
+            self._drain()
+
+    def finish(self):
+        """
+        Entrega el último párrafo pendiente.
+
+        Returns:
+            Texto visible completo (párrafos entregados separados por línea en blanco)
+        """
+        self._drain()
+        if self._in_fence:
+            # Bloque de código sin cerrar: nunca se muestra al usuario
+            self._buffer = ""
+        self._emit(self._paragraph + self._buffer)
+        self._buffer = self._paragraph = ""
+        return PARAGRAPH_BREAK.join(self.paragraphs)
+
+    def _drain(self):
+        while True:
+            if self._in_fence:
+                end = self._buffer.find(FENCE)
+                if end == -1:
+                    return
+                self._capture_code_block(self._buffer[:end])
+                self._buffer = self._buffer[end + len(FENCE):]
+                self._in_fence = False
+                continue
+
+            fence = self._buffer.find(FENCE)
+            brk = self._buffer.find(PARAGRAPH_BREAK)
+            if brk != -1 and (fence == -1 or brk < fence):
+                self._emit(self._paragraph + self._buffer[:brk])
+                self._paragraph = ""
+                self._buffer = self._buffer[brk + len(PARAGRAPH_BREAK):]
+            elif fence != -1:
+                self._paragraph += self._buffer[:fence]
+                self._buffer = self._buffer[fence + len(FENCE):]
+                self._in_fence = True
+            else:
+                return
+
+    def _capture_code_block(self, block):
+        if not block.startswith("json") or self.json_data:
+            return
+        try:
+            self.json_data = json.loads(block[len("json"):].strip())
+            logger.info("JSON extraído de la respuesta en streaming y eliminado del texto visible")
+        except ValueError:
+            logger.warning("Se encontró formato de JSON en streaming pero no se pudo parsear")
+
+    def _emit(self, text):
+        text = clean_visible_text(text)
+        if text:
+            self.paragraphs.append(text)
+            self.on_paragraph(text)
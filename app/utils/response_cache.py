@@ -0,0 +1,176 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from app.utils.flow_state import get_flow_step, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Tipos de mensaje cuya respuesta depende solo del paso del flujo y no del contenido.
+# Las ubicaciones no se cachean: la respuesta suele repetir la dirección o el nombre de la tienda.
+# Las imágenes se cachean por número de fotos recibidas ("2 de 3 fotos"), que va en state.
+CONTENT_INDEPENDENT_TYPES = {"image", "audio"}
+# Pasos cuya respuesta valida lo que el usuario envió (cédula, ciudad, cliente): nunca se cachean
+NON_CACHEABLE_STEPS = {"registration"}
+
+
+def cache_state(user_data):
+    """
+    Estado del usuario del que dependen las respuestas cacheables: el paso al que llevó
+    el mensaje, si ya dijo "listo"/"terminado" y cuántas fotos, documentos y audios lleva.
+    Se calcula después de actualizar el paso del flujo.
+    """
+    return (
+        get_flow_step(user_data),
+        bool(user_data.get("conversation_complete")),
+        len(user_data.get("images", [])),
+        len(user_data.get("documents", [])),
+        len(user_data.get("audio_messages", [])),
+    )
+
+
+class ResponseCache:
+    """
+    Cache de respuestas del asistente para turnos repetidos ("sí", "no", "listo",
+    una foto o un audio recibidos en el mismo paso del flujo y estado del usuario).
+
+    La clave es (paso del flujo, mensaje normalizado, tipo de mensaje, estado del
+    usuario según cache_state). Las entradas
+    expiran por TTL y se desalojan por LRU cuando se supera el tamaño máximo.
+    Las respuestas se guardan como plantilla ({name}) para que cada usuario
+    reciba su propio nombre.
+    """
+
+    def __init__(self, max_entries=500, ttl_seconds=3600, max_message_length=40, opt_out=None):
+        """
+        Inicializa el cache.
+
+        Args:
+            max_entries: Número máximo de entradas antes de desalojar por LRU
+            ttl_seconds: Segundos que una respuesta permanece válida
+            max_message_length: Longitud máxima del mensaje normalizado para cachearlo
+            opt_out: Lista de entradas "paso:mensaje" excluidas ("paso:*" excluye el paso completo)
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_message_length = max_message_length
+        self._entries = OrderedDict()
+        self._opt_out = set()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "latency_saved_ms": 0.0}
+        for entry in opt_out or []:
+            step, _, message = entry.partition(":")
+            self.add_opt_out(step.strip(), message.strip() or "*")
+
+    def make_key(self, flow_step, message_type, message_text=None, state=None):
+        """
+        Construye la clave del cache o None si el turno no es cacheable.
+
+        Args:
+            state: Estado del usuario del que depende la respuesta (ver cache_state);
+                solo comparten respuesta los usuarios en el mismo estado
+        """
+        if flow_step in NON_CACHEABLE_STEPS:
+            return None
+        if message_type in CONTENT_INDEPENDENT_TYPES:
+            normalized = ""
+        elif message_type == "text":
+            normalized = normalize_text(message_text)
+            if not normalized or len(normalized) > self.max_message_length:
+                return None
+        else:
+            return None
+
+        if (flow_step, "*") in self._opt_out or (flow_step, normalized) in self._opt_out:
+            return None
+        return (flow_step, normalized, message_type, state)
+
+    def add_opt_out(self, flow_step, message="*"):
+        """Excluye del cache un mensaje concreto de un paso, o el paso completo con '*'"""
+        normalized = message if message == "*" else normalize_text(message)
+        with self._lock:
+            self._opt_out.add((flow_step, normalized))
+            for key in [k for k in self._entries if k[0] == flow_step and normalized in ("*", k[1])]:
+                del self._entries[key]
+
+    def get(self, key, user_name):
+        """
+        Busca una respuesta en el cache.
+
+        Returns:
+            La respuesta personalizada para el usuario o None si no hay entrada válida
+        """
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry["stored_at"] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            self._stats["latency_saved_ms"] += entry["latency_ms"]
+            template = entry["template"]
+
+        return template.replace("{name}", user_name or "")
+
+    def saved_latency_ms(self, key):
+        """Latencia de la llamada al modelo que ahorra la entrada (0 si no existe)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry["latency_ms"] if entry else 0
+
+    def put(self, key, response, user_name, latency_ms):
+        """
+        Guarda una respuesta en el cache como plantilla.
+
+        Args:
+            key: Clave obtenida con make_key
+            response: Respuesta ya personalizada para el usuario
+            user_name: Nombre del usuario, se reemplaza por {name} en la plantilla
+            latency_ms: Latencia de la llamada al modelo que se ahorra en cada acierto
+        """
+        if key is None or not response:
+            return
+        template = response
+        if user_name and len(user_name) > 1:
+            # Solo palabras completas: un nombre corto ("Al", "Sol") no debe alterar otras palabras
+            template = re.sub(rf"(?<!\w){re.escape(user_name)}(?!\w)", "{name}", template)
+        with self._lock:
+            self._entries[key] = {
+                "template": template,
+                "stored_at": time.time(),
+                "latency_ms": latency_ms,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Retorna aciertos, fallos, tasa de aciertos y latencia ahorrada"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["latency_saved_ms"] = round(stats["latency_saved_ms"], 1)
+        return stats
+
+
+def create_response_cache_from_env():
+    """Crea el cache de respuestas a partir de las variables de entorno (None si está deshabilitado)"""
+    if os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        logger.info("Cache de respuestas deshabilitado")
+        return None
+    opt_out = [e for e in os.getenv("RESPONSE_CACHE_OPT_OUT", "").split(",") if e.strip()]
+    return ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500")),
+        ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+        max_message_length=int(os.getenv("RESPONSE_CACHE_MAX_MESSAGE_LENGTH", "40")),
+        opt_out=opt_out,
+    )
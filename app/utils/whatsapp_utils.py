@@ -2,20 +2,76 @@
 import logging
 from flask import current_app, jsonify
 import json
-import requests
 import re
 import os
 import uuid
 import time
-from app.services.openai_service import generate_response
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.services.openai_service import (
+    generate_response,
+    replay_deferred_turns,
+    deferred_turns,
+    llm_breaker,
+    restore_archived_media,
+    attach_media_file,
+    extract_document_text,
+    store_media_analysis,
+)
+from app.services.graph_api import get_graph_api_client
 
 # Importar MessageHandler para registrar mensajes en el dashboard
 from app.utils.message_handler import MessageHandler
 from app.utils.image_proxy import ImageProxy
+from app.utils.media_store import MediaUrlCache, create_media_ingestor_from_env
+from app.utils.image_processing import create_derivative_generator_from_env
+from app.utils.media_analysis import MediaAnalyzer
+from app.utils.outbox import create_message_outbox_from_env
 
-# Inicializar el MessageHandler y el ImageProxy
+# Cliente de la Graph API compartido (pool keep-alive y métricas de latencia por endpoint)
+graph_api = get_graph_api_client()
+
+# Inicializar el MessageHandler, el ImageProxy y el ingestor de medios (cache local con cuota
+# cuyos medios desalojados se recuperan del archivo en la nube)
 message_handler = MessageHandler()
-image_proxy = ImageProxy()
+media_ingestor = create_media_ingestor_from_env(restore=restore_archived_media)
+image_proxy = ImageProxy(
+    images_dir=media_ingestor.media_dir,
+    public_base_url=os.getenv("MEDIA_PUBLIC_BASE_URL"),
+)
+# Resolución de media_id -> URL en cache hasta que la URL expira, y descargas anticipadas
+media_url_cache = MediaUrlCache(ttl_seconds=int(os.getenv("MEDIA_URL_CACHE_TTL_SECONDS", "240")))
+media_prefetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MEDIA_PREFETCH_WORKERS", "4")), thread_name_prefix="media-prefetch"
+)
+PREFETCH_MEDIA_TYPES = ("image", "audio", "document", "video", "sticker")
+# Tamaño máximo por tipo de medio (límites de WhatsApp); el resto usa MEDIA_MAX_BYTES
+MEDIA_MAX_BYTES_BY_TYPE = {
+    "document": int(os.getenv("MEDIA_MAX_BYTES_DOCUMENT", str(100 * 1024 * 1024))),
+    "video": int(os.getenv("MEDIA_MAX_BYTES_VIDEO", str(16 * 1024 * 1024))),
+    "sticker": int(os.getenv("MEDIA_MAX_BYTES_STICKER", str(512 * 1024))),
+}
+# Documentos y videos: el webhook no espera su descarga, se procesan al terminar
+BACKGROUND_MEDIA_TYPES = ("document", "video")
+MEDIA_PREFETCH_TIMEOUT_SECONDS = float(os.getenv("MEDIA_PREFETCH_TIMEOUT_SECONDS", "60"))
+# Miniaturas y vistas previas de las imágenes para el dashboard (None si está deshabilitado)
+derivative_generator = create_derivative_generator_from_env(media_ingestor.media_dir,
+                                                            on_file=media_ingestor.register_file)
+# Páginas y texto de los PDF, primer cuadro y duración de los videos, en segundo plano
+media_analyzer = MediaAnalyzer(
+    work_dir=os.path.join(media_ingestor.media_dir, "frames"),
+    max_workers=int(os.getenv("MEDIA_ANALYSIS_WORKERS", "2")),
+    derivatives=derivative_generator,
+    extract_text=extract_document_text,
+    max_text_bytes=int(os.getenv("DOCUMENT_TEXT_MAX_BYTES", str(10 * 1024 * 1024))),
+    on_result=store_media_analysis,
+    on_file=media_ingestor.register_file,
+)
+# Espera máxima por la miniatura cuando el dashboard la recibe incrustada (sin servidor de medios)
+DERIVATIVE_WAIT_SECONDS = float(os.getenv("IMAGE_DERIVATIVE_WAIT_SECONDS", "3"))
+
+# Enviar la respuesta por párrafos a medida que el modelo la genera
+STREAMING_ENABLED = os.getenv("OPENAI_STREAMING_ENABLED", "false").lower() in ("1", "true", "yes")
 
 def log_http_response(response):
     logging.info(f"Status: {response.status_code}")
@@ -40,42 +96,74 @@ def get_image_message_input(recipient, image_url):
         "image": {"link": image_url}
     })
 
-def send_message(data):
+def get_typing_indicator_input(message_id):
+    """Marca el mensaje como leído y muestra el indicador de escritura al usuario"""
+    return json.dumps({
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": message_id,
+        "typing_indicator": {"type": "text"}
+    })
+
+def deliver_message(data, phone_number_id):
+    """
+    Envío real a la Graph API; lo ejecuta el outbox dentro del contexto de la app.
+    
+    Returns:
+        requests.Response (el outbox decide si reintentar según el código)
     """
-    Envía un mensaje a WhatsApp.
+    access_token = current_app.config.get('ACCESS_TOKEN')
+    version = current_app.config.get('VERSION') or 'v17.0'
+    if not access_token:
+        raise ValueError("ACCESS_TOKEN no está configurado")
+    
+    logging.info(f"Enviando mensaje con el número {phone_number_id}")
+    # Cliente compartido: reutiliza las conexiones keep-alive con la Graph API
+    return graph_api.send_message(data, phone_number_id=phone_number_id, access_token=access_token, version=version)
+
+def record_undelivered_message(message):
+    """Deja constancia en el dashboard de un mensaje que agotó sus reintentos"""
+    if message["kind"] == "typing":
+        return
+    message_handler.add_message(
+        phone_number=message["wa_id"],
+        message=f"[MENSAJE NO ENTREGADO: {message['last_status'] or 'sin respuesta'}]",
+        is_bot=True
+    )
+
+# Outbox persistente: límite de tasa por número, orden por destinatario y reintentos
+message_outbox = create_message_outbox_from_env(send_fn=deliver_message, on_dead_letter=record_undelivered_message)
+
+def send_message(data, wa_id=None):
+    """
+    Encola un mensaje de WhatsApp en el outbox; el despachador lo entrega en orden.
     Verifica que los parámetros necesarios estén configurados.
+    
+    Args:
+        data: Payload JSON del mensaje
+        wa_id: Destinatario, si el payload no lo incluye (indicador de escritura)
+    
+    Returns:
+        ID del mensaje en el outbox o None si falta configuración
     """
     phone_number_id = current_app.config.get('PHONE_NUMBER_ID')
-    version = current_app.config.get('VERSION')
-    access_token = current_app.config.get('ACCESS_TOKEN')
     
     # Verificar que tenemos todos los parámetros necesarios
     if not phone_number_id:
         logging.error("Error: PHONE_NUMBER_ID no está configurado")
         return None
     
-    if not version:
-        version = 'v17.0'  # Valor por defecto
-    
-    if not access_token:
+    if not current_app.config.get('ACCESS_TOKEN'):
         logging.error("Error: ACCESS_TOKEN no está configurado")
         return None
     
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-    }
-    
-    url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
-    
-    try:
-        logging.info(f"Enviando mensaje a: {url}")
-        response = requests.post(url, data=data, headers=headers, timeout=10)
-        response.raise_for_status()
-        return response
-    except requests.RequestException as e:
-        logging.error(f"Error sending message: {e}")
-        return None
+    payload = json.loads(data) if isinstance(data, str) else data
+    kind = "typing" if payload.get("status") == "read" else payload.get("type", "text")
+    return message_outbox.enqueue(data, wa_id or payload.get("to"), phone_number_id, kind=kind)
+
+def start_outbox_worker(app):
+    """Inicia el despachador del outbox con el contexto de la app (token y versión)"""
+    message_outbox.start(app_context=app.app_context)
 
 def process_text_for_whatsapp(text):
     """Formatear texto para WhatsApp"""
@@ -93,6 +181,12 @@ def determine_message_type(message):
         return "audio"
     elif "location" in message:
         return "location"
+    elif "document" in message:
+        return "document"
+    elif "video" in message:
+        return "video"
+    elif "sticker" in message:
+        return "sticker"
     else:
         return "unknown"
 
@@ -107,28 +201,34 @@ def is_valid_whatsapp_message(body):
         and body["entry"][0]["changes"][0]["value"]["messages"][0]
     )
 
-def get_media_url(media_id):
+def get_media_url(media_id, access_token=None, version=None):
     """
     Obtener la URL real de la imagen a partir del media_id
     usando la API de Facebook/WhatsApp.
+    
+    La resolución se guarda en cache hasta que la URL expira. El token y la versión
+    se pueden pasar explícitamente para llamarla fuera del contexto de Flask.
     """
-    phone_number_id = current_app.config.get('PHONE_NUMBER_ID')
-    version = current_app.config.get('VERSION', 'v17.0')
-    access_token = current_app.config.get('ACCESS_TOKEN')
+    cached = media_url_cache.get(media_id)
+    if cached:
+        return cached.get('url')
+    
+    if access_token is None:
+        access_token = current_app.config.get('ACCESS_TOKEN')
+    if version is None:
+        version = current_app.config.get('VERSION', 'v17.0')
     
     # Verificar que tenemos los parámetros necesarios
     if not access_token:
         logging.error("Error: ACCESS_TOKEN no está configurado")
         return None
     
-    url = f"https://graph.facebook.com/{version}/{media_id}"
-    params = {'access_token': access_token}
-    
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = graph_api.get_media(media_id, access_token=access_token, version=version)
         response.raise_for_status()
         data = response.json()
         logging.info(f"Respuesta de Graph API para media_id={media_id}: {data}")
+        media_url_cache.put(media_id, data)
         
         # La URL directa del medio está en el campo 'url'
         return data.get('url')
@@ -136,6 +236,79 @@ def get_media_url(media_id):
         logging.error(f"Error fetching media URL: {e}")
         return None
 
+def ingest_media(media_id, access_token=None, version=None, max_bytes=None):
+    """
+    Resuelve la URL de un media_id y lo descarga una sola vez con el ingestor de medios.
+    
+    Returns:
+        Handle del medio (media_id, path, sha256, size, mime, url) o None si falla
+    """
+    if not media_id:
+        return None
+    handle = media_ingestor.get(media_id)
+    if handle:
+        return handle
+    if access_token is None:
+        access_token = current_app.config.get('ACCESS_TOKEN')
+    
+    # Si la URL en cache ya no sirve se resuelve de nuevo una vez
+    for attempt in range(2):
+        media_url = get_media_url(media_id, access_token=access_token, version=version)
+        if not media_url:
+            logging.error(f"No se pudo obtener la URL del medio {media_id}")
+            return None
+        handle = media_ingestor.ingest(media_id, media_url, access_token=access_token, max_bytes=max_bytes)
+        if handle:
+            return handle
+        media_url_cache.invalidate(media_id)
+    return None
+
+def prefetch_media(message):
+    """
+    Lanza en segundo plano la resolución y descarga del medio de un mensaje, para que
+    ocurra en paralelo con el registro del mensaje y la consulta del estado del bot.
+    
+    Returns:
+        Future con el handle del medio, o None si el mensaje no trae medios
+    """
+    media_type = next((t for t in PREFETCH_MEDIA_TYPES if t in message), None)
+    media_id = message[media_type].get("id") if media_type else None
+    if not media_id:
+        return None
+    return media_prefetch_executor.submit(
+        ingest_media,
+        media_id,
+        access_token=current_app.config.get('ACCESS_TOKEN'),
+        version=current_app.config.get('VERSION', 'v17.0'),
+        max_bytes=MEDIA_MAX_BYTES_BY_TYPE.get(media_type),
+    )
+
+def process_media_file(wa_id, kind, future):
+    """
+    Al terminar la descarga de un documento o video lo registra en la conversación y
+    encola su análisis. Corre en el hilo de la descarga, no en el del webhook.
+    """
+    try:
+        handle = future.result()
+    except Exception as e:
+        logging.error(f"La descarga del {kind} de {wa_id} falló: {e}")
+        return
+    if not handle:
+        logging.error(f"No se pudo descargar el {kind} de {wa_id}")
+        return
+    conversation_id = attach_media_file(wa_id, kind, handle)
+    media_analyzer.submit(wa_id, conversation_id, kind, handle)
+
+def wait_for_media(future):
+    """Espera el resultado de una descarga anticipada (None si falló o superó el plazo)"""
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=MEDIA_PREFETCH_TIMEOUT_SECONDS)
+    except Exception as e:
+        logging.error(f"La descarga anticipada del medio falló: {e}")
+        return None
+
 def process_whatsapp_message(body):
     """Procesar mensaje entrante de WhatsApp"""
     if not is_valid_whatsapp_message(body):
@@ -147,6 +320,10 @@ def process_whatsapp_message(body):
     message = body["entry"][0]["changes"][0]["value"]["messages"][0]
     message_type = determine_message_type(message)
     
+    # Resolver y descargar el medio en segundo plano mientras se registra el mensaje
+    media_future = prefetch_media(message)
+    bot_active = message_handler.should_bot_respond(wa_id)
+    
     # Construir contenido del mensaje según el tipo
     message_content = None
     
@@ -159,20 +336,28 @@ def process_whatsapp_message(body):
         media_id = message["image"].get("id")
         logging.info(f"ID de imagen recibido: {media_id}")
         
-        # Obtener URL de la imagen
-        original_media_url = get_media_url(media_id) if media_id else None
+        # Descargar la imagen una sola vez; el handle se comparte con el modelo y el archivado
+        handle = wait_for_media(media_future)
         
-        if original_media_url:
-            logging.info(f"URL de imagen obtenida: {original_media_url}")
+        if handle:
+            # Generar miniatura y vista previa en el pool de procesos
+            thumbnail = None
+            future = derivative_generator.submit(handle) if derivative_generator else None
+            if derivative_generator and not image_proxy.public_base_url:
+                try:
+                    if future:
+                        derivatives = future.result(timeout=DERIVATIVE_WAIT_SECONDS)
+                    else:
+                        derivatives = derivative_generator.get(handle["sha256"])
+                    thumbnail = derivatives.get("thumb")
+                except Exception as e:
+                    logging.warning(f"Miniatura no disponible para {media_id}: {e}")
             
-            # Usar el ImageProxy para procesar la imagen
-            image_results = image_proxy.process_whatsapp_image(
-                url=original_media_url,
-                access_token=current_app.config.get('ACCESS_TOKEN')
-            )
+            # Usar el ImageProxy para preparar la imagen del dashboard desde la copia local
+            image_results = image_proxy.process_media_handle(handle, thumbnail=thumbnail)
             
             # Determinar la mejor URL para guardar
-            best_url = image_results.get('data_url') or original_media_url
+            best_url = image_results.get('public_url') or image_results.get('data_url') or handle["url"]
             
             # Registrar mensaje con la URL procesada - CORREGIDO: usar phone_number en lugar de wa_id
             message_handler.add_message(
@@ -181,12 +366,12 @@ def process_whatsapp_message(body):
                 is_bot=False, 
                 media_url=best_url
             )
-            message_content = original_media_url
+            message_content = handle
             
             # Log info about the processed image
             logging.info(f"Imagen procesada: Local path: {image_results.get('local_path')}")
         else:
-            logging.error("No se pudo obtener la URL de la imagen")
+            logging.error("No se pudo obtener la imagen")
             message_content = "[Image sent]"
             # Registrar mensaje sin URL - CORREGIDO: usar phone_number en lugar de wa_id
             message_handler.add_message(phone_number=wa_id, message="[IMAGEN - URL no disponible]", is_bot=False)
@@ -198,10 +383,35 @@ def process_whatsapp_message(body):
             message_handler.add_message(phone_number=wa_id, message=f"[CAPTION] {caption}", is_bot=False)
 
     elif message_type == "audio":
-        message_content = "[Audio message sent]"
+        handle = wait_for_media(media_future)
+        message_content = handle or "[Audio message sent]"
         # Registrar mensaje en el dashboard - CORREGIDO
         message_handler.add_message(phone_number=wa_id, message="[AUDIO]", is_bot=False)
 
+    elif message_type in BACKGROUND_MEDIA_TYPES:
+        # No se espera la descarga: puede ser un archivo grande y se procesa en segundo plano
+        media = message[message_type]
+        message_content = {
+            "media_id": media.get("id"),
+            "mime": media.get("mime_type"),
+            "filename": media.get("filename"),
+            "caption": media.get("caption"),
+        }
+        label = "DOCUMENTO" if message_type == "document" else "VIDEO"
+        detail = f": {media['filename']}" if media.get("filename") else ""
+        message_handler.add_message(phone_number=wa_id, message=f"[{label}{detail}]", is_bot=False)
+
+    elif message_type == "sticker":
+        handle = wait_for_media(media_future)
+        media_url = None
+        if handle:
+            if derivative_generator:
+                derivative_generator.submit(handle)
+            sticker_results = image_proxy.process_media_handle(handle)
+            media_url = sticker_results.get("public_url") or sticker_results.get("data_url")
+        message_content = handle or "[Sticker sent]"
+        message_handler.add_message(phone_number=wa_id, message="[STICKER]", is_bot=False, media_url=media_url)
+
     elif message_type == "location":
         # Extraer los datos de ubicación del mensaje
         loc = message.get("location", {})
@@ -219,16 +429,32 @@ def process_whatsapp_message(body):
         # Registrar mensaje en el dashboard - CORREGIDO
         message_handler.add_message(phone_number=wa_id, message="[MENSAJE NO SOPORTADO]", is_bot=False)
     
+    # El documento o video se completa cuando termine su descarga, también si el chat lo atiende un operador
+    if message_type in BACKGROUND_MEDIA_TYPES and media_future:
+        media_future.add_done_callback(lambda done: process_media_file(wa_id, message_type, done))
+    
     # Verificar si el bot debe responder
-    if not message_handler.should_bot_respond(wa_id):
+    if not bot_active:
         logging.info(f"Bot desactivado para {wa_id}. No se procesará el mensaje.")
         return jsonify({"status": "success", "message": "Bot is inactive"}), 200
     
+    on_paragraph = None
+    if STREAMING_ENABLED:
+        # Confirmar lectura y mostrar "escribiendo..." antes de llamar al modelo
+        if message.get("id"):
+            send_message(get_typing_indicator_input(message["id"]), wa_id=wa_id)
+        
+        def on_paragraph(paragraph):
+            text = process_text_for_whatsapp(paragraph)
+            if text:
+                send_message(get_text_message_input(wa_id, text))
+                message_handler.add_message(phone_number=wa_id, message=text, is_bot=True)
+    
     # Obtener respuesta basada en el script/servicio
-    response = generate_response(wa_id, name, message_type, message_content)
+    response = generate_response(wa_id, name, message_type, message_content, on_paragraph=on_paragraph)
     
-    # Enviar respuesta de texto (si existe)
-    if "text_response" in response and response["text_response"]:
+    # Enviar respuesta de texto (si existe y no se envió ya en streaming)
+    if response.get("text_response") and not response.get("streamed"):
         text_response = process_text_for_whatsapp(response["text_response"])
         data = get_text_message_input(wa_id, text_response)
         send_message(data)
@@ -243,4 +469,43 @@ def process_whatsapp_message(body):
         # Registrar envío de imagen en el dashboard - CORREGIDO
         message_handler.add_message(phone_number=wa_id, message="[IMAGEN ENVIADA]", is_bot=True, media_url=image_url)
     
-    return jsonify({"status": "success"}), 200
\ No newline at end of file
+    return jsonify({"status": "success"}), 200
+
+# ------------------------------------------------------------------------
+# REPRODUCCIÓN DE TURNOS DIFERIDOS
+# ------------------------------------------------------------------------
+_replay_worker_started = False
+
+def _deliver_replayed_turn(wa_id, response):
+    """Envía al usuario la respuesta a sus turnos diferidos"""
+    if response.get("text_response"):
+        text_response = process_text_for_whatsapp(response["text_response"])
+        send_message(get_text_message_input(wa_id, text_response))
+        message_handler.add_message(phone_number=wa_id, message=text_response, is_bot=True)
+
+def replay_pending_turns():
+    """
+    Responde, en orden de llegada, a los usuarios con turnos diferidos por una caída
+    del modelo. Se detiene en cuanto el circuito del modelo vuelve a abrirse.
+    """
+    deferred_turns.replay_pending(replay_deferred_turns, _deliver_replayed_turn, breaker=llm_breaker)
+
+def start_deferred_replay_worker(app):
+    """Inicia el hilo que reproduce los turnos diferidos cuando el circuito se cierra"""
+    global _replay_worker_started
+    if _replay_worker_started:
+        return
+    _replay_worker_started = True
+    interval = float(os.getenv("DEFERRED_REPLAY_INTERVAL_SECONDS", "15"))
+
+    def worker():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    replay_pending_turns()
+            except Exception as e:
+                logging.error(f"Error reproduciendo turnos diferidos: {e}", exc_info=True)
+
+    threading.Thread(target=worker, name="deferred-replay", daemon=True).start()
+    logging.info(f"Reproducción de turnos diferidos activa (cada {interval}s)")
@@ -6,12 +6,14 @@ import os
 import sqlite3
 from datetime import datetime
 import base64
-import requests
 from PIL import Image
 from io import BytesIO
 import logging
 from dotenv import load_dotenv
 import re
+from app.utils.llm_metrics import LLMMetrics
+from app.services.graph_api import GraphAPIClient
+from app.utils.outbox import MessageOutbox, PENDING, SENDING, DELIVERED, DEAD
 # 1. PRIMERO: Configurar logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -22,6 +24,8 @@ load_dotenv()
 WHATSAPP_ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v22.0")
+# Minutos tras los que un mensaje que sigue pendiente en el outbox se marca como atrasado
+OUTBOX_STALE_MINUTES = float(os.getenv("OUTBOX_STALE_MINUTES", "5"))
 
 # 3. TERCERO: Verificar que las variables necesarias estén disponibles
 if WHATSAPP_ACCESS_TOKEN and WHATSAPP_PHONE_NUMBER_ID:
@@ -35,14 +39,30 @@ else:
         missing.append("PHONE_NUMBER_ID")
     logger.warning(f"Variables faltantes: {', '.join(missing)}")
 
-# Asegurarse de que los directorios necesarios existen
-app_dir = os.path.dirname(os.path.abspath(__file__))
-static_dir = os.path.join(app_dir, "static")
-whatsapp_images_dir = os.path.join(static_dir, "whatsapp_images")
 
-for directory in [static_dir, whatsapp_images_dir]:
-    os.makedirs(directory, exist_ok=True)
-    logger.info(f"Directorio asegurado: {directory}")
+@st.cache_resource
+def get_whatsapp_client():
+    """Cliente de la Graph API compartido entre las recargas del dashboard (conexiones keep-alive)"""
+    return GraphAPIClient(
+        access_token=WHATSAPP_ACCESS_TOKEN,
+        phone_number_id=WHATSAPP_PHONE_NUMBER_ID,
+        version=WHATSAPP_API_VERSION,
+    )
+
+
+@st.cache_resource
+def get_message_outbox():
+    """Outbox compartido con el bot: el dashboard solo encola y consulta, el bot entrega"""
+    return MessageOutbox()
+
+
+def outbox_stale_warning():
+    """Aviso si hay mensajes pendientes en el outbox hace más de OUTBOX_STALE_MINUTES (o None)"""
+    oldest = get_message_outbox().oldest_pending_seconds()
+    if oldest is None or oldest < OUTBOX_STALE_MINUTES * 60:
+        return None
+    return (f"⚠️ Hay mensajes pendientes en el outbox desde hace {oldest / 60:.0f} minutos. "
+            "Verificar que el bot esté en ejecución y revisar los errores de entrega.")
 
 # Configuración de la página
 st.set_page_config(
@@ -549,9 +569,12 @@ class DatabaseManager:
         return {"is_active": result[0], "last_updated": result[1]}
     
     def send_message(self, phone_number, message):
-        """Envía un mensaje a WhatsApp y lo registra en la base de datos"""
+        """
+        Encola un mensaje para WhatsApp y lo registra en la base de datos. El bot lo
+        entrega desde el outbox: True significa encolado, no entregado.
+        """
         
-        # Intentar enviar el mensaje a WhatsApp
+        # Encolar el mensaje en el outbox del bot
         success, response = send_whatsapp_message(phone_number, message)
         
         # Registrar el mensaje en la base de datos local
@@ -559,9 +582,9 @@ class DatabaseManager:
         
         # Registrar el resultado para depuración
         if success:
-            logger.info(f"Mensaje enviado con éxito a {phone_number}")
+            logger.info(f"Mensaje encolado para {phone_number} (outbox {response.get('outbox_id')})")
         else:
-            logger.warning(f"No se pudo enviar el mensaje a WhatsApp: {response}")
+            logger.warning(f"No se pudo encolar el mensaje para WhatsApp: {response}")
         
         return success
 
@@ -574,6 +597,10 @@ def is_lookaside_url(url):
     """Verifica si la URL es de lookaside.fbsbx.com"""
     return url and isinstance(url, str) and 'lookaside.fbsbx.com' in url
 
+def is_media_server_url(url):
+    """Verifica si la URL apunta a los medios servidos por la app Flask"""
+    return bool(url and isinstance(url, str) and ('/media/files/' in url or re.search(r'/media/[0-9a-f]{64}', url)))
+
 def is_gcs_url(url):
     """Verifica si la URL es de Google Cloud Storage"""
     return url and isinstance(url, str) and ('storage.googleapis.com' in url or 'storage.cloud.google.com' in url)
@@ -629,6 +656,12 @@ def create_image_tag(url):
     if is_data_url(url):
         # Es un data URL, usarlo directamente
         return f'<img src="{url}" class="chat-image" alt="Imagen" />'
+    elif is_media_server_url(url):
+        # Medio servido por la app: se muestra la miniatura y la foto completa solo al hacer clic
+        return (
+            f'<a href="{url}" target="_blank" rel="noopener noreferrer">'
+            f'<img src="{url}?variant=thumb" class="chat-image" loading="lazy" alt="Imagen" /></a>'
+        )
     elif is_gcs_url(url):
         # Es una URL de GCS, debería ser accesible directamente
         return f'<img src="{url}" class="chat-image" alt="Imagen de GCS" />'
@@ -816,14 +849,17 @@ with col2:
                 submit_button = st.form_submit_button("Enviar")
             
             if submit_button and user_message:
-                with st.spinner("Enviando mensaje..."):
-                    # Enviar mensaje
+                with st.spinner("Encolando mensaje..."):
+                    # Encolar mensaje (el bot lo entrega desde el outbox)
                     success = db_manager.send_message(selected_number, user_message)
                     
                     if success:
-                        st.success("✅ Mensaje enviado correctamente a WhatsApp")
+                        st.success("✅ Mensaje encolado para WhatsApp. Su entrega se ve en la sección del outbox.")
+                        stale_warning = outbox_stale_warning()
+                        if stale_warning:
+                            st.warning(stale_warning)
                     else:
-                        st.warning("⚠️ El mensaje se guardó localmente pero no se pudo enviar a WhatsApp. Revisar logs para más detalles.")
+                        st.warning("⚠️ El mensaje se guardó localmente pero no se pudo encolar para WhatsApp. Revisar logs para más detalles.")
                     
                     time.sleep(1)
                     st.rerun()
@@ -872,12 +908,8 @@ with st.expander("Estado de integración con WhatsApp", expanded=False):
             if not WHATSAPP_ACCESS_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
                 st.error("❌ No se puede probar: Faltan variables de configuración")
             else:
-                # URL para verificar estado de la API
-                test_url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}"
-                headers = {"Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"}
-                
                 with st.spinner("Verificando conexión..."):
-                    response = requests.get(test_url, headers=headers)
+                    response = get_whatsapp_client().get_phone_number()
                     
                 if response.status_code == 200:
                     st.success("✅ Conexión exitosa con la API de WhatsApp")
@@ -887,6 +919,12 @@ with st.expander("Estado de integración con WhatsApp", expanded=False):
                     st.json(response.json())
         except Exception as e:
             st.error(f"❌ Error al probar la conexión: {str(e)}")
+    
+    # Latencia de las llamadas del dashboard a la Graph API, por endpoint
+    graph_api_stats = get_whatsapp_client().stats()
+    if graph_api_stats:
+        st.markdown("**Latencia de la Graph API (ms)**")
+        st.dataframe(pd.DataFrame.from_dict(graph_api_stats, orient="index"), use_container_width=True)
 
 # Información de conversaciones (versión simplificada usando componentes nativos)
 with st.expander("Información de conversaciones", expanded=False):
@@ -933,9 +971,78 @@ with st.expander("Información de conversaciones", expanded=False):
         except:
             pass
 
+# Consumo del modelo: tokens, latencia y costo por paso, día y conversación
+with st.expander("Consumo del modelo (tokens, latencia y costo)", expanded=False):
+    try:
+        llm_metrics = LLMMetrics(db_manager.db_path)
+        
+        st.subheader("Por paso del flujo")
+        by_step = pd.DataFrame(llm_metrics.rollup_by_step())
+        if by_step.empty:
+            st.info("Todavía no hay llamadas al modelo registradas.")
+        else:
+            st.dataframe(by_step, use_container_width=True)
+            
+            st.subheader("Cache de respuestas")
+            cache_stats = llm_metrics.cache_stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Tasa de aciertos", f"{cache_stats['hit_rate'] * 100:.1f}%")
+            col2.metric("Aciertos / consultas", f"{cache_stats['hits']} / {cache_stats['lookups']}")
+            col3.metric("Latencia ahorrada", f"{cache_stats['latency_saved_ms'] / 1000:.1f}s")
+            if cache_stats["by_step"]:
+                st.dataframe(pd.DataFrame(cache_stats["by_step"]), use_container_width=True)
+            
+            st.subheader("Por día")
+            st.dataframe(pd.DataFrame(llm_metrics.rollup_by_day()), use_container_width=True)
+            
+            st.subheader("Conversaciones con mayor consumo")
+            st.dataframe(pd.DataFrame(llm_metrics.top_conversations()), use_container_width=True)
+    except Exception as e:
+        st.error(f"Error al cargar las métricas del modelo: {str(e)}")
+
+# Mensajes salientes: pendientes, entregados y fallidos (outbox del bot)
+with st.expander("Mensajes salientes (outbox)", expanded=False):
+    try:
+        outbox = get_message_outbox()
+        counts = outbox.counts()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Pendientes", counts[PENDING])
+        col2.metric("Enviando", counts[SENDING])
+        col3.metric("Entregados", counts[DELIVERED])
+        col4.metric("Fallidos", counts[DEAD])
+        stale_warning = outbox_stale_warning()
+        if stale_warning:
+            st.warning(stale_warning)
+        
+        st.subheader("Pendientes")
+        pending = pd.DataFrame(outbox.list_messages([PENDING, SENDING]))
+        if pending.empty:
+            st.info("No hay mensajes pendientes.")
+        else:
+            st.dataframe(pending, use_container_width=True)
+        
+        st.subheader("Fallidos")
+        dead = outbox.list_messages([DEAD])
+        if not dead:
+            st.info("No hay mensajes fallidos.")
+        else:
+            st.dataframe(pd.DataFrame(dead), use_container_width=True)
+            retry_id = st.selectbox("Reintentar mensaje", [message["id"] for message in dead])
+            if st.button("Reintentar envío"):
+                if outbox.retry(retry_id):
+                    st.success(f"Mensaje {retry_id} devuelto a la cola")
+        
+        st.subheader("Entregados recientemente")
+        st.dataframe(pd.DataFrame(outbox.list_messages([DELIVERED], limit=20)), use_container_width=True)
+    except Exception as e:
+        st.error(f"Error al cargar el outbox: {str(e)}")
+
 # Añadir esta función para enviar mensajes a WhatsApp
 def send_whatsapp_message(phone_number, message):
-    """Envía un mensaje a WhatsApp usando la API de WhatsApp Cloud"""
+    """
+    Encola un mensaje para WhatsApp en el outbox del bot, que lo entrega con la API de
+    WhatsApp Cloud. Retorna (True, {"outbox_id": ...}) al encolarlo, no al entregarlo.
+    """
     
     if not WHATSAPP_ACCESS_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
         logger.error("No se pueden enviar mensajes: Faltan credenciales de WhatsApp")
@@ -945,15 +1052,6 @@ def send_whatsapp_message(phone_number, message):
     if phone_number.startswith('+'):
         phone_number = phone_number[1:]
     
-    # URL de la API
-    url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    
-    # Encabezados
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"
-    }
-    
     # Datos del mensaje
     payload = {
         "messaging_product": "whatsapp",
@@ -968,20 +1066,12 @@ def send_whatsapp_message(phone_number, message):
     try:
         # Registrar información de depuración
         logger.info(f"Enviando mensaje a WhatsApp: {phone_number}")
-        logger.debug(f"URL de API: {url}")
         logger.debug(f"Payload: {json.dumps(payload)}")
         
-        # Enviar solicitud a la API
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        response_data = response.json()
-        
-        # Registrar la respuesta
-        if response.status_code == 200:
-            logger.info(f"Mensaje enviado correctamente a WhatsApp: {response_data}")
-            return True, response_data
-        else:
-            logger.error(f"Error al enviar mensaje a WhatsApp. Código: {response.status_code}, Respuesta: {response_data}")
-            return False, response_data
+        # Encolar en el outbox: el bot lo entrega respetando el límite de tasa y el orden del chat
+        outbox_id = get_message_outbox().enqueue(payload, phone_number, WHATSAPP_PHONE_NUMBER_ID)
+        logger.info(f"Mensaje encolado en el outbox para WhatsApp: {outbox_id}")
+        return True, {"outbox_id": outbox_id}
     
     except Exception as e:
         logger.error(f"Excepción al enviar mensaje a WhatsApp: {str(e)}")
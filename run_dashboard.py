@@ -4,18 +4,6 @@ import sys
 import time
 
 if __name__ == "__main__":
-    # Asegurarse de que existe el directorio para imágenes
-    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-    whatsapp_images_dir = os.path.join(static_dir, "whatsapp_images")
-    
-    # Crear los directorios si no existen
-    try:
-        os.makedirs(static_dir, exist_ok=True)
-        os.makedirs(whatsapp_images_dir, exist_ok=True)
-        print(f"Directorio para imágenes configurado: {whatsapp_images_dir}")
-    except Exception as e:
-        print(f"Advertencia: No se pudo crear el directorio para imágenes: {e}")
-    
     # Mostrar mensaje informativo
     print("Iniciando el dashboard de WhatsApp Bot...")
     print("Esto puede tardar unos segundos...")
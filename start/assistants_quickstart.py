@@ -1,14 +1,15 @@
 import shelve
 import logging
-import requests
 import json
 import os
 import time
 import sys
+import threading
 from openai import OpenAI
 from flask import current_app
 from dotenv import load_dotenv
 from app.utils.message_handler import MessageHandler
+from app.services.graph_api import get_graph_api_client
 
 # Cargar variables de entorno
 load_dotenv()
@@ -44,13 +45,26 @@ except Exception as e:
 # ------------------------------------------------------------------------
 # GESTIÓN DE THREADS
 # ------------------------------------------------------------------------
+# Cache en memoria de wa_id -> thread_id, respaldado en el shelve threads_db
+threads_cache = {}
+threads_cache_lock = threading.Lock()
+
 def check_if_thread_exists(wa_id):
     """Verifica si existe un thread para el usuario de WhatsApp"""
+    with threads_cache_lock:
+        if wa_id in threads_cache:
+            return threads_cache[wa_id]
     with shelve.open("threads_db") as threads_shelf:
-        return threads_shelf.get(wa_id, None)
+        thread_id = threads_shelf.get(wa_id, None)
+    if thread_id is not None:
+        with threads_cache_lock:
+            threads_cache[wa_id] = thread_id
+    return thread_id
 
 def store_thread(wa_id, thread_id):
     """Almacena un thread para el usuario de WhatsApp"""
+    with threads_cache_lock:
+        threads_cache[wa_id] = thread_id
     with shelve.open("threads_db", writeback=True) as threads_shelf:
         threads_shelf[wa_id] = thread_id
 
@@ -69,7 +83,7 @@ def download_image_bytes(image_url):
 
     try:
         logger.info(f"[download_image_bytes] Descargando: {image_url}")
-        resp = requests.get(image_url, headers=headers, timeout=10)
+        resp = get_graph_api_client().download(image_url, headers=headers, timeout=10)
         resp.raise_for_status()
         return resp.content
     except Exception as e:
@@ -79,6 +93,97 @@ def download_image_bytes(image_url):
 # ------------------------------------------------------------------------
 # EJECUTAR ASISTENTE
 # ------------------------------------------------------------------------
+RUN_TERMINAL_STATES = ["completed", "failed", "cancelled", "expired", "incomplete", "requires_action"]
+# Eventos de fin del run (thread.run.completed, ...); los thread.run.step.* son de los pasos, no del run
+RUN_TERMINAL_EVENTS = {f"thread.run.{state}" for state in RUN_TERMINAL_STATES}
+RUN_TIMEOUT_SECONDS = 30
+POLL_INITIAL_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF_FACTOR = 1.5
+
+def extract_message_text(message):
+    """Extrae el texto de un mensaje del thread (o None si no tiene texto)"""
+    for content_part in getattr(message, "content", None) or []:
+        if hasattr(content_part, 'text') and hasattr(content_part.text, 'value'):
+            return content_part.text.value
+    return None
+
+def stream_run(thread_id, run_ref):
+    """
+    Ejecuta el asistente consumiendo los eventos del run en streaming.
+    
+    Args:
+        thread_id: ID del thread
+        run_ref: Dict donde se guarda el ID del run en cuanto se crea
+        
+    Returns:
+        Tupla (estado final del run, texto del último mensaje del asistente)
+    """
+    message_text = None
+    status = None
+    with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=OPENAI_ASSISTANT_ID,
+        timeout=RUN_TIMEOUT_SECONDS
+    ) as stream:
+        for event in stream:
+            if event.event == "thread.run.created":
+                run_ref["id"] = event.data.id
+            elif event.event == "thread.message.completed" and event.data.role == "assistant":
+                message_text = extract_message_text(event.data) or message_text
+            elif event.event in RUN_TERMINAL_EVENTS:
+                status = event.data.status
+                logger.info(f"Run {event.data.id} terminó con estado: {status}")
+    return status, message_text
+
+def poll_run(thread_id, run_id=None):
+    """
+    Alternativa sin streaming: consulta el estado del run con backoff adaptativo
+    (empieza en 100ms y crece hasta 2s), luego obtiene solo el mensaje más reciente.
+    
+    Args:
+        thread_id: ID del thread
+        run_id: ID de un run ya creado (si el streaming falló a mitad); si no, se crea uno
+        
+    Returns:
+        Tupla (estado final del run, texto del último mensaje del asistente)
+    """
+    if run_id:
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    else:
+        run = client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=OPENAI_ASSISTANT_ID
+        )
+    deadline = time.time() + RUN_TIMEOUT_SECONDS
+    delay = POLL_INITIAL_DELAY
+    status = run.status
+    
+    while status not in RUN_TERMINAL_STATES and time.time() < deadline:
+        time.sleep(min(delay, max(0, deadline - time.time())))
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+        try:
+            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+            status = run.status
+            logger.info(f"Run status: {status}")
+        except Exception as e:
+            logger.error(f"Error verificando estado del run: {e}")
+    
+    if status != "completed":
+        return status, None
+    
+    # Obtener solo el mensaje más reciente del asistente para este run
+    messages = client.beta.threads.messages.list(
+        thread_id=thread_id,
+        run_id=run.id,
+        order="desc",
+        limit=1
+    )
+    for msg in messages.data:
+        if msg.role == "assistant":
+            return status, extract_message_text(msg)
+    return status, None
+
 def run_assistant(thread_id):
     """Ejecuta el asistente y retorna su respuesta"""
     try:
@@ -91,52 +196,24 @@ def run_assistant(thread_id):
             logger.error("No se puede ejecutar el asistente sin thread_id")
             return "Error de procesamiento: No se puede continuar la conversación."
             
-        # Crear y ejecutar la corrida
         logger.info(f"Ejecutando asistente en thread: {thread_id}")
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=OPENAI_ASSISTANT_ID
-        )
-        
-        # Esperar a que termine
-        status = "waiting"
-        attempt = 0
-        max_attempts = 30  # Aproximadamente 15 segundos máximo
-        
-        while status not in ["completed", "failed", "cancelled", "expired"] and attempt < max_attempts:
-            time.sleep(0.5)
-            attempt += 1
-            try:
-                run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                status = run.status
-                logger.info(f"Run status: {status} (intento {attempt})")
-            except Exception as e:
-                logger.error(f"Error verificando estado del run: {e}")
-                if attempt >= max_attempts // 2:  # Si ya llevamos la mitad de los intentos, salir
-                    break
+        run_ref = {}
+        try:
+            status, new_message = stream_run(thread_id, run_ref)
+        except Exception as e:
+            logger.warning(f"Streaming del run no disponible ({e}), usando consulta con backoff")
+            status, new_message = poll_run(thread_id, run_ref.get("id"))
         
         # Verificar errores
         if status != "completed":
             logger.error(f"La ejecución falló con estado final: {status}")
             return "Lo siento, ocurrió un problema procesando tu solicitud."
         
-        # Obtener los mensajes
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        
-        # Buscar el mensaje más reciente del asistente
-        if not messages.data:
-            logger.error("No se encontraron mensajes en el thread")
-            return "No se pudo obtener una respuesta del asistente."
-            
-        for msg in messages.data:
-            if msg.role == "assistant":
-                if hasattr(msg, 'content') and len(msg.content) > 0:
-                    for content_part in msg.content:
-                        if hasattr(content_part, 'text') and hasattr(content_part.text, 'value'):
-                            new_message = content_part.text.value
-                            logger.info(f"Mensaje generado ({len(new_message)} caracteres)")
-                            return new_message
+        if new_message:
+            logger.info(f"Mensaje generado ({len(new_message)} caracteres)")
+            return new_message
         
+        logger.error("No se encontró un mensaje del asistente para el run")
         return "No se pudo obtener respuesta del asistente."
         
     except Exception as e:
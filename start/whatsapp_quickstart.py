@@ -1,9 +1,8 @@
 import json
 from dotenv import load_dotenv
 import os
-import requests
-import aiohttp
 import asyncio
+from app.services.graph_api import GraphAPIClient, AsyncGraphAPIClient
 
 # --------------------------------------------------------------
 # Load environment variables
@@ -18,24 +17,23 @@ VERSION = os.getenv("VERSION")
 APP_ID = os.getenv("APP_ID")
 APP_SECRET = os.getenv("APP_SECRET")
 
+# Shared Graph API client: every request below reuses the same keep-alive connections
+client = GraphAPIClient(access_token=ACCESS_TOKEN, phone_number_id=PHONE_NUMBER_ID, version=VERSION)
+client.warm_up(connections=1)
+
 # --------------------------------------------------------------
 # Send a template WhatsApp message
 # --------------------------------------------------------------
 
 
 def send_whatsapp_message():
-    url = f"https://graph.facebook.com/{VERSION}/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": "Bearer " + ACCESS_TOKEN,
-        "Content-Type": "application/json",
-    }
     data = {
         "messaging_product": "whatsapp",
         "to": RECIPIENT_WAID,
         "type": "template",
         "template": {"name": "hello_world", "language": {"code": "en_US"}},
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = client.send_message(data)
     return response
 
 
@@ -64,14 +62,7 @@ def get_text_message_input(recipient, text):
 
 
 def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-    }
-
-    url = f"https://graph.facebook.com/{VERSION}/{PHONE_NUMBER_ID}/messages"
-
-    response = requests.post(url, data=data, headers=headers)
+    response = client.send_message(data)
     if response.status_code == 200:
         print("Status:", response.status_code)
         print("Content-type:", response.headers["content-type"])
@@ -96,26 +87,20 @@ response = send_message(data)
 
 # Does not work with Jupyter!
 async def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-    }
-
-    async with aiohttp.ClientSession() as session:
-        url = "https://graph.facebook.com" + f"/{VERSION}/{PHONE_NUMBER_ID}/messages"
-        try:
-            async with session.post(url, data=data, headers=headers) as response:
-                if response.status == 200:
-                    print("Status:", response.status)
-                    print("Content-type:", response.headers["content-type"])
-
-                    html = await response.text()
-                    print("Body:", html)
-                else:
-                    print(response.status)
-                    print(response)
-        except aiohttp.ClientConnectorError as e:
-            print("Connection Error", str(e))
+    async_client = AsyncGraphAPIClient(access_token=ACCESS_TOKEN, phone_number_id=PHONE_NUMBER_ID, version=VERSION)
+    try:
+        response = await async_client.send_message(data)
+        if response.status_code == 200:
+            print("Status:", response.status_code)
+            print("Content-type:", response.headers["content-type"])
+            print("Body:", response.text)
+        else:
+            print(response.status_code)
+            print(response)
+    except Exception as e:
+        print("Connection Error", str(e))
+    finally:
+        await async_client.aclose()
 
 
 def get_text_message_input(recipient, text):
@@ -137,3 +122,6 @@ data = get_text_message_input(
 loop = asyncio.get_event_loop()
 loop.run_until_complete(send_message(data))
 loop.close()
+
+# Per-endpoint latency of the calls above
+print(client.stats())
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# Las pruebas importan el paquete app desde la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Base de datos SQLite aislada para cada prueba"""
+    return str(tmp_path / "test.db")
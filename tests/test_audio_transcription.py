@@ -0,0 +1,71 @@
+import hashlib
+
+from app.services.audio_transcription import AudioTranscriber, StubTranscriptionBackend
+
+
+class CountingBackend(StubTranscriptionBackend):
+    """StubTranscriptionBackend que registra cada audio transcrito"""
+
+    def __init__(self):
+        self.calls = []
+
+    def transcribe(self, path):
+        self.calls.append(path)
+        return super().transcribe(path)
+
+
+def make_audio(tmp_path, name, content):
+    path = tmp_path / f"{name}.ogg"
+    path.write_bytes(content)
+    return {"media_id": name, "path": str(path), "sha256": hashlib.sha256(content).hexdigest(), "mime": "audio/ogg"}
+
+
+def make_transcriber(tmp_path, db_path, backend):
+    return AudioTranscriber(backend, db_path=db_path, work_dir=str(tmp_path / "normalized"))
+
+
+def test_take_unmerged_returns_each_transcript_once_in_order(tmp_path, db_path):
+    transcriber = make_transcriber(tmp_path, db_path, CountingBackend())
+    first, second = make_audio(tmp_path, "a1", b"uno" * 100), make_audio(tmp_path, "a2", b"dos" * 200)
+    transcriber.submit("573001", "conv-1", first).result(timeout=5)
+    transcriber.submit("573001", "conv-1", second).result(timeout=5)
+
+    merged = transcriber.take_unmerged("573001")
+
+    assert [row["media_id"] for row in merged] == ["a1", "a2"]
+    assert all(row["transcript"] for row in merged)
+    assert transcriber.take_unmerged("573001") == []
+    # Siguen disponibles para el manifiesto de la conversación
+    assert [row["media_id"] for row in transcriber.transcripts_for("conv-1")] == ["a1", "a2"]
+
+
+def test_take_unmerged_is_scoped_to_the_user(tmp_path, db_path):
+    transcriber = make_transcriber(tmp_path, db_path, CountingBackend())
+    transcriber.submit("573001", "conv-1", make_audio(tmp_path, "a1", b"uno")).result(timeout=5)
+    transcriber.submit("573002", "conv-2", make_audio(tmp_path, "b1", b"otro")).result(timeout=5)
+
+    assert [row["media_id"] for row in transcriber.take_unmerged("573002")] == ["b1"]
+    assert [row["media_id"] for row in transcriber.take_unmerged("573001")] == ["a1"]
+
+
+def test_failed_transcriptions_are_not_merged(tmp_path, db_path):
+    class FailingBackend(StubTranscriptionBackend):
+        def transcribe(self, path):
+            raise RuntimeError("backend caído")
+
+    transcriber = make_transcriber(tmp_path, db_path, FailingBackend())
+    transcriber.submit("573001", "conv-1", make_audio(tmp_path, "a1", b"uno")).result(timeout=5)
+
+    assert transcriber.take_unmerged("573001") == []
+
+
+def test_same_audio_is_transcribed_once(tmp_path, db_path):
+    backend = CountingBackend()
+    transcriber = make_transcriber(tmp_path, db_path, backend)
+    audio = make_audio(tmp_path, "a1", b"uno" * 100)
+    first = transcriber.submit("573001", "conv-1", audio).result(timeout=5)
+    again = transcriber.submit("573001", "conv-1", dict(audio, media_id="a1-reenviado")).result(timeout=5)
+
+    assert again == first
+    assert len(backend.calls) == 1
+    assert len(transcriber.take_unmerged("573001")) == 2
@@ -0,0 +1,110 @@
+import sqlite3
+
+import pytest
+
+from app.services.capture_extraction import CaptureExtractor, StubExtractionBackend, build_transcript
+
+
+# Los bloques ```json se retiran antes de guardar el historial: la captura sale del texto
+HISTORY = [
+    {"role": "system", "content": "guion"},
+    {"role": "user", "content": "Hola"},
+    {"role": "assistant", "content": "¡Hola! ¿Ya estás registrado en Kapta?"},
+    {"role": "user", "content": "Sí, ya estoy registrado"},
+    {"role": "assistant", "content": "Envíame el nombre de la tienda que vamos a capturar."},
+    {"role": "user", "content": "D1 Centro"},
+    {"role": "user", "content": "[📍 Ubicación recibida]\nDirección: Calle 1"},
+    {"role": "user", "content": "[📸 Imagen recibida (120.0KB)]"},
+    {"role": "user", "content": "Listo"},
+    {"role": "user", "content": "[🎤 Audio recibido]"},
+    {"role": "user", "content": "La competencia tiene mejor exhibición"},
+    {"role": "user", "content": "Listo"},
+    {"role": "assistant", "content": "¡Gracias! 🎉"},
+]
+USER_DATA = {
+    "location": {"latitude": 4.6, "longitude": -74.08},
+    "images": [{"sha256": "a"}, {"sha256": "b"}],
+    "audio_messages": [{"sha256": "c"}],
+}
+
+
+@pytest.fixture
+def extractor(db_path):
+    records = []
+    extractor = CaptureExtractor(
+        StubExtractionBackend(),
+        load_conversation=lambda wa_id: (HISTORY, USER_DATA),
+        on_record=lambda wa_id, conversation_id, record: records.append((wa_id, conversation_id, record)),
+        db_path=db_path,
+        max_attempts=2,
+    )
+    # Sin hilo de fondo: la prueba procesa los lotes directamente
+    extractor.start = lambda: None
+    extractor.records = records
+    return extractor
+
+
+def job_status(db_path, conversation_id):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT status, attempts FROM extraction_jobs WHERE conversation_id = ?",
+                       (conversation_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_stub_backend_extracts_and_normalizes_the_capture(extractor, db_path):
+    assert extractor.enqueue("573001", "conv-1")
+
+    assert extractor.process_batch() == 1
+    assert extractor.process_batch() == 0
+
+    record = extractor.get_record("conv-1")
+    assert record["store_name"] == "D1 Centro"
+    assert record["registered"] == 1
+    assert record["channel"] == "moderno"
+    assert record["category"] is None
+    assert record["brand_feedback"] == "La competencia tiene mejor exhibición"
+    assert (record["latitude"], record["longitude"]) == (4.6, -74.08)
+    assert (record["photo_count"], record["audio_count"]) == (2, 1)
+    assert record["backend"] == "stub"
+    assert [(wa_id, conversation_id) for wa_id, conversation_id, _ in extractor.records] == [("573001", "conv-1")]
+    assert job_status(db_path, "conv-1") == ("done", 1)
+
+
+def test_stub_backend_reads_an_unregistered_user_from_the_text():
+    history = [
+        {"role": "assistant", "content": "¿Ya estás registrado en Kapta?"},
+        {"role": "user", "content": "No todavía"},
+        {"role": "user", "content": "[📸 Documento de identidad recibido, se está procesando]"},
+        {"role": "user", "content": "Listo"},
+        {"role": "user", "content": "Tienda Doña Luz"},
+    ]
+
+    raw, = StubExtractionBackend().extract_batch([build_transcript(history)])
+
+    assert raw == {"registered": False, "store_name": "Tienda Doña Luz", "brand_feedback": None}
+
+
+def test_each_conversation_is_enqueued_once(extractor):
+    extractor.enqueue("573001", "conv-1")
+    extractor.enqueue("573001", "conv-1")
+    extractor.enqueue("573002", "conv-2")
+
+    assert extractor.process_batch() == 2
+    assert extractor.get_record("conv-2")["store_name"] == "D1 Centro"
+
+
+def test_backend_errors_are_retried_until_max_attempts(extractor, db_path):
+    class FailingBackend(StubExtractionBackend):
+        def extract_batch(self, transcripts):
+            raise RuntimeError("backend caído")
+
+    extractor.backend = FailingBackend()
+    extractor.enqueue("573001", "conv-1")
+
+    extractor.process_batch()
+    assert job_status(db_path, "conv-1") == ("pending", 1)
+    extractor.process_batch()
+    assert job_status(db_path, "conv-1") == ("failed", 2)
+    assert extractor.process_batch() == 0
+    assert extractor.get_record("conv-1") is None
@@ -0,0 +1,81 @@
+import app.utils.circuit_breaker as circuit_breaker_module
+from app.utils.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_breaker(monkeypatch, failure_threshold=2, recovery_timeout=30):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker_module.time, "time", clock)
+    return CircuitBreaker("llm", failure_threshold=failure_threshold, recovery_timeout=recovery_timeout), clock
+
+
+def test_opens_after_consecutive_failures(monkeypatch):
+    breaker, _ = make_breaker(monkeypatch)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+
+def test_success_resets_the_failure_count(monkeypatch):
+    breaker, _ = make_breaker(monkeypatch)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_a_single_probe_through(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    breaker.record_failure()
+    breaker.record_failure()
+
+    clock.now += 29
+    assert breaker.state == OPEN
+    clock.now += 1
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow_request()
+    # Mientras la prueba está en curso no pasan más llamadas
+    assert not breaker.allow_request()
+
+
+def test_successful_probe_closes_the_circuit(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow_request()
+
+    breaker.record_success()
+
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_the_circuit(monkeypatch):
+    breaker, clock = make_breaker(monkeypatch, failure_threshold=5)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow_request()
+
+    # Un solo fallo en semiabierto basta para reabrir, sin esperar al umbral
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
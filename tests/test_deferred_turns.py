@@ -0,0 +1,85 @@
+import sqlite3
+
+from app.utils.circuit_breaker import CircuitBreaker
+from app.utils.deferred_turns import DeferredTurnQueue
+
+
+def statuses(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT wa_id, status FROM deferred_turns ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+class Replayer:
+    """replay_fn que reclama los turnos del usuario y falla para los indicados"""
+
+    def __init__(self, queue, failing=(), breaker=None):
+        self.queue = queue
+        self.failing = set(failing)
+        self.breaker = breaker
+        self.calls = []
+
+    def __call__(self, wa_id):
+        self.calls.append(wa_id)
+        turns = self.queue.claim(wa_id)
+        turn_ids = [turn["id"] for turn in turns]
+        if wa_id in self.failing:
+            self.queue.release(turn_ids)
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            return None
+        self.queue.complete(turn_ids)
+        return {"text_response": " / ".join(turn["user_message"] for turn in turns)}
+
+
+def test_turns_are_replayed_per_user_in_arrival_order(db_path):
+    queue = DeferredTurnQueue(db_path)
+    queue.enqueue("B", "Beto", "text", "hola")
+    queue.enqueue("A", "Ana", "text", "primero")
+    queue.enqueue("B", "Beto", "text", "sigo aquí")
+    delivered = []
+
+    assert queue.replay_pending(Replayer(queue), lambda wa_id, response: delivered.append((wa_id, response)))
+
+    assert delivered == [("B", {"text_response": "hola / sigo aquí"}), ("A", {"text_response": "primero"})]
+    assert not queue.has_pending("A") and not queue.has_pending("B")
+
+
+def test_a_user_without_response_does_not_block_the_others(db_path):
+    queue = DeferredTurnQueue(db_path)
+    queue.enqueue("A", "Ana", "text", "uno")
+    queue.enqueue("B", "Beto", "text", "dos")
+    queue.enqueue("C", "Caro", "text", "tres")
+    delivered = []
+
+    replayed = queue.replay_pending(Replayer(queue, failing={"A"}), lambda wa_id, _: delivered.append(wa_id))
+
+    assert replayed == 2
+    assert delivered == ["B", "C"]
+    # Los turnos de A vuelven a la cola para el siguiente ciclo
+    assert statuses(db_path) == [("A", "pending"), ("B", "done"), ("C", "done")]
+
+
+def test_replay_stops_when_the_breaker_opens(db_path):
+    queue = DeferredTurnQueue(db_path)
+    breaker = CircuitBreaker("llm", failure_threshold=1, recovery_timeout=60)
+    queue.enqueue("A", "Ana", "text", "uno")
+    queue.enqueue("B", "Beto", "text", "dos")
+    replayer = Replayer(queue, failing={"A"}, breaker=breaker)
+
+    assert queue.replay_pending(replayer, lambda wa_id, _: None, breaker=breaker) == 0
+
+    assert replayer.calls == ["A"]
+    assert queue.pending_wa_ids() == ["A", "B"]
+
+
+def test_turns_claimed_by_an_interrupted_process_are_requeued(db_path):
+    queue = DeferredTurnQueue(db_path)
+    queue.enqueue("A", "Ana", "text", "uno")
+    queue.claim("A")
+    assert not queue.has_pending("A")
+
+    restarted = DeferredTurnQueue(db_path)
+
+    assert restarted.has_pending("A")
@@ -0,0 +1,116 @@
+import sqlite3
+import hashlib
+import threading
+
+from PIL import Image
+
+from app.services.document_processing import DocumentJobQueue, StubDocumentProcessor
+
+
+class CountingProcessor(StubDocumentProcessor):
+    """StubDocumentProcessor que registra cada solicitud"""
+
+    def __init__(self):
+        self.calls = []
+
+    def process(self, content, mime_type):
+        self.calls.append(mime_type)
+        return super().process(content, mime_type)
+
+
+class ResultCollector:
+    def __init__(self):
+        self.results = []
+        self.done = threading.Event()
+
+    def __call__(self, wa_id, conversation_id, result, sha256s):
+        self.results.append((wa_id, conversation_id, result, sorted(sha256s)))
+        self.done.set()
+
+    def wait(self):
+        assert self.done.wait(5), "el documento no se procesó a tiempo"
+        self.done.clear()
+        return self.results[-1]
+
+
+def make_photo(tmp_path, name, color):
+    path = tmp_path / f"{name}.jpg"
+    Image.new("RGB", (64, 40), color).save(path, format="JPEG")
+    data = path.read_bytes()
+    return {"media_id": name, "path": str(path), "sha256": hashlib.sha256(data).hexdigest(), "mime": "image/jpeg"}
+
+
+def make_queue(db_path, processor, collector, prepared, window=5.0):
+    def prepare(handle):
+        prepared.append(handle["sha256"])
+        return handle
+
+    return DocumentJobQueue(processor, on_result=collector, db_path=db_path, group_window_seconds=window,
+                            prepare=prepare)
+
+
+def test_front_and_back_are_processed_in_one_request(tmp_path, db_path):
+    processor, collector, prepared = CountingProcessor(), ResultCollector(), []
+    queue = make_queue(db_path, processor, collector, prepared)
+    front, back = make_photo(tmp_path, "front", "red"), make_photo(tmp_path, "back", "blue")
+
+    assert queue.submit("573001", "conv-1", front)
+    assert not queue.submit("573001", "conv-1", front)
+    assert queue.submit("573001", "conv-1", back)
+
+    wa_id, conversation_id, result, sha256s = collector.wait()
+    assert (wa_id, conversation_id) == ("573001", "conv-1")
+    assert sha256s == sorted([front["sha256"], back["sha256"]])
+    assert processor.calls == ["image/tiff"]
+    assert len(result["full_document"]["pages"]) == 2
+    assert sorted(prepared) == sha256s
+
+
+def test_single_photo_is_processed_when_the_window_expires(tmp_path, db_path):
+    processor, collector, prepared = CountingProcessor(), ResultCollector(), []
+    queue = make_queue(db_path, processor, collector, prepared, window=0.05)
+    front = make_photo(tmp_path, "front", "red")
+
+    queue.submit("573001", "conv-1", front)
+
+    _, _, result, sha256s = collector.wait()
+    assert sha256s == [front["sha256"]]
+    assert processor.calls == ["image/jpeg"]
+    assert result["success"]
+
+
+def test_resubmitted_photos_are_served_from_the_sha256_cache(tmp_path, db_path):
+    processor, collector, prepared = CountingProcessor(), ResultCollector(), []
+    queue = make_queue(db_path, processor, collector, prepared)
+    front, back = make_photo(tmp_path, "front", "red"), make_photo(tmp_path, "back", "blue")
+    queue.submit("573001", "conv-1", front)
+    queue.submit("573001", "conv-1", back)
+    _, _, first, _ = collector.wait()
+
+    # Las mismas fotos en otra conversación y en otro orden: sin procesar ni preparar de nuevo
+    queue.submit("573001", "conv-2", back)
+    queue.submit("573001", "conv-2", front)
+    _, conversation_id, second, _ = collector.wait()
+
+    assert conversation_id == "conv-2"
+    assert second == first
+    assert processor.calls == ["image/tiff"]
+    assert len(prepared) == 2
+    conn = sqlite3.connect(db_path)
+    hits = conn.execute("SELECT cache_hit FROM document_jobs ORDER BY id").fetchall()
+    conn.close()
+    assert hits == [(0,), (1,)]
+
+
+def test_page_already_processed_in_a_group_hits_the_cache_alone(tmp_path, db_path):
+    processor, collector, prepared = CountingProcessor(), ResultCollector(), []
+    queue = make_queue(db_path, processor, collector, prepared, window=0.05)
+    front, back = make_photo(tmp_path, "front", "red"), make_photo(tmp_path, "back", "blue")
+    queue.submit("573001", "conv-1", front)
+    queue.submit("573001", "conv-1", back)
+    collector.wait()
+
+    queue.submit("573001", "conv-2", front)
+    collector.wait()
+
+    assert processor.calls == ["image/tiff"]
@@ -0,0 +1,112 @@
+import sys
+import types
+import hashlib
+
+import pytest
+from flask import Flask
+
+from app.services import media_server
+
+CONTENT = bytes(range(256)) * 8
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class FakeIngestor:
+    def __init__(self, handles):
+        self.handles = handles
+
+    def get_by_sha256(self, sha256):
+        return self.handles.get(sha256)
+
+
+class FakeDerivatives:
+    def __init__(self, derivatives):
+        self.derivatives = derivatives
+
+    def get(self, sha256):
+        return self.derivatives.get(sha256, {})
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    """Cliente de prueba del blueprint con un medio y, opcionalmente, sus derivados"""
+    path = tmp_path / f"{SHA256}.jpg"
+    path.write_bytes(CONTENT)
+    handles = {SHA256: {"media_id": "m1", "path": str(path), "sha256": SHA256, "size": len(CONTENT),
+                        "mime": "image/jpeg"}}
+    derivatives = {}
+    # media_server importa el ingestor y el generador de whatsapp_utils al atender cada solicitud
+    fake_utils = types.ModuleType("app.utils.whatsapp_utils")
+    fake_utils.media_ingestor = FakeIngestor(handles)
+    fake_utils.derivative_generator = FakeDerivatives(derivatives)
+    monkeypatch.setitem(sys.modules, "app.utils.whatsapp_utils", fake_utils)
+
+    app = Flask(__name__)
+    app.register_blueprint(media_server.bp)
+    client = app.test_client()
+    client.handles, client.derivatives, client.tmp_path = handles, derivatives, tmp_path
+    return client
+
+
+def test_media_is_served_with_the_sha256_etag_and_immutable_caching(media):
+    response = media.get(f"/media/{SHA256}")
+
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers["ETag"] == f'"{SHA256}"'
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+def test_if_none_match_returns_304(media):
+    response = media.get(f"/media/{SHA256}", headers={"If-None-Match": f'"{SHA256}"'})
+
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_range_requests_return_206_and_416(media):
+    partial = media.get(f"/media/{SHA256}", headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.data == CONTENT[10:20]
+    assert partial.headers["Content-Range"] == f"bytes 10-19/{len(CONTENT)}"
+
+    unsatisfiable = media.get(f"/media/{SHA256}", headers={"Range": f"bytes={len(CONTENT) + 10}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_existing_variant_is_served_with_its_own_etag(media):
+    thumb = media.tmp_path / "thumb.webp"
+    thumb.write_bytes(b"miniatura")
+    media.derivatives[SHA256] = {"thumb": {"path": str(thumb), "format": "WEBP"}}
+
+    response = media.get(f"/media/{SHA256}?variant=thumb")
+
+    assert response.data == b"miniatura"
+    assert response.mimetype == "image/webp"
+    assert response.headers["ETag"] == f'"{SHA256}-thumb"'
+
+
+def test_missing_variant_redirects_to_the_original_without_caching(media):
+    response = media.get(f"/media/{SHA256}?variant=thumb")
+
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith(f"/media/{SHA256}")
+    assert response.headers["Cache-Control"] == "no-store"
+    assert "ETag" not in response.headers
+
+
+def test_restored_variant_is_not_served_as_immutable(media):
+    restored = media.tmp_path / f"{SHA256}_restored.jpg"
+    restored.write_bytes(b"jpeg normalizado")
+    media.handles[SHA256] = dict(media.handles[SHA256], path=str(restored), variant="restored")
+
+    response = media.get(f"/media/{SHA256}")
+
+    assert response.data == b"jpeg normalizado"
+    assert "immutable" not in response.headers["Cache-Control"]
+    assert response.headers["ETag"] != f'"{SHA256}"'
+
+
+def test_unknown_media_and_malformed_hashes_return_404(media):
+    assert media.get(f"/media/{'0' * 64}").status_code == 404
+    assert media.get("/media/no-es-un-hash").status_code == 404
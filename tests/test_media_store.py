@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import hashlib
+
+import pytest
+
+import app.utils.media_store as media_store
+from app.utils.media_store import MediaIngestor
+
+ORIGINAL = b"foto original " * 100
+ARCHIVED_VARIANT = b"jpeg normalizado " * 20
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Reemplaza la descarga de la Graph API por bytes fijos por URL"""
+    calls = []
+
+    def fake_stream_to_file(url, part_path, headers=None, max_bytes=None, timeout=None):
+        calls.append(url)
+        with open(part_path, "wb") as f:
+            f.write(ORIGINAL)
+        return {"sha256": hashlib.sha256(ORIGINAL).hexdigest(), "size": len(ORIGINAL), "mime": "image/jpeg"}
+
+    monkeypatch.setattr(media_store, "stream_to_file", fake_stream_to_file)
+    return calls
+
+
+class FakeArchive:
+    """Función restore del ingestor que recupera el objeto archivado indicado"""
+
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def __call__(self, sha256, dest_path):
+        self.calls += 1
+        with open(dest_path, "wb") as f:
+            f.write(self.content)
+        return "image/jpeg"
+
+
+def make_ingestor(tmp_path, db_path, quota_bytes=0, restore=None):
+    ingestor = MediaIngestor(media_dir=str(tmp_path / "media"), db_path=db_path, quota_bytes=quota_bytes,
+                             restore=restore)
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS archived_objects (object_path TEXT PRIMARY KEY, sha256 TEXT, kind TEXT)")
+    conn.commit()
+    conn.close()
+    return ingestor
+
+
+def mark_archived(db_path, sha256):
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO archived_objects VALUES (?, ?, 'image')", (f"obj/{sha256}.jpg", sha256))
+    conn.commit()
+    conn.close()
+
+
+def derived_file(tmp_path, name, size):
+    path = tmp_path / "media" / name
+    path.write_bytes(b"d" * size)
+    return str(path)
+
+
+def test_ingest_downloads_each_media_id_once(tmp_path, db_path, downloads):
+    ingestor = make_ingestor(tmp_path, db_path)
+
+    handle = ingestor.ingest("m1", "https://lookaside/m1")
+    again = ingestor.ingest("m1", "https://lookaside/m1")
+
+    assert downloads == ["https://lookaside/m1"]
+    assert again == handle
+    assert handle["path"].endswith(handle["sha256"] + ".jpg")
+    with open(handle["path"], "rb") as f:
+        assert f.read() == ORIGINAL
+
+
+def test_quota_evicts_derived_files_before_archived_originals(tmp_path, db_path, downloads):
+    ingestor = make_ingestor(tmp_path, db_path, quota_bytes=len(ORIGINAL) + 500)
+    handle = ingestor.ingest("m1", "u1")
+    mark_archived(db_path, handle["sha256"])
+
+    thumb = derived_file(tmp_path, "thumb.webp", 300)
+    ingestor.register_file(thumb, handle["sha256"], "derivative")
+    frame = derived_file(tmp_path, "frame.jpg", 300)
+    ingestor.register_file(frame, handle["sha256"], "frame")
+
+    assert not os.path.exists(thumb)
+    assert os.path.exists(frame)
+    assert os.path.exists(handle["path"])
+
+    ingestor.quota_bytes = 100
+    ingestor.enforce_quota()
+    assert not os.path.exists(frame)
+    assert not os.path.exists(handle["path"])
+
+
+def test_quota_never_evicts_media_that_is_not_archived(tmp_path, db_path, downloads):
+    ingestor = make_ingestor(tmp_path, db_path, quota_bytes=100)
+
+    handle = ingestor.ingest("m1", "u1")
+
+    assert os.path.exists(handle["path"])
+    assert ingestor.enforce_quota() == 0
+
+
+def test_restore_of_identical_bytes_returns_to_the_original_path(tmp_path, db_path, downloads):
+    archive = FakeArchive(ORIGINAL)
+    ingestor = make_ingestor(tmp_path, db_path, restore=archive)
+    handle = ingestor.ingest("m1", "u1")
+    mark_archived(db_path, handle["sha256"])
+    ingestor.quota_bytes = 1
+    ingestor.enforce_quota()
+    ingestor.quota_bytes = 0
+
+    restored = ingestor.get("m1")
+
+    assert restored == handle
+    assert "variant" not in restored
+    assert os.path.exists(handle["path"])
+    assert ingestor.get_by_sha256(handle["sha256"]) == handle
+    assert archive.calls == 1
+
+
+def test_restore_of_an_archived_variant_keeps_its_own_path_and_row(tmp_path, db_path, downloads):
+    archive = FakeArchive(ARCHIVED_VARIANT)
+    ingestor = make_ingestor(tmp_path, db_path, restore=archive)
+    handle = ingestor.ingest("m1", "u1")
+    mark_archived(db_path, handle["sha256"])
+    ingestor.quota_bytes = 1
+    ingestor.enforce_quota()
+    ingestor.quota_bytes = 0
+
+    restored = ingestor.get("m1")
+
+    assert restored["variant"] == "restored"
+    assert restored["path"] != handle["path"]
+    assert restored["size"] == len(ARCHIVED_VARIANT)
+    assert not os.path.exists(handle["path"])
+    conn = sqlite3.connect(db_path)
+    media_row = conn.execute("SELECT sha256, size, mime, evicted FROM media WHERE media_id = 'm1'").fetchone()
+    files = conn.execute("SELECT path, kind FROM media_files").fetchall()
+    conn.close()
+    # La fila del original no cambia: sigue desalojada con su sha256, tamaño y MIME
+    assert media_row == (handle["sha256"], len(ORIGINAL), "image/jpeg", 1)
+    assert files == [(restored["path"], "restored")]
+    # La variante recuperada se reutiliza sin volver al almacenamiento de objetos
+    assert ingestor.get_by_sha256(handle["sha256"])["path"] == restored["path"]
+    assert archive.calls == 1
@@ -0,0 +1,79 @@
+import time
+import threading
+
+import pytest
+
+from app.services.openai_client import OpenAICallLayer, OpenAICallTimeout, summarize_attempts
+from app.utils.llm_metrics import LLMMetrics
+
+
+@pytest.fixture
+def layer():
+    layer = OpenAICallLayer(api_key="sk-test", deadline_seconds=5, attempt_timeout_seconds=2, max_retries=2,
+                            backoff_base_seconds=0, backoff_max_seconds=0, hedge=True, hedge_min_samples=1)
+    yield layer
+    layer._executor.shutdown(wait=True)
+
+
+def test_hedges_are_not_counted_as_retries():
+    attempts = [
+        {"attempt": 1, "hedge": False, "outcome": "abandoned"},
+        {"attempt": 1, "hedge": True, "outcome": "ok"},
+    ]
+    assert summarize_attempts(attempts) == (0, 1)
+
+    attempts = [
+        {"attempt": 1, "hedge": False, "outcome": "error"},
+        {"attempt": 2, "hedge": False, "outcome": "timeout"},
+        {"attempt": 2, "hedge": True, "outcome": "error"},
+        {"attempt": 3, "hedge": False, "outcome": "ok"},
+    ]
+    assert summarize_attempts(attempts) == (2, 1)
+    assert summarize_attempts([{"attempt": 1, "hedge": False, "outcome": "ok"}]) == (0, 0)
+
+
+def test_slow_request_is_hedged_within_the_same_attempt(layer):
+    layer._latencies.append(0.05)
+    release = threading.Event()
+    calls = []
+
+    def method(timeout=None):
+        calls.append(timeout)
+        if len(calls) == 1:
+            # La primera solicitud se queda colgada hasta que termina la prueba
+            release.wait(2)
+            return "lenta"
+        return "cobertura"
+
+    response, attempts = layer.call(method)
+    release.set()
+
+    assert response == "cobertura"
+    assert summarize_attempts(attempts) == (0, 1)
+    assert [(a["attempt"], a["hedge"], a["outcome"]) for a in attempts] == [(1, True, "ok"), (1, False, "abandoned")]
+
+
+def test_transient_errors_are_retried(layer):
+    layer.hedge = False
+    calls = []
+
+    def method(timeout=None):
+        calls.append(timeout)
+        if len(calls) < 3:
+            raise OpenAICallTimeout("lento")
+        return "ok"
+
+    response, attempts = layer.call(method)
+
+    assert response == "ok"
+    assert summarize_attempts(attempts) == (2, 0)
+
+
+def test_retries_and_hedges_are_stored_separately(db_path):
+    metrics = LLMMetrics(db_path)
+    metrics.record("573001", "conv-1", "photos", model="gpt-4o-mini", latency_ms=900, retries=1, hedges=2)
+    metrics.record("573001", "conv-1", "photos", model="gpt-4o-mini", latency_ms=700)
+
+    row, = metrics.rollup_by_step()
+
+    assert (row["calls"], row["retries"], row["hedges"]) == (2, 1, 2)
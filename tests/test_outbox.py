@@ -0,0 +1,135 @@
+import sqlite3
+
+import pytest
+
+from app.utils.outbox import MessageOutbox, PENDING, SENDING, DELIVERED, DEAD
+
+
+class FakeResponse:
+    """Respuesta mínima de la Graph API (la parte que usa el outbox)"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body or {}
+        self.text = str(self._body)
+
+    def json(self):
+        return self._body
+
+
+class FakeSender:
+    """send_fn que responde con la secuencia de códigos indicada por destinatario"""
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.sent = []
+
+    def __call__(self, payload, phone_number_id):
+        to = payload.split('"to": "')[1].split('"')[0]
+        self.sent.append(to)
+        status = self.responses.get(to, []).pop(0) if self.responses.get(to) else 200
+        return FakeResponse(status, {"messages": [{"id": f"wamid.{len(self.sent)}"}]} if status < 300 else {})
+
+
+@pytest.fixture
+def dead_letters():
+    return []
+
+
+def make_outbox(db_path, sender, dead_letters, max_attempts=3):
+    # Sin despachador: la prueba reclama y entrega los mensajes directamente
+    return MessageOutbox(send_fn=sender, db_path=db_path, rate_per_second=1000, burst=1000,
+                         max_attempts=max_attempts, base_delay=60, on_dead_letter=dead_letters.append)
+
+
+def enqueue(outbox, to, kind="text"):
+    return outbox.enqueue({"messaging_product": "whatsapp", "to": to, "type": kind}, to, "pn-1", kind=kind)
+
+
+def status_of(db_path, outbox_id):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT status, attempts, last_status FROM outbox_messages WHERE id = ?",
+                       (outbox_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def make_due(db_path, outbox_id):
+    """Adelanta el reintento programado de un mensaje"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE outbox_messages SET next_attempt_at = 0 WHERE id = ?", (outbox_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_only_the_head_message_of_each_recipient_is_claimed(db_path, dead_letters):
+    outbox = make_outbox(db_path, FakeSender(), dead_letters)
+    a1, a2, b1 = enqueue(outbox, "A"), enqueue(outbox, "A"), enqueue(outbox, "B")
+
+    claimed = outbox._claim_due(10)
+    assert [message["id"] for message in claimed] == [a1, b1]
+    # El segundo mensaje de A espera a que el primero se entregue
+    assert outbox._claim_due(10) == []
+
+    for message in claimed:
+        outbox._deliver(message)
+    assert [message["id"] for message in outbox._claim_due(10)] == [a2]
+    assert status_of(db_path, a1) == (DELIVERED, 1, 200)
+    assert outbox.counts() == {PENDING: 0, SENDING: 1, DELIVERED: 2, DEAD: 0}
+
+
+def test_retryable_errors_are_retried_without_reordering(db_path, dead_letters):
+    outbox = make_outbox(db_path, FakeSender({"A": [503]}), dead_letters)
+    a1, a2 = enqueue(outbox, "A"), enqueue(outbox, "A")
+
+    outbox._deliver(outbox._claim_due(10)[0])
+    assert status_of(db_path, a1) == (PENDING, 1, 503)
+    # Mientras a1 espera su reintento, a2 no se adelanta
+    assert outbox._claim_due(10) == []
+
+    make_due(db_path, a1)
+    retried = outbox._claim_due(10)
+    assert [message["id"] for message in retried] == [a1]
+    outbox._deliver(retried[0])
+    assert status_of(db_path, a1) == (DELIVERED, 2, 200)
+    assert [message["id"] for message in outbox._claim_due(10)] == [a2]
+    assert dead_letters == []
+
+
+def test_messages_go_to_dead_letter_after_max_attempts(db_path, dead_letters):
+    outbox = make_outbox(db_path, FakeSender({"A": [500, 500]}), dead_letters, max_attempts=2)
+    a1, a2 = enqueue(outbox, "A"), enqueue(outbox, "A")
+
+    outbox._deliver(outbox._claim_due(10)[0])
+    make_due(db_path, a1)
+    outbox._deliver(outbox._claim_due(10)[0])
+
+    assert status_of(db_path, a1) == (DEAD, 2, 500)
+    assert [message["id"] for message in dead_letters] == [a1]
+    # El siguiente mensaje del destinatario ya puede salir
+    assert [message["id"] for message in outbox._claim_due(10)] == [a2]
+
+
+def test_client_errors_and_typing_indicators_are_not_retried(db_path, dead_letters):
+    outbox = make_outbox(db_path, FakeSender({"A": [400], "B": [503]}), dead_letters)
+    a1, b1 = enqueue(outbox, "A"), enqueue(outbox, "B", kind="typing")
+
+    for message in outbox._claim_due(10):
+        outbox._deliver(message)
+
+    assert status_of(db_path, a1) == (DEAD, 1, 400)
+    assert status_of(db_path, b1) == (DEAD, 1, 503)
+    assert sorted(message["id"] for message in dead_letters) == [a1, b1]
+
+
+def test_dead_messages_can_be_requeued(db_path, dead_letters):
+    outbox = make_outbox(db_path, FakeSender({"A": [400]}), dead_letters)
+    a1 = enqueue(outbox, "A")
+    outbox._deliver(outbox._claim_due(10)[0])
+
+    assert outbox.retry(a1)
+    assert not outbox.retry(a1)
+    outbox._deliver(outbox._claim_due(10)[0])
+    assert status_of(db_path, a1) == (DELIVERED, 1, 200)
+    assert outbox.oldest_pending_seconds() is None
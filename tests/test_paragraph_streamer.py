@@ -0,0 +1,73 @@
+from app.utils.paragraph_streamer import ParagraphStreamer
+
+
+def stream(deltas):
+    """Alimenta el streamer con los fragmentos dados, como stream_openai_response"""
+    sent = []
+    streamer = ParagraphStreamer(sent.append)
+    for delta in deltas:
+        streamer.feed(delta)
+    return streamer, sent
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_paragraphs_are_sent_as_soon_as_they_complete():
+    streamer, sent = stream(["Hola Ana,", " bienvenida.\n", "\nEnvía tu ", "ubicación."])
+
+    assert sent == ["Hola Ana, bienvenida."]
+    assert streamer.finish() == "Hola Ana, bienvenida.\n\nEnvía tu ubicación."
+    assert sent == ["Hola Ana, bienvenida.", "Envía tu ubicación."]
+
+
+def test_fences_split_across_deltas_are_removed_and_json_is_captured():
+    text = 'Gracias.\n```json\n{"store_name": "D1 Centro"}\n```\n\nAhora la foto.'
+    for size in (1, 2, 3, 7):
+        streamer, sent = stream(chunked(text, size))
+
+        assert streamer.finish() == "Gracias.\n\nAhora la foto."
+        assert sent == ["Gracias.", "Ahora la foto."]
+        assert streamer.json_data == {"store_name": "D1 Centro"}
+
+
+def test_paragraph_breaks_inside_code_blocks_do_not_split_the_text():
+    streamer, sent = stream(["Antes ", "```py", "thon\nprint(1)\n\n\nprint(2)\n", "```", " después\n\nFin"])
+
+    assert streamer.finish() == "Antes después\n\nFin"
+    assert sent == ["Antes después", "Fin"]
+    assert streamer.json_data == {}
+
+
+def test_unclosed_fence_is_never_shown():
+    streamer, sent = stream(["Listo.\n", "```json\n", '{"registered": "si"'])
+
+    assert sent == []
+    assert streamer.finish() == "Listo."
+    assert sent == ["Listo."]
+    assert streamer.json_data == {}
+
+
+def test_only_the_first_valid_json_block_is_kept():
+    streamer, _ = stream([
+        "```json\n{no es json}\n```",
+        '```json\n{"category": "lácteos"}\n```',
+        '```json\n{"category": "aseo"}\n```Listo',
+    ])
+
+    assert streamer.finish() == "Listo"
+    assert streamer.json_data == {"category": "lácteos"}
+
+
+def test_finished_text_is_exactly_what_was_sent():
+    # Con streamed=True el webhook no reenvía text_response: todo lo visible ya salió por on_paragraph
+    streamer, sent = stream(chunked("Uno.[DEBUG: paso 2]\n\n\n\nDos\n\n```json\n{}\n```\n\n  \n\nTres", 4))
+
+    text = streamer.finish()
+
+    assert sent == ["Uno.", "Dos", "Tres"]
+    assert text == "\n\n".join(sent)
+    # Cerrar de nuevo (p. ej. tras cortarse el stream) no reenvía nada
+    assert streamer.finish() == text
+    assert sent == ["Uno.", "Dos", "Tres"]
@@ -0,0 +1,54 @@
+import importlib
+
+import pytest
+
+import app.services.prompts as prompts_module
+from app.services.prompts import STEP_PROMPTS, STEP_SYSTEM_PROMPTS, SYSTEM_PROMPT, get_system_prompt
+
+
+def test_step_prompt_contains_only_that_step():
+    prompt = get_system_prompt("photos")
+
+    assert prompt == STEP_SYSTEM_PROMPTS["photos"]
+    assert STEP_PROMPTS["photos"] in prompt
+    assert STEP_PROMPTS["registration"] not in prompt
+
+
+def test_message_that_advances_the_flow_keeps_the_previous_step_instructions():
+    # Un "listo" durante el registro se valida con las instrucciones del registro
+    prompt = get_system_prompt("store_name", previous_step="registration")
+
+    assert STEP_PROMPTS["registration"] in prompt
+    assert STEP_PROMPTS["store_name"] in prompt
+    assert STEP_PROMPTS["photos"] not in prompt
+    assert get_system_prompt("store_name", previous_step="store_name") == STEP_SYSTEM_PROMPTS["store_name"]
+
+
+def test_unknown_step_falls_back_to_the_full_prompt():
+    assert get_system_prompt(None) == SYSTEM_PROMPT
+    assert get_system_prompt("desconocido", previous_step="onboarding") == SYSTEM_PROMPT
+
+
+@pytest.fixture
+def reload_prompts(monkeypatch):
+    """Recarga el módulo con las variables de entorno de la prueba y lo restaura al final"""
+    yield lambda: importlib.reload(prompts_module)
+    monkeypatch.undo()
+    importlib.reload(prompts_module)
+
+
+def test_json_capture_instructions_are_kept_without_deferred_extraction(monkeypatch, reload_prompts):
+    monkeypatch.setenv("CAPTURE_EXTRACTION_BACKEND", "none")
+    prompts = reload_prompts()
+
+    assert "```json" in prompts.get_system_prompt("photos")
+    assert "JSON local" in prompts.get_system_prompt("registration")
+    assert "JSON" in prompts.STEP_PROMPTS["complete"]
+
+
+def test_json_capture_instructions_are_dropped_with_deferred_extraction(monkeypatch, reload_prompts):
+    monkeypatch.setenv("CAPTURE_EXTRACTION_BACKEND", "stub")
+    prompts = reload_prompts()
+
+    assert "```json" not in prompts.SYSTEM_PROMPT
+    assert "JSON local" not in prompts.SYSTEM_PROMPT
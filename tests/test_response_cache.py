@@ -0,0 +1,97 @@
+import app.utils.response_cache as response_cache_module
+from app.utils.llm_metrics import LLMMetrics
+from app.utils.response_cache import ResponseCache, cache_state
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_key_normalizes_case_accents_punctuation_and_spaces():
+    cache = ResponseCache()
+
+    assert cache.make_key("photos", "text", "  ¡LISTO!! ") == cache.make_key("photos", "text", "listo")
+    assert cache.make_key("onboarding", "text", "Sí") == cache.make_key("onboarding", "text", "si")
+    assert cache.make_key("photos", "text", "listo") != cache.make_key("audio", "text", "listo")
+
+
+def test_uncacheable_turns_have_no_key():
+    cache = ResponseCache(max_message_length=10, opt_out=["audio:listo", "store_name:*"])
+
+    assert cache.make_key("photos", "text", "") is None
+    assert cache.make_key("photos", "text", "un mensaje demasiado largo") is None
+    assert cache.make_key("photos", "location") is None
+    assert cache.make_key("registration", "text", "listo") is None
+    assert cache.make_key("registration", "image") is None
+    assert cache.make_key("audio", "text", "Listo") is None
+    assert cache.make_key("store_name", "text", "hola") is None
+    assert cache.make_key("photos", "image") is not None
+
+
+def test_key_depends_on_the_user_state():
+    cache = ResponseCache()
+    user = {"flow_step": "photos", "images": [{}, {}]}
+    other = {"flow_step": "photos", "images": [{}, {}, {}]}
+    done = dict(user, conversation_complete=True)
+
+    assert cache_state(user) == ("photos", False, 2, 0, 0)
+    assert cache.make_key("photos", "image", state=cache_state(user)) != \
+        cache.make_key("photos", "image", state=cache_state(other))
+    assert cache.make_key("photos", "text", "listo", state=cache_state(user)) != \
+        cache.make_key("photos", "text", "listo", state=cache_state(done))
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache_module.time, "time", clock)
+    cache = ResponseCache(ttl_seconds=60)
+    key = cache.make_key("onboarding", "text", "si")
+    cache.put(key, "Hola Ana", "Ana", latency_ms=800)
+
+    clock.now += 59
+    assert cache.get(key, "Luis") == "Hola Luis"
+    clock.now += 2
+    assert cache.get(key, "Luis") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    first, second, third = (cache.make_key("onboarding", "text", text) for text in ("si", "no", "ya"))
+    cache.put(first, "uno", None, 100)
+    cache.put(second, "dos", None, 100)
+    cache.get(first, None)
+
+    cache.put(third, "tres", None, 100)
+
+    assert cache.get(second, None) is None
+    assert cache.get(first, None) == "uno"
+    assert cache.get(third, None) == "tres"
+
+
+def test_name_is_templated_as_a_whole_word():
+    cache = ResponseCache()
+    key = cache.make_key("onboarding", "text", "si")
+
+    cache.put(key, "¡Genial Al! Vamos a almacenar tu registro", "Al", latency_ms=500)
+
+    assert cache.get(key, "Beatriz") == "¡Genial Beatriz! Vamos a almacenar tu registro"
+    assert cache.saved_latency_ms(key) == 500
+    stats = cache.stats()
+    assert (stats["hits"], stats["latency_saved_ms"]) == (1, 500)
+
+
+def test_cache_stats_are_persisted_for_the_dashboard(db_path):
+    metrics = LLMMetrics(db_path)
+    metrics.record("573001", "conv-1", "photos", cache_hit=True, cache_lookup=True, latency_saved_ms=900)
+    metrics.record("573001", "conv-1", "photos", model="gpt-4o-mini", latency_ms=800, cache_lookup=True)
+    metrics.record("573001", "conv-1", "registration", model="gpt-4o", latency_ms=1200)
+
+    stats = metrics.cache_stats()
+
+    assert (stats["lookups"], stats["hits"], stats["hit_rate"], stats["latency_saved_ms"]) == (2, 1, 0.5, 900)
+    assert [row["flow_step"] for row in stats["by_step"]] == ["photos"]